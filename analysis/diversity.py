@@ -1,4 +1,5 @@
 import os
+import glob
 import shutil
 import numpy as np
 import pandas as pd
@@ -34,10 +35,20 @@ def foldseek_cluster(
     alignment_type: int = 1,
     output_mode: str = 'FLOAT',
     save_tmp: bool=False,
-    foldseek_path: Optional[Union[str, Path]] = None
+    foldseek_path: Optional[Union[str, Path]] = None,
+    threads: Optional[int] = None,
+    query_db: Optional[Union[str, Path]] = None
 ) -> Union[float, dict]:
-
-    if not os.listdir(input):
+    """
+    Cluster the structures under `input` with Foldseek and compute their diversity.
+    If `query_db` (built by `foldseek_createdb` from the same structures) is given, it is clustered
+    directly instead of letting easy-cluster extract the structures again. If that fails, this falls
+    back to easy-cluster with the assistant protein.
+    """
+
+    with os.scandir(input) as entries:
+        is_empty = next(entries, None) is None
+    if is_empty:
         return {"Clusters": 0, "Samples": 0, "Diversity": 0} if output_mode == 'DICT' else 0
     tmp_path = os.path.join(input, 'tmp')
     os.makedirs(tmp_path, exist_ok=True)
@@ -53,38 +64,68 @@ def foldseek_cluster(
             --alignment-mode 2 \
             -v 0'
 
+    if threads is not None:
+        cmd += f' --threads {threads}'
+
     if foldseek_path is not None:
-        cmd.replace('foldseek', str(foldseek_path))
+        cmd = cmd.replace('foldseek', str(foldseek_path), 1)
 
     assist_num = 0
-    try:
-        subprocess.run(cmd, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        for failed_tmp_file in os.listdir(tmp_path):
-            abs_path = os.path.join(tmp_path, failed_tmp_file)
-            if os.path.islink(abs_path):
-                target_path = os.readlink(abs_path)
-                os.unlink(abs_path)
-                pass
-            else:
-                shutil.rmtree(abs_path)
-
-        shutil.copy(assist_protein_path, os.path.join(input, 'assist_protein.pdb'))
-        log.info(f'Foldseek-clusters encountered an error. \
-        Copied an assistant protein to resume clustering.')
-        subprocess.run(cmd, shell=True, check=True)
-        assist_num += 1
-
-
-    result = pd.read_csv(f'{output_prefix}_cluster.tsv', sep='\t', header=None, names=['clusters', 'members'])
-    unique_clusters = result['clusters'].nunique() - assist_num
-    total_members = len(result) - assist_num
-    diversity = round(unique_clusters / total_members, 3)
+    clustered = False
+    if query_db is not None:
+        cluster_db = f'{output_prefix}_clu'
+        cluster_cmd = f'foldseek cluster \
+                {query_db} \
+                {cluster_db} \
+                {tmp_path} \
+                --alignment-type {alignment_type} \
+                --tmscore-threshold {tmscore_threshold} \
+                --alignment-mode 2 \
+                -v 0'
+        if threads is not None:
+            cluster_cmd += f' --threads {threads}'
+        tsv_cmd = f'foldseek createtsv {query_db} {query_db} {cluster_db} {output_prefix}_cluster.tsv -v 0'
+        if foldseek_path is not None:
+            cluster_cmd = cluster_cmd.replace('foldseek', str(foldseek_path), 1)
+            tsv_cmd = tsv_cmd.replace('foldseek', str(foldseek_path), 1)
+        try:
+            subprocess.run(cluster_cmd, shell=True, check=True)
+            subprocess.run(tsv_cmd, shell=True, check=True)
+            clustered = True
+        except subprocess.CalledProcessError:
+            log.info('Foldseek-cluster on the prebuilt query database failed, falling back to easy-cluster.')
+            shutil.rmtree(tmp_path)
+            os.makedirs(tmp_path, exist_ok=True)
+        for cluster_file in glob.glob(f'{cluster_db}*'):
+            os.remove(cluster_file)
+
+    if not clustered:
+        try:
+            subprocess.run(cmd, shell=True, check=True)
+        except subprocess.CalledProcessError as e:
+            for failed_tmp_file in os.listdir(tmp_path):
+                abs_path = os.path.join(tmp_path, failed_tmp_file)
+                if os.path.islink(abs_path):
+                    target_path = os.readlink(abs_path)
+                    os.unlink(abs_path)
+                    pass
+                else:
+                    shutil.rmtree(abs_path)
+
+            shutil.copy(assist_protein_path, os.path.join(input, 'assist_protein.pdb'))
+            log.info(f'Foldseek-clusters encountered an error. \
+            Copied an assistant protein to resume clustering.')
+            subprocess.run(cmd, shell=True, check=True)
+            assist_num += 1
+
+
+    summary = cluster_summary(f'{output_prefix}_cluster.tsv', assist_num=assist_num)
 
     if not save_tmp:
-        os.remove(f'{output_prefix}_cluster.tsv')
-        os.remove(f'{output_prefix}_rep_seq.fasta')
-        os.remove(f'{output_prefix}_all_seqs.fasta')
+        # The FASTA outputs are only written by easy-cluster
+        for tmp_output in [f'{output_prefix}_cluster.tsv', f'{output_prefix}_rep_seq.fasta', f'{output_prefix}_all_seqs.fasta']:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
 
     # Remove assistant protein
     if os.path.exists(os.path.join(input, 'assist_protein.pdb')):
@@ -92,9 +133,53 @@ def foldseek_cluster(
     shutil.rmtree(tmp_path)
 
     if output_mode == 'FLOAT':
-        return diversity
+        return summary['Diversity']
     elif output_mode == 'DICT':
-        return {"Clusters": unique_clusters, "Samples": total_members, "Diversity": diversity}
+        return summary
+
+
+def foldseek_createdb(
+    input: Union[str, Path],
+    db_path: Union[str, Path],
+    threads: Optional[int] = None,
+    foldseek_path: Optional[Union[str, Path]] = None
+) -> str:
+    """
+    Build a Foldseek database from the structures under `input` once, so that clustering
+    (`foldseek_cluster`) and novelty search (`novelty.batched_pdbTM`) can share it.
+    Entries are named after the PDB files, as with easy-cluster / easy-search.
+    """
+    db_path = str(db_path)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    for old_db_file in glob.glob(f'{db_path}*'):
+        os.remove(old_db_file)
+
+    cmd = f'foldseek createdb {input} {db_path} -v 0'
+    if threads is not None:
+        cmd += f' --threads {threads}'
+    if foldseek_path is not None:
+        cmd = cmd.replace('foldseek', str(foldseek_path), 1)
+
+    subprocess.run(cmd, shell=True, check=True)
+    return db_path
+
+
+def cluster_summary(
+    cluster_tsv: Union[str, Path],
+    assist_num: Optional[int] = None
+) -> dict:
+    """
+    Summarize a Foldseek `*_cluster.tsv` into cluster / sample counts and diversity.
+    If `assist_num` is None, the assistant protein is detected from the table itself,
+    which lets a previously written cluster table be reused without rerunning Foldseek.
+    """
+    result = pd.read_csv(cluster_tsv, sep='\t', header=None, names=['clusters', 'members'])
+    if assist_num is None:
+        assist_num = int((result['members'] == 'assist_protein.pdb').sum())
+    unique_clusters = result['clusters'].nunique() - assist_num
+    total_members = len(result) - assist_num
+    diversity = round(unique_clusters / total_members, 3)
+    return {"Clusters": unique_clusters, "Samples": total_members, "Diversity": diversity}
 
 
 def process_directories(methods_dict: Dict[str, List[str]]) -> pd.DataFrame:
@@ -0,0 +1,396 @@
+import os
+import time
+import shutil
+import logging
+import subprocess
+import concurrent.futures
+from typing import Optional, Union, List, Tuple, Dict
+from pathlib import Path
+
+import torch
+import esm
+from omegaconf import DictConfig
+from biotite.sequence.io import fasta
+
+from analysis import utils as au
+
+"""
+Structure prediction shared by the refolding pipelines:
+ESMFold (fair-esm or HuggingFace weights) and AlphaFold2 through LocalColabFold.
+"""
+
+
+log = logging.getLogger(__name__)
+
+# Confidence metrics copied to the host after each ESMFold forward pass
+_ESMFOLD_METRICS = ['predicted_aligned_error', 'ptm', 'mean_plddt']
+
+# fair-esm ESMFold models already loaded in this process, keyed by device
+_ESMFOLD_CACHE: Dict[str, torch.nn.Module] = {}
+
+
+class _CompiledModule(torch.nn.Module):
+    """
+    Run `module` through torch.compile, and switch back to the eager module for good if
+    Dynamo or the compiler backend fails on it. Unlike `torch._dynamo.config.suppress_errors`,
+    this leaves the error handling of other compiled code in the process untouched.
+    Other attributes (e.g. `set_chunk_size`) are looked up on the eager module.
+    """
+
+    def __init__(self, module: torch.nn.Module, **compile_kwargs):
+        super().__init__()
+        self._orig_mod = module
+        self._compiled = torch.compile(module, **compile_kwargs)
+
+    def forward(self, *args, **kwargs):
+        if self._compiled is not None:
+            try:
+                return self._compiled(*args, **kwargs)
+            except torch._dynamo.exc.TorchDynamoException as e:
+                log.warning(f'Failed to compile ESMFold ({e}), running it uncompiled.')
+                self._compiled = None
+        return self._orig_mod(*args, **kwargs)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._orig_mod, name)
+
+
+def _compile_trunk(trunk: torch.nn.Module, **compile_kwargs) -> torch.nn.Module:
+    """Compile the ESMFold trunk if torch.compile is available (PyTorch >= 2.0)."""
+    if not hasattr(torch, 'compile'):
+        log.warning(f'torch.compile is not available in PyTorch {torch.__version__}, running ESMFold uncompiled.')
+        return trunk
+    return _CompiledModule(trunk, **compile_kwargs)
+
+
+def _use_cpu_bf16(infer_conf: DictConfig) -> bool:
+    """Whether to run ESMFold in bfloat16 on CPU: requested by `esmfold_cpu_bf16` and supported by oneDNN."""
+    if not infer_conf.get('esmfold_cpu_bf16', False):
+        return False
+    if not torch.backends.mkldnn.is_available():
+        log.warning('oneDNN is not available in this PyTorch build, running ESMFold in float32 on CPU.')
+        return False
+    return True
+
+
+def load_esmfold(device: str, infer_conf: DictConfig) -> Tuple[torch.nn.Module, bool, torch.dtype]:
+    """Load fair-esm ESMFold on `device`. The model is loaded once per device and shared by all
+    refolders created in this process.
+
+    Args:
+        device (str): 'cpu' or 'cuda:{id}'.
+        infer_conf (DictConfig): The `inference` config, read for the esmfold_* options.
+
+    Returns:
+        The folding model, whether to run it under autocast and the autocast dtype.
+    """
+    if 'cuda' in device:
+        if device not in _ESMFOLD_CACHE:
+            folding_model = esm.pretrained.esmfold_v1().eval()
+            # Run the ESM-2 language model in half precision and let the folding trunk use TF32 matmuls
+            folding_model.esm = folding_model.esm.half()
+            _ESMFOLD_CACHE[device] = folding_model.to(device)
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
+        folding_model = _ESMFOLD_CACHE[device]
+        # Compile the folding trunk (including the structure module) into fused kernels.
+        # Requires PyTorch >= 2.0, options as in `load_esmfold_hf`.
+        if infer_conf.get('esmfold_compile', False) and not hasattr(folding_model.trunk, '_orig_mod'):
+            folding_model.trunk = _compile_trunk(folding_model.trunk, mode='reduce-overhead', dynamic=True)
+        # Chunk the axial attention of the trunk to bound memory on long sequences
+        folding_model.trunk.set_chunk_size(infer_conf.get('esmfold_chunk_size', None))
+        autocast = infer_conf.get('esmfold_autocast', False)
+        autocast_dtype = getattr(torch, infer_conf.get('esmfold_autocast_dtype', 'float16'))
+        return folding_model, autocast, autocast_dtype
+
+    # ESMFold is not supported for half-precision model when running on CPU.
+    # bfloat16 is supported though: optionally keep the ESM-2 language model in bf16
+    # and run the folding trunk under bf16 autocast (fast on CPUs with AVX512-BF16 / AMX).
+    esmfold_cpu_bf16 = _use_cpu_bf16(infer_conf)
+    model_key = 'cpu-bf16' if esmfold_cpu_bf16 else 'cpu'
+    if model_key not in _ESMFOLD_CACHE:
+        folding_model = esm.pretrained.esmfold_v1().float().eval()
+        if esmfold_cpu_bf16:
+            folding_model.esm = folding_model.esm.to(torch.bfloat16)
+        _ESMFOLD_CACHE[model_key] = folding_model
+    return _ESMFOLD_CACHE[model_key], esmfold_cpu_bf16, torch.bfloat16
+
+
+def load_esmfold_hf(device: str, infer_conf: DictConfig) -> Tuple[torch.nn.Module, bool, torch.dtype]:
+    """Load the HuggingFace port of ESMFold (`facebook/esmfold_v1`) on `device`.
+
+    Args:
+        device (str): 'cpu' or 'cuda:{id}'.
+        infer_conf (DictConfig): The `inference` config, read for the esmfold_* options.
+
+    Returns:
+        The folding model, whether to run it under autocast and the autocast dtype.
+    """
+    from transformers import EsmForProteinFolding
+
+    model = EsmForProteinFolding.from_pretrained("facebook/esmfold_v1", low_cpu_mem_usage=True)
+    autocast = False
+    autocast_dtype = torch.float16
+    if 'cuda' in device:
+        model = model.to(device)
+        # Uncomment to switch the stem to float16
+        model.esm = model.esm.half()
+        torch.backends.cuda.matmul.allow_tf32 = True
+        # Uncomment this line if your GPU memory is 16GB or less, or if you're folding longer (over 600 or so) sequences
+        model.trunk.set_chunk_size(64)
+        # Compile the folding trunk (including the structure module) into fused kernels.
+        # Requires PyTorch >= 2.0. Lengths differ between batches, so shapes are traced dynamically,
+        # and the trunk falls back to eager if it fails to compile instead of failing the run.
+        if infer_conf.get('esmfold_compile', False):
+            model.trunk = _compile_trunk(model.trunk, mode='reduce-overhead', dynamic=True)
+        # The folding trunk runs under autocast on GPU, the ESM-2 stem is already in half precision
+        autocast = infer_conf.get('esmfold_autocast', False)
+        autocast_dtype = getattr(torch, infer_conf.get('esmfold_autocast_dtype', 'float16'))
+        return model.eval(), autocast, autocast_dtype
+
+    # ESMFold is not supported for half-precision model when running on CPU
+    model = model.float().eval()
+    # bfloat16 is supported though: optionally keep the ESM-2 language model in bf16
+    # and run the folding trunk under bf16 autocast (fast on CPUs with AVX512-BF16 / AMX).
+    if _use_cpu_bf16(infer_conf):
+        model.esm = model.esm.to(torch.bfloat16)
+        autocast = True
+        autocast_dtype = torch.bfloat16
+    # Use every core this process may run on, some builds otherwise start oneDNN with a single thread
+    num_threads = infer_conf.get('esmfold_cpu_threads', None)
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        # Can only be set before the first inter-op parallel work, e.g. by an earlier refolder
+        pass
+    log.info(f'Running ESMFold on {num_threads} CPU threads.')
+    return model, autocast, autocast_dtype
+
+
+def write_pdb(save_path: Union[str, Path], pdb_str: str):
+    with open(save_path, "w") as f:
+        f.write(pdb_str)
+
+
+class PDBWriter:
+    """Write predicted structures to disk in background threads while the GPU folds the next batch."""
+
+    def __init__(self, max_workers: int = 4):
+        self._max_workers = max_workers
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = []
+
+    def submit(self, save_path: Union[str, Path], pdb_str: str):
+        self._pending.append(self._pool.submit(write_pdb, save_path, pdb_str))
+
+    def wait(self):
+        """Block until all queued writes are done, re-raising any error from the writer threads."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def shutdown(self):
+        """Wait for the queued writes and stop the writer threads. A fresh executor, which
+        starts no thread until it is used, replaces it so the writer can still be reused."""
+        self._pool.shutdown(wait=True)
+        self._pending = []
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers)
+
+
+def run_esmfold(
+    model: torch.nn.Module,
+    sequence: str,
+    save_path: Union[str, Path],
+    device: str,
+    autocast: bool = False,
+    autocast_dtype: torch.dtype = torch.float16
+):
+    """Run ESMFold on a single sequence and write the prediction to `save_path`.
+
+    Returns:
+        The PDB strings and the confidence metrics (predicted_aligned_error, ptm, mean_plddt) on the host.
+    """
+    with torch.inference_mode(), torch.autocast(device_type=device.split(':')[0], dtype=autocast_dtype, enabled=autocast):
+        output = model.infer(sequence)
+        # Queue the copies of the confidence metrics before building the PDB
+        # string so they overlap, then synchronize once
+        output_dict = {key: output[key].float().to('cpu', non_blocking=True) for key in _ESMFOLD_METRICS}
+        pdbs = model.output_to_pdb(output)
+    if 'cuda' in device:
+        torch.cuda.synchronize(device)
+    write_pdb(save_path, pdbs[0])
+    return pdbs, output_dict
+
+
+def run_esmfold_batch(
+    model: torch.nn.Module,
+    sequences: List[str],
+    save_paths: List[Union[str, Path]],
+    device: str,
+    autocast: bool = False,
+    autocast_dtype: torch.dtype = torch.float16,
+    pdb_writer: Optional[PDBWriter] = None
+) -> List[Dict]:
+    """Run ESMFold on a batch of sequences in a single forward pass.
+    Outputs of each sequence are trimmed to its own length so that
+    padding does not leak into the per-sample metrics.
+
+    Args:
+        pdb_writer (Optional[PDBWriter]): Writes the predictions in the background, call its `wait`
+            before reading them. They are written before returning if None.
+
+    Returns:
+        Per sequence, the confidence metrics and the CA coordinates (`bb_positions`) of the prediction.
+    """
+    with torch.inference_mode(), torch.autocast(device_type=device.split(':')[0], dtype=autocast_dtype, enabled=autocast):
+        output = model.infer(sequences)
+        # Only the confidence metrics and the CA coordinates of the final structure module
+        # iteration (atom14 index 1) are needed on the host, in full precision.
+        # Queue their copies before building the PDB strings and synchronize once.
+        metrics = {key: output[key].float().to('cpu', non_blocking=True) for key in _ESMFOLD_METRICS}
+        ca_positions = output['positions'][-1, :, :, 1].float().to('cpu', non_blocking=True)
+        pdbs = model.output_to_pdb(output)
+    if 'cuda' in device:
+        torch.cuda.synchronize(device)
+    ca_positions = ca_positions.numpy()
+    output_dicts = []
+    for i, (sequence, pdb_str, save_path) in enumerate(zip(sequences, pdbs, save_paths)):
+        if pdb_writer is not None:
+            pdb_writer.submit(save_path, pdb_str)
+        else:
+            write_pdb(save_path, pdb_str)
+        length = len(sequence)
+        output_dicts.append({
+            'predicted_aligned_error': metrics['predicted_aligned_error'][i, :length, :length],
+            'ptm': metrics['ptm'][i],
+            'mean_plddt': metrics['mean_plddt'][i],
+            'bb_positions': ca_positions[i, :length],
+        })
+    return output_dicts
+
+
+def setup_af2(af2_conf: DictConfig, device: str):
+    """Apply `af2.only_best` and put LocalColabFold on the PATH."""
+    if af2_conf.get('only_best', False):
+        # Only the top-ranked AlphaFold2 model is evaluated downstream
+        log.warning('`af2.only_best` is set: overriding num_models, num_relax and rank '
+                    'with 1, 1 and plddt for AlphaFold2.')
+        af2_conf.num_models = 1
+        af2_conf.num_relax = 1
+        af2_conf.rank = 'plddt'
+    colabfold_path = af2_conf.executive_colabfold_path
+    current_path = os.environ.get('PATH', '')
+    os.environ['PATH'] = colabfold_path + ":" + current_path
+    if device == 'cpu':
+        log.info(f"You're running AlphaFold2 on {device}.")
+
+
+def colabfold_args(af2_conf: DictConfig) -> List[str]:
+    """Command-line options of a single-sequence colabfold_batch run."""
+    af2_args = [
+        '--msa-mode',
+        'single_sequence',
+        '--num-recycle',
+        str(af2_conf.recycle),
+        '--random-seed',
+        str(af2_conf.seed),
+        '--model-type',
+        af2_conf.model_type,
+        '--num-models',
+        str(af2_conf.num_models),
+    ]
+    if af2_conf.num_models > 1:
+        af2_args.append('--rank')
+        af2_args.append(af2_conf.rank)
+    if af2_conf.use_amber_relax:
+        af2_args.append('--amber')
+        af2_args.append('--num-relax')
+        af2_args.append(str(af2_conf.num_relax))
+        if af2_conf.use_gpu_relax:
+            af2_args.append('--use-gpu-relax')
+    return af2_args
+
+
+def run_colabfold(
+    af2_args: List[str],
+    input_path: Union[str, Path],
+    save_path: Union[str, Path],
+    gpu_ids: Optional[List[int]] = None,
+    timeout: Optional[float] = None
+):
+    """Run colabfold_batch on the sequences of `input_path`.
+
+    Args:
+        af2_args (List[str]): Options from `colabfold_args`.
+        gpu_ids (Optional[List[int]]): If several are given, the sequences are split over
+            these GPUs with one ColabFold process per GPU. Otherwise all sequences go
+            through a single colabfold_batch call.
+        timeout (Optional[float]): Seconds after which a hung attempt is killed and retried.
+    """
+    if gpu_ids is None or len(gpu_ids) <= 1:
+        _run_colabfold(af2_args, input_path, save_path, timeout=timeout)
+        return
+
+    seqs = list(fasta.FastaFile.read(input_path).items())
+    shard_dir = os.path.join(os.path.dirname(os.path.normpath(save_path)), 'af2_inputs')
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for shard_idx, gpu_id in enumerate(gpu_ids):
+        shard_seqs = dict(seqs[shard_idx::len(gpu_ids)])
+        if len(shard_seqs) == 0:
+            continue
+        shard_path = os.path.join(shard_dir, f'shard_{shard_idx}.fa')
+        au.write_seqs_to_fasta(shard_seqs, shard_path)
+        shards.append((shard_path, gpu_id))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        futures = [pool.submit(_run_colabfold, af2_args, shard_path, save_path, gpu_id, timeout)
+                   for shard_path, gpu_id in shards]
+        for future in futures:
+            future.result()
+
+
+def _run_colabfold(af2_args, input_path, save_path, gpu_id=None, timeout=None, max_tries: int = 5):
+    """
+    Run colabfold_batch on `input_path`, retrying with exponential backoff if it exits with an error.
+    Its output is appended to `af2_run.log` next to `save_path`, which is truncated once it exceeds 10 MB.
+    """
+    env = os.environ.copy()
+    if gpu_id is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+    # An absolute executable path and close_fds=False let subprocess use posix_spawn (Python >= 3.8)
+    # instead of forking this process, whose address space is large once torch is loaded
+    colabfold_batch = shutil.which('colabfold_batch') or 'colabfold_batch'
+    log_name = 'af2_run.log' if gpu_id is None else f'af2_run_gpu{gpu_id}.log'
+    log_path = os.path.join(os.path.dirname(os.path.normpath(save_path)), log_name)
+    for num_tries in range(1, max_tries + 1):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if os.path.exists(log_path) and os.path.getsize(log_path) > 10 * 1024 * 1024:
+            flags |= os.O_TRUNC
+        log_fd = os.open(log_path, flags, 0o644)
+        try:
+            ret_af2 = subprocess.run(
+                [colabfold_batch, input_path, save_path] + af2_args,
+                env=env,
+                stdout=log_fd,
+                stderr=subprocess.STDOUT,
+                close_fds=False,
+                timeout=timeout,
+                check=False
+            ).returncode
+        except subprocess.TimeoutExpired:
+            # The hung process has been killed, retry it like a failed run
+            ret_af2 = 'timeout'
+        finally:
+            os.close(log_fd)
+        if ret_af2 == 0:
+            return
+        log.info(f'Hmm...Maybe some error occurs during executing AlphaFold2 (exit code {ret_af2}), see {log_path}. Tried {num_tries}/{max_tries}')
+        if num_tries < max_tries:
+            time.sleep(min(2 ** num_tries, 60))
+    raise RuntimeError(f'AlphaFold2 failed on {input_path} after {max_tries} attempts.')
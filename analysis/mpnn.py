@@ -0,0 +1,223 @@
+import os
+import sys
+import copy
+import logging
+import importlib
+import subprocess
+import threading
+from typing import Optional, Union, List, Dict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+"""
+ProteinMPNN run inside the refolding process, with the weights loaded once instead of
+spawning `protein_mpnn_run.py` for every backbone. Sampling follows `protein_mpnn_run.py`
+(temperature 0.1, seed 33) and writes the same FASTA files.
+"""
+
+
+log = logging.getLogger(__name__)
+
+
+def _join_mpnn_chains(seq: str, chain_lengths: List[int], chain_order: List[str]) -> str:
+    """
+    Reorder the designed chains of a ProteinMPNN sequence by chain ID and
+    separate them with "/", as `protein_mpnn_run.py` does in its outputs.
+    """
+    chunks = []
+    start = 0
+    for length in chain_lengths:
+        chunks.append(seq[start:start + length])
+        start += length
+    return "/".join(chunks[i] for i in np.argsort(chain_order))
+
+
+def _git_hash(pmpnn_dir: Union[str, Path]) -> str:
+    """Commit of the ProteinMPNN checkout, as written by `protein_mpnn_run.py` in the FASTA headers."""
+    try:
+        return subprocess.check_output(
+            ['git', '--git-dir', os.path.join(pmpnn_dir, '.git'), 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+
+
+class ProteinMPNNSampler:
+    """
+    In-process ProteinMPNN. Models are loaded on first use and kept for later backbones.
+    `sample` is safe to call from several threads, runs are serialized by a lock.
+
+    Args:
+        pmpnn_dir (Union[str, Path]): ProteinMPNN checkout holding `protein_mpnn_utils.py` and the weights.
+        device (str): Device the models run on.
+        seed (int): Seed of every run, so the sequences of a backbone do not depend on earlier runs.
+        temperature (float): Sampling temperature.
+    """
+
+    def __init__(self, pmpnn_dir: Union[str, Path], device: str, seed: int = 33, temperature: float = 0.1):
+        self._pmpnn_dir = os.fspath(pmpnn_dir)
+        if self._pmpnn_dir not in sys.path:
+            sys.path.insert(0, self._pmpnn_dir)
+        self._utils = importlib.import_module('protein_mpnn_utils')
+        self.device = device
+        self.seed = seed
+        self.temperature = temperature
+        self._git_hash = _git_hash(self._pmpnn_dir)
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _get_model(self, ca_only: bool):
+        """
+        Load the ProteinMPNN model (full-backbone or CA-only) on first use and keep it for later backbones.
+        """
+        if ca_only not in self._models:
+            weights_dir = 'ca_model_weights' if ca_only else 'vanilla_model_weights'
+            checkpoint_path = os.path.join(self._pmpnn_dir, weights_dir, 'v_48_020.pt')
+            checkpoint = torch.load(checkpoint_path, map_location=self.device)
+            model = self._utils.ProteinMPNN(
+                ca_only=ca_only,
+                num_letters=21,
+                node_features=128,
+                edge_features=128,
+                hidden_dim=128,
+                num_encoder_layers=3,
+                num_decoder_layers=3,
+                augment_eps=0.0,
+                k_neighbors=checkpoint['num_edges']
+            )
+            model.load_state_dict(checkpoint['model_state_dict'])
+            self._models[ca_only] = model.to(self.device).eval()
+            log.info(f'Loaded ProteinMPNN weights from {checkpoint_path}')
+        return self._models[ca_only]
+
+    def sample(
+            self,
+            pdb_path: Union[str, Path],
+            out_dir: Union[str, Path],
+            num_seqs: int,
+            batch_size: int,
+            ca_only: bool = False,
+            fixed_positions: Optional[Dict[str, List[int]]] = None
+            ) -> str:
+        """
+        Sample sequences for one backbone and write them to out_dir/seqs/<name>.fa.
+
+        ProteinMPNN draws from the global torch RNG (`torch.randn`, `torch.multinomial`), which cannot
+        be given a generator. Each run is seeded inside `torch.random.fork_rng`, so the RNG state
+        of the rest of the process is restored afterwards. Python and NumPy RNGs are not touched.
+
+        Args:
+            pdb_path: Path to the backbone to be designed.
+            out_dir: Directory where the `seqs` folder is created.
+            num_seqs: Number of sequences to sample, rounded down to a multiple of `batch_size`.
+            batch_size: Sequences sampled per forward pass.
+            ca_only: Whether to use the CA-only ProteinMPNN weights.
+            fixed_positions: Optional mapping from chain ID to 1-based residue positions kept fixed.
+
+        Returns:
+            Path of the written FASTA file.
+        """
+        with self._lock:
+            device = torch.device(self.device)
+            rng_devices = []
+            if device.type == 'cuda':
+                rng_devices = [device.index if device.index is not None else torch.cuda.current_device()]
+            with torch.random.fork_rng(devices=rng_devices):
+                # Only the generators restored by fork_rng are seeded
+                torch.default_generator.manual_seed(self.seed)
+                for index in rng_devices:
+                    with torch.cuda.device(index):
+                        torch.cuda.manual_seed(self.seed)
+                fasta_lines, name = self._sample(pdb_path, device, num_seqs, batch_size, ca_only, fixed_positions)
+
+        seqs_dir = os.path.join(out_dir, 'seqs')
+        os.makedirs(seqs_dir, exist_ok=True)
+        fasta_path = os.path.join(seqs_dir, f'{name}.fa')
+        with open(fasta_path, 'w') as f:
+            f.write('\n'.join(fasta_lines) + '\n')
+        return fasta_path
+
+    def _sample(self, pdb_path, device, num_seqs, batch_size, ca_only, fixed_positions):
+        mpnn = self._utils
+        model = self._get_model(ca_only)
+        temperature = self.temperature
+        num_batches = num_seqs // batch_size
+        alphabet = 'ACDEFGHIKLMNPQRSTVWYX'
+        omit_AAs_np = np.array([AA in 'X' for AA in alphabet]).astype(np.float32)
+        bias_AAs_np = np.zeros(len(alphabet))
+        score_fmt = lambda x: np.format_float_positional(np.float32(x), unique=False, precision=4)
+
+        protein = mpnn.parse_PDB(str(pdb_path), ca_only=ca_only)[0]
+        name = protein['name']
+        fixed_positions_dict = None
+        if fixed_positions is not None:
+            all_chains = [key[-1:] for key in protein if key[:9] == 'seq_chain']
+            fixed_positions_dict = {name: {chain: fixed_positions.get(chain, []) for chain in all_chains}}
+
+        log.info(f'Running ProteinMPNN on {name}......')
+        batch_clones = [copy.deepcopy(protein) for _ in range(batch_size)]
+        with torch.no_grad():
+            (X, S, mask, lengths, chain_M, chain_encoding_all, chain_list_list, visible_list_list,
+             masked_list_list, masked_chain_length_list_list, chain_M_pos, omit_AA_mask, residue_idx,
+             dihedral_mask, tied_pos_list_of_lists_list, pssm_coef, pssm_bias, pssm_log_odds_all,
+             bias_by_res_all, tied_beta) = mpnn.tied_featurize(
+                batch_clones, device, None, fixed_positions_dict, ca_only=ca_only)
+            pssm_log_odds_mask = (pssm_log_odds_all > 0.0).float()
+            mask_for_loss = mask * chain_M * chain_M_pos
+
+            # Score the input sequence
+            randn_1 = torch.randn(chain_M.shape, device=X.device)
+            log_probs = model(X, S, mask, chain_M * chain_M_pos, residue_idx, chain_encoding_all, randn_1)
+            native_score = mpnn._scores(S, log_probs, mask_for_loss).cpu().numpy()
+            global_native_score = mpnn._scores(S, log_probs, mask).cpu().numpy()
+            native_seq = _join_mpnn_chains(
+                mpnn._S_to_seq(S[0], chain_M[0]), masked_chain_length_list_list[0], masked_list_list[0])
+            visible_chains = sorted(visible_list_list[0])
+            masked_chains = sorted(masked_list_list[0])
+            model_name_key = 'CA_model_name' if ca_only else 'model_name'
+            fasta_lines = [
+                f'>{name}, score={score_fmt(native_score.mean())}, global_score={score_fmt(global_native_score.mean())}, '
+                f'fixed_chains={visible_chains}, designed_chains={masked_chains}, {model_name_key}=v_48_020, '
+                f'git_hash={self._git_hash}, seed={self.seed}',
+                native_seq
+            ]
+
+            # Sample sequences
+            for j in range(num_batches):
+                randn_2 = torch.randn(chain_M.shape, device=X.device)
+                sample_dict = model.sample(
+                    X, randn_2, S, chain_M, chain_encoding_all, residue_idx, mask=mask,
+                    temperature=temperature, omit_AAs_np=omit_AAs_np, bias_AAs_np=bias_AAs_np,
+                    chain_M_pos=chain_M_pos, omit_AA_mask=omit_AA_mask, pssm_coef=pssm_coef,
+                    pssm_bias=pssm_bias, pssm_multi=0.0, pssm_log_odds_flag=False,
+                    pssm_log_odds_mask=pssm_log_odds_mask, pssm_bias_flag=False, bias_by_res=bias_by_res_all
+                )
+                S_sample = sample_dict["S"]
+                log_probs = model(
+                    X, S_sample, mask, chain_M * chain_M_pos, residue_idx, chain_encoding_all, randn_2,
+                    use_input_decoding_order=True, decoding_order=sample_dict["decoding_order"]
+                )
+                scores = mpnn._scores(S_sample, log_probs, mask_for_loss).cpu().numpy()
+                global_scores = mpnn._scores(S_sample, log_probs, mask).cpu().numpy()
+                for b_ix in range(batch_size):
+                    seq_recovery_rate = torch.sum(
+                        torch.sum(
+                            torch.nn.functional.one_hot(S[b_ix], 21) * torch.nn.functional.one_hot(S_sample[b_ix], 21),
+                            axis=-1
+                        ) * mask_for_loss[b_ix]
+                    ) / torch.sum(mask_for_loss[b_ix])
+                    seq = _join_mpnn_chains(
+                        mpnn._S_to_seq(S_sample[b_ix], chain_M[b_ix]),
+                        masked_chain_length_list_list[b_ix],
+                        masked_list_list[b_ix]
+                    )
+                    sample_number = j * batch_size + b_ix + 1
+                    fasta_lines.append(
+                        f'>T={temperature}, sample={sample_number}, score={score_fmt(scores[b_ix])}, '
+                        f'global_score={score_fmt(global_scores[b_ix])}, seq_recovery={score_fmt(seq_recovery_rate.cpu().numpy())}'
+                    )
+                    fasta_lines.append(seq)
+        return fasta_lines, name
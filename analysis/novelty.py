@@ -1,14 +1,18 @@
 import os
+import glob
+import shutil
 import numpy as np
 import pandas as pd
 import subprocess
+import multiprocessing
 import argparse
 import psutil
 import time
+import logging
 import typing as T
 from typing import Optional, Union, List, Tuple, Dict
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 """
 Novelty Calculation.
@@ -17,7 +21,8 @@ We provide two options for calculating the pdbTM value:
 1. Indepentdent Mode: Calculate the pdbTM value of a single input PDB file.
     Example usage: python pdbTM.py -c {example}.pdb
 2. Batch Mode: Calculate pdbTM of a number of PDBs once in a time. 
-    Take a csv file with 'backbone_path' as the path of PDB files as input.
+    Take a csv file with 'backbone_path' as the path of PDB files, or a directory of PDB files as input.
+    All PDBs are searched with a single Foldseek call.
     A csv file will be returned with 'pdbTM' column filled with corresponding values.
     
 Args:
@@ -28,12 +33,17 @@ Independent Mode:
 
 Batch Mode:
 [Required]
-'-i', '--input': Path of input csv file you want to calculate with.
+'-i', '--input': Path of input csv file (or directory of PDB files) you want to calculate with.
 [Optional]
 '-o', '--output': Path of output csv file with calculated pdbTM values.
                     Default = "novelty_results.csv" 
+'-t', '--threads': Number of threads used by Foldseek. Default = all CPU cores.
+
+Both modes require '-d', '--database': Path of the Foldseek database to search against.
 """
 
+log = logging.getLogger(__name__)
+
 def pdbTM(
     input: Union[str, Path],
     foldseek_database_path: Union[str, Path],
@@ -85,7 +95,7 @@ def pdbTM(
                 -v 0'
                 
         if foldseek_path is not None:
-            cmd.replace('foldseek', {foldseek_path})
+            cmd = cmd.replace('foldseek', str(foldseek_path), 1)
 
         _ = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
         
@@ -100,25 +110,158 @@ def pdbTM(
             
     return top_pdbTM
 
+def prewarm_foldseek_database(
+    foldseek_database_path: Union[str, Path],
+    copy_to: Optional[Union[str, Path]] = None,
+    chunk_size: int = 64 * 1024 * 1024,
+) -> str:
+    """
+    Pull a Foldseek database into memory before searching it.
+    
+    Every file sharing the database prefix is either read once sequentially, so that it is
+    served from the page cache afterwards, or copied into `copy_to` (e.g. a tmpfs such as /dev/shm).
+    Both options need about as much free RAM as the database occupies on disk
+    (e.g. ~150 GB for the full PDB database).
+    
+    Returns:
+    The database path to search with, i.e. the copied prefix if `copy_to` is given.
+    """
+    foldseek_database_path = str(foldseek_database_path)
+    db_files = [f for f in glob.glob(f'{foldseek_database_path}*') if os.path.isfile(f)]
+
+    if copy_to is not None:
+        os.makedirs(copy_to, exist_ok=True)
+        for f in db_files:
+            dst = os.path.join(copy_to, os.path.basename(f))
+            if not os.path.exists(dst) or os.path.getsize(dst) != os.path.getsize(f):
+                shutil.copyfile(f, dst)
+        return os.path.join(copy_to, os.path.basename(foldseek_database_path))
+
+    buffer = bytearray(chunk_size)
+    for f in db_files:
+        with open(f, 'rb', buffering=0) as fh:
+            while fh.readinto(buffer):
+                pass
+    return foldseek_database_path
+
+def batched_pdbTM(
+    inputs: List[Union[str, Path]],
+    foldseek_database_path: Union[str, Path],
+    threads: int,
+    tmp_dir: Union[str, Path] = "../tmp/batched_search",
+    save_tmp: bool = False,
+    foldseek_path: Optional[Union[Path, str]] = None,
+    query_db: Optional[Union[str, Path]] = None,
+) -> Dict[str, float]:
+    """
+    Calculate pdbTM values of many PDB files with a single Foldseek search.
+    
+    Queries are staged (symlinked) into one directory so that the database is loaded
+    only once, and parallelism is left to Foldseek's own `--threads`.
+    If `query_db` is given (see `diversity.foldseek_createdb`), it is searched directly instead;
+    its entries must be named after the basenames of `inputs`.
+    Search parameters and the pdbTM definition (TM-score of the top hit) are the same as `pdbTM`.
+    
+    Returns:
+    A dictionary mapping each input path to its pdbTM value (None if Foldseek found no hit).
+    """
+    search_tmp = os.path.join(tmp_dir, 'tmp')
+    os.makedirs(search_tmp, exist_ok=True)
+    output_file = os.path.join(tmp_dir, 'batched_search.m8')
+    search_args = f'--alignment-type 1 \
+            --num-iterations 2 \
+            -e inf \
+            --threads {threads} \
+            -v 0'
+    format_args = '--format-mode 4 --format-output query,target,evalue,alntmscore,rmsd,prob'
+
+    staged = {}
+    if query_db is not None:
+        for path in inputs:
+            staged.setdefault(os.path.basename(path), []).append(path)
+        aln_db = os.path.join(tmp_dir, 'aln')
+        cmds = [
+            f'foldseek search {query_db} {foldseek_database_path} {aln_db} {search_tmp} {search_args}',
+            f'foldseek convertalis {query_db} {foldseek_database_path} {aln_db} {output_file} {format_args} -v 0',
+        ]
+    else:
+        query_dir = os.path.join(tmp_dir, 'queries')
+        os.makedirs(query_dir, exist_ok=True)
+        # Prefix with the index so that backbones sharing a basename do not collide
+        for idx, path in enumerate(inputs):
+            name = f'{idx}_{os.path.basename(path)}'
+            dst = os.path.join(query_dir, name)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.symlink(os.path.abspath(path), dst)
+            staged[name] = [path]
+        cmds = [
+            f'foldseek easy-search {query_dir} {foldseek_database_path} {output_file} {search_tmp} {format_args} {search_args}',
+        ]
+
+    for cmd in cmds:
+        if foldseek_path is not None:
+            cmd = cmd.replace('foldseek', str(foldseek_path), 1)
+        _ = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    result = pd.read_csv(output_file, sep='\t', usecols=['query', 'alntmscore'],
+                         dtype={'query': 'string', 'alntmscore': 'float32'})
+    # Foldseek may append a chain suffix to the query name, strip everything after '.pdb'
+    result['query'] = result['query'].str.replace(r'(\.pdb).*$', r'\1', regex=True)
+    # Hits are reported best first for every query, so the first row is the top hit
+    top_hits = result.groupby('query', sort=False)['alntmscore'].first().round(3)
+
+    pdbTM_values = {path: None for path in inputs}
+    for name, value in top_hits.items():
+        for path in staged.get(name, []):
+            pdbTM_values[path] = float(value)
+
+    if save_tmp == False:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return pdbTM_values
+
 def calculate_novelty(
     input_csv: Union[str, Path, pd.DataFrame],
     foldseek_database_path: Union[str, Path],
     max_workers: int,
-    cpu_threshold: float 
+    cpu_threshold: float,
+    batch_search: bool = True,
+    tmp_dir: Union[str, Path] = "../tmp/batched_search",
+    query_db: Optional[Union[str, Path]] = None,
+    foldseek_path: Optional[Union[str, Path]] = None,
 ) -> pd.DataFrame:
-    df = pd.read_csv(input_csv).copy() if isinstance(input_csv, str) or isinstance(input_csv, Path) else input_csv.copy()
+    if isinstance(input_csv, (str, Path)) and os.path.isdir(input_csv):
+        # A directory of PDB files, e.g. the successful backbones of an evaluation
+        df = pd.DataFrame({'backbone_path': sorted(glob.glob(os.path.join(input_csv, '*.pdb')))})
+    else:
+        df = pd.read_csv(input_csv).copy() if isinstance(input_csv, str) or isinstance(input_csv, Path) else input_csv.copy()
     if 'pdbTM' not in df.columns:
         df.loc[:, 'pdbTM'] = None
         
     futures = {}
-    if max_workers > 0:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    if batch_search:
+        # One Foldseek process searches every backbone, so the database is only loaded once
+        pending = df.loc[df['pdbTM'].isna(), 'backbone_path'].unique().tolist()
+        if pending:
+            pdbTM_values = batched_pdbTM(pending, foldseek_database_path,
+                                         threads=max(int(max_workers), 1), tmp_dir=tmp_dir,
+                                         query_db=query_db, foldseek_path=foldseek_path)
+            missing = df['pdbTM'].isna()
+            df.loc[missing, 'pdbTM'] = df.loc[missing, 'backbone_path'].map(pdbTM_values)
+    elif max_workers > 0:
+        # Fork would duplicate the caller, which usually has torch and the folding models loaded.
+        # Workers are started from a small forkserver process that only preloads this module instead.
+        mp_context = multiprocessing.get_context('forkserver')
+        mp_context.set_forkserver_preload(['analysis.novelty'])
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
             process_id = 0
             for backbone_path in df['backbone_path'].unique():
                 if pd.isna(df[df['backbone_path'] == backbone_path]['pdbTM'].iloc[0]):
                     while psutil.cpu_percent(interval=1) > cpu_threshold:
                         time.sleep(0.5)
-                    future = executor.submit(pdbTM, backbone_path, foldseek_database_path, process_id)
+                    future = executor.submit(pdbTM, backbone_path, foldseek_database_path, process_id,
+                                             foldseek_path=foldseek_path)
                     futures[future] = backbone_path
                     process_id += 1
                     
@@ -131,18 +274,138 @@ def calculate_novelty(
     else:
         for process_id_placeholder, backbone_path in enumerate(df['backbone_path'].unique()):
             pdbTM_value = pdbTM(backbone_path, foldseek_database_path,
-                    process_id_placeholder)
+                    process_id_placeholder, foldseek_path=foldseek_path)
             df.loc[df['backbone_path'] == backbone_path, 'pdbTM'] = pdbTM_value
             
     return df
 
+class FoldseekDatabases:
+    """
+    Foldseek databases used while evaluating one set of backbones.
+
+    The reference database searched for novelty can be copied to a tmpfs or prewarmed,
+    optionally in the background (`prefetch`) while refolding is still running.
+    Query databases built from the successful backbones are kept per path, so that
+    clustering and novelty search share them.
+
+    Args:
+        database_path (Union[str, Path]): Foldseek database searched for novelty.
+        tmpfs_dir (Optional[Union[str, Path]]): Directory (e.g. /dev/shm) the database is copied to, None searches it in place.
+        prewarm (bool): Read the database into the page cache before searching it.
+        threads (Optional[int]): Threads used to build query databases.
+        foldseek_path (Optional[Union[str, Path]]): Foldseek binary, `foldseek` from PATH if None.
+        shared_query_db (bool): Build query databases at all, otherwise Foldseek reads the PDB files directly.
+    """
+
+    def __init__(
+            self,
+            database_path: Union[str, Path],
+            tmpfs_dir: Optional[Union[str, Path]] = None,
+            prewarm: bool = False,
+            threads: Optional[int] = None,
+            foldseek_path: Optional[Union[str, Path]] = None,
+            shared_query_db: bool = True
+            ):
+        self.database_path = database_path
+        self.tmpfs_dir = tmpfs_dir
+        self.prewarm = prewarm
+        self.threads = threads
+        self.foldseek_path = foldseek_path
+        self.shared_query_db = shared_query_db
+        self._future = None
+        self._database = None
+        self._query_dbs = {}
+
+    @classmethod
+    def from_eval_conf(
+            cls,
+            eval_conf,
+            threads: Optional[int] = None,
+            foldseek_path: Optional[Union[str, Path]] = None
+            ) -> 'FoldseekDatabases':
+        """Build from the `evaluation` section of the configuration."""
+        return cls(
+            database_path=eval_conf.foldseek_database,
+            tmpfs_dir=eval_conf.get('foldseek_database_tmpfs', None),
+            prewarm=eval_conf.get('foldseek_prewarm', False),
+            threads=threads,
+            foldseek_path=foldseek_path,
+            shared_query_db=eval_conf.get('foldseek_shared_query_db', True)
+        )
+
+    @property
+    def resolved_path(self) -> str:
+        """Path novelty search runs against, i.e. the tmpfs copy if configured, without loading anything."""
+        if self.tmpfs_dir is not None:
+            return os.path.join(self.tmpfs_dir, os.path.basename(str(self.database_path)))
+        return str(self.database_path)
+
+    def _load(self) -> str:
+        if self.tmpfs_dir is not None or self.prewarm:
+            log.info(f'Loading Foldseek database {self.database_path} into memory......')
+            return prewarm_foldseek_database(self.database_path, copy_to=self.tmpfs_dir)
+        return str(self.database_path)
+
+    def prefetch(self):
+        """Copy or prewarm the database in a background thread, `database` waits for it."""
+        if self.tmpfs_dir is None and not self.prewarm:
+            return
+        pool = ThreadPoolExecutor(max_workers=1)
+        self._future = pool.submit(self._load)
+        pool.shutdown(wait=False)
+
+    def database(self) -> str:
+        """Path to search for novelty, copied or prewarmed on first use if configured."""
+        if self._future is not None:
+            return self._future.result()
+        if self._database is None:
+            self._database = self._load()
+        return self._database
+
+    def close(self):
+        """
+        Wait for (or cancel) a pending prefetch and remove the tmpfs copy of the database.
+        A failed prefetch is only logged here, as nothing searches the database anymore.
+        """
+        if self._future is not None and not self._future.cancel():
+            try:
+                self._future.result()
+            except Exception:
+                log.exception(f'Loading Foldseek database {self.database_path} into memory failed.')
+        self._future = None
+        self._database = None
+        if self.tmpfs_dir is not None:
+            for db_file in glob.glob(f'{self.resolved_path}*'):
+                if os.path.isfile(db_file):
+                    os.remove(db_file)
+
+    def query_db(self, backbone_dir: Union[str, Path], db_path: Union[str, Path]) -> Optional[str]:
+        """
+        Build (once) the query database of `backbone_dir` at `db_path`.
+        Returns None if shared query databases are disabled or Foldseek failed to build it.
+        """
+        from analysis import diversity as du
+
+        if not self.shared_query_db:
+            return None
+        db_path = str(db_path)
+        if db_path not in self._query_dbs:
+            try:
+                self._query_dbs[db_path] = du.foldseek_createdb(
+                    backbone_dir, db_path, threads=self.threads, foldseek_path=self.foldseek_path)
+            except subprocess.CalledProcessError:
+                log.warning(f'Failed to build Foldseek query database {db_path}, '
+                            'clustering and novelty search will read the PDB files directly.')
+                self._query_dbs[db_path] = None
+        return self._query_dbs[db_path]
+
 def create_parser():
     parser = argparse.ArgumentParser(description='Calculating pdb-TM(novelty) for protein backbones')
     parser.add_argument(
         '-i',
         '--input',
         type=str,
-        help='Input csv file'
+        help='Input csv file or directory of PDB files'
     )
     parser.add_argument(
         '-c',
@@ -157,6 +420,20 @@ def create_parser():
         default='novelty_results.csv',
         help='Output csv file',
     )
+    parser.add_argument(
+        '-d',
+        '--database',
+        type=str,
+        required=True,
+        help='Foldseek database to search against'
+    )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of threads used by Foldseek'
+    )
     return parser
     
 if __name__ == "__main__":
@@ -167,16 +444,14 @@ if __name__ == "__main__":
         raise ValueError('Cannot read csv file and single PDB file simultaneously!')
     
     if args.input is not None:
-        # Check hardware status
-        num_cpu_cores = os.cpu_count()
-        
         results = calculate_novelty(
             input_csv=args.input,
-            max_workers=num_cpu_cores,
+            foldseek_database_path=args.database,
+            max_workers=args.threads,
             cpu_threshold=75.0
         )
         results.to_csv(args.output, index=False)
     
     if args.calculate is not None:
-        value = pdbTM(args.calculate)
+        value = pdbTM(args.calculate, args.database, process_id=0)
         print(f'TM-Score between {os.path.basename(args.calculate)} and its closest protein in PDB is {value}.')
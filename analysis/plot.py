@@ -1,21 +1,50 @@
 import os
+import re
 import json
+import gc
 import logging
+import functools
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pac
 
-from typing import List, Union, Optional, Literal
+from typing import List, Tuple, Union, Optional, Literal
 from pathlib import Path
 from scipy.stats import gaussian_kde
+from scipy.ndimage import gaussian_filter1d
 from pymol import cmd
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 log = logging.getLogger(__name__)
 
-plt.rcParams['font.sans-serif'] = 'Arial'
-plt.rcParams['font.family'] = 'Arial'
-mpl.rcParams['lines.linewidth'] = 1
+# Motif segment of a contig, e.g. "B25-46" or "A32"
+_CONTIG_RE = re.compile(r"([A-Za-z])(\d+)(?:-(\d+))?")
+
+# From this number of samples on, the KDE curve of a marginal is indistinguishable from
+# its 50-bin histogram, so the (lightly smoothed) histogram density is drawn instead.
+_KDE_MAX_SAMPLES = 50_000
+
+
+@functools.lru_cache(maxsize=8)
+def _load_motif_info(path: str, mtime: float) -> dict:
+    """ Parse the motif info json, cached on (path, mtime) so an updated file is re-read. """
+    if orjson is not None:
+        return orjson.loads(Path(path).read_bytes())
+    with open(path, "r") as f:
+        return json.load(f)
+
 
 def motif_scaffolding_pymol_write(
     unique_designable_backbones: Union[str, Path],
@@ -33,56 +62,56 @@ def motif_scaffolding_pymol_write(
     Authored by: Bo Zhang
     """
 
-    unique_designable_backbones_pdb = [i.replace(".pdb","") for i in os.listdir(unique_designable_backbones) if i.endswith('.pdb')]
-    with open(motif_json,"r") as f:
-        info = json.load(f)
-    design_name_motif = {}
-    for i in unique_designable_backbones_pdb:
-        design_name_motif[i] = info[i]["motif_idx"]
-    # re-initialize the pymol
-    cmd.reinitialize()
-    cmd.load(reference_pdb, "native_pdb")
+    with os.scandir(unique_designable_backbones) as it:
+        pdb_entries = [e for e in it if e.name.endswith('.pdb')]
+    unique_designable_backbones_pdb = [e.name[:-4] for e in pdb_entries]
+    motif_json = os.path.abspath(motif_json)
+    info = _load_motif_info(motif_json, os.path.getmtime(motif_json))
+    design_name_motif = {name: tuple(info[name]["motif_idx"]) for name in unique_designable_backbones_pdb}
     contig = list(info.values())[0]["contig"]
     # "contig": "31-31/B25-46/32-32/A32/A4/A5"
-    contig_list = [i for i in contig.split("/") if not i[0].isdigit()]
-    config_folder = []
-    for i in contig_list:
-        chain = i[0]
-        i = i[1:]
-        if "-" in i:
-            element = i.split("-")
-            start = element[0]
-            end = element[1]
-            select = f"resi {start}-{end} and chain {chain}"
-            config_folder.append(select)
-        else:
-            select = f"resi {i[1:]} and chain {chain}"
-            config_folder.append(select)
+    # Scaffold segments start with a digit and never match the pattern
+    config_folder = [
+        f"resi {m.group(2)}-{m.group(3)} and chain {m.group(1)}" if m.group(3)
+        else f"resi {m.group(2)} and chain {m.group(1)}"
+        for m in map(_CONTIG_RE.fullmatch, contig.split("/")) if m
+    ]
     # merge all the contig into one
     config_extract = " or ".join(config_folder)
     print(f"loading native motif {config_extract}")
 
-    cmd.extract("native_motif",config_extract)
-    # delete native_pdb 
+    # re-initialize the pymol
+    cmd.reinitialize()
+    # Skip building the geometry of every loaded object, nothing is rendered before the session is saved
+    defer_builds_mode = cmd.get('defer_builds_mode')
+    cmd.set('defer_builds_mode', 3)
+    cmd.load(reference_pdb, "native_pdb")
+    cmd.extract("native_motif", config_extract)
+    # delete native_pdb
     cmd.delete("native_pdb")
     # color the native motif of PDB
-    cmd.color(native_motif_color,"native_motif")
-    cmd.show("sticks","native_motif")
-
-    if os.listdir(unique_designable_backbones):
-        for i in os.listdir(unique_designable_backbones):
-            print(i)
-            if i.endswith(".pdb"):
-                name = i.split(".")[0]
-                cmd.load(f"{unique_designable_backbones}/{i}",name)
-                cmd.color(design_scaffold_color,name)
-                motif_residue = design_name_motif[name]
-                cmd.select(f"{name}_motif","resi "+"+".join([str(i) for i in motif_residue])+" and "+name)
-                cmd.color(design_motif_color,f"{name}_motif")
-                cmd.show("sticks",f"{name}_motif")
-                # align the motif
-                cmd.align(f"{name}","native_motif")
+    cmd.color(native_motif_color, "native_motif")
+    cmd.show("sticks", "native_motif")
+
+    # Designs of the same case mostly share the motif indices, so build each selection only once
+    motif_cache = {}
+    for e in pdb_entries:
+        name = e.name[:-4]
+        key = design_name_motif[name]
+        sel = motif_cache.get(key)
+        if sel is None:
+            sel = motif_cache[key] = "+".join(map(str, key))
+        cmd.load(e.path, name)
+        cmd.color(design_scaffold_color, name)
+        cmd.select(f"{name}_motif", f"resi {sel} and {name}")
+        cmd.color(design_motif_color, f"{name}_motif")
+        cmd.show("sticks", f"{name}_motif")
+        # align the motif
+        cmd.align(name, "native_motif")
+    cmd.set('defer_builds_mode', defer_builds_mode)
 
+    if pdb_entries:
+        log.info(f"Loaded {len(pdb_entries)} designable backbones from {unique_designable_backbones}")
         cmd.bg_color('white')
         cmd.set("grid_mode",1)
         cmd.set('ray_trace_mode', 1)
@@ -107,16 +136,196 @@ def truncate_colormap(
     return new_cmap
 
 
+# Colormap and colors of plot_metrics_distribution, built once at import
+_PUBU_TRUNC = truncate_colormap(plt.get_cmap('PuBu'), min_val=0.1, max_val=1.0)
+_MOTIF_RMSD_COLOR = '#0888B5'
+_RMSD_COLOR = '#EE8400'
+
+
+def _fast_kde_1d(
+    x: np.ndarray,
+    n_grid: int = 256
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gaussian KDE by binning onto a regular grid and smoothing the histogram,
+    which costs O(N + G) instead of the O(N * G) of `scipy.stats.gaussian_kde`.
+    The bandwidth follows Silverman's rule of thumb.
+
+    Returns:
+        grid (np.ndarray): Bin centers of the evaluation grid.
+        density (np.ndarray): Estimated density on `grid`.
+    """
+    x = np.asarray(x)
+    n = x.size
+    bw = 1.06 * x.std() * n ** -0.2
+    if bw <= 0: # All values are identical
+        bw = 1e-3
+    # Pad the grid by 3 bandwidths so the tails are not truncated by the filter
+    lo, hi = x.min() - 3 * bw, x.max() + 3 * bw
+    counts, edges = np.histogram(x, bins=n_grid, range=(lo, hi))
+    # Keep float32 inputs in float32 through the convolution
+    dtype = x.dtype if x.dtype == np.float32 else np.float64
+    return _smooth_counts(counts.astype(dtype), edges, bw)
+
+
+def _binned_kde_1d(
+    counts: np.ndarray,
+    edges: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gaussian KDE from already binned counts, e.g. a marginal of the 2D histogram
+    of the main plot, so no extra pass over the raw data is needed.
+    The Silverman bandwidth is estimated from the binned mean and variance.
+
+    Returns:
+        grid (np.ndarray): Bin centers.
+        density (np.ndarray): Estimated density on `grid`.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum()
+    centers = (edges[:-1] + edges[1:]) / 2
+    mean = (counts * centers).sum() / n
+    std = np.sqrt((counts * (centers - mean) ** 2).sum() / n)
+    bw = 1.06 * std * n ** -0.2
+    if bw <= 0: # All values fall into a single bin
+        bw = edges[1] - edges[0]
+    return _smooth_counts(counts, edges, bw)
+
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True)
+    def _gauss_smooth(h, sigma):
+        """ 1D Gaussian filter with zero padding, equivalent to `gaussian_filter1d(h, sigma, mode='constant')`. """
+        n = h.size
+        radius = int(4.0 * sigma + 0.5)
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel /= kernel.sum()
+        out = np.zeros(n, dtype=h.dtype)
+        for i in range(n):
+            acc = 0.0
+            for k in range(max(-radius, -i), min(radius, n - 1 - i) + 1):
+                acc += h[i + k] * kernel[k + radius]
+            out[i] = acc
+        return out
+else:
+    def _gauss_smooth(h, sigma):
+        return gaussian_filter1d(h, sigma=sigma, mode='constant')
+
+
+def _smooth_counts(
+    counts: np.ndarray,
+    edges: np.ndarray,
+    bw: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """ Smooth histogram counts with a Gaussian of width `bw` and normalize to a density. """
+    dx = edges[1] - edges[0]
+    density = _gauss_smooth(counts, float(bw / dx))
+    density /= counts.sum() * dx
+    grid = (edges[:-1] + edges[1:]) / 2
+    return grid, density
+
+
+def _hexbin_counts(
+    x: np.ndarray,
+    y: np.ndarray,
+    gridsize: int = 30,
+    mincnt: int = 1
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Vectorized version of the hexagon binning done inside `Axes.hexbin`.
+    Each point is assigned to the closer center of the two offset lattices,
+    and the occupied cells are counted with `np.bincount`. Hexagons with less
+    than `mincnt` points are dropped here, so matplotlib gets no filtering to do.
+
+    Returns:
+        hex_x, hex_y (np.ndarray): Centers of the occupied hexagons.
+        counts (np.ndarray): Number of points falling into each hexagon.
+        extent (tuple): Data extent to pass to `hexbin` so that the centers
+            are re-binned into the very same hexagons.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    nx = gridsize
+    ny = int(nx / np.sqrt(3))
+    # Expand singular ranges the same way matplotlib does
+    xmin, xmax = mpl.transforms.nonsingular(x.min(), x.max(), expander=0.1)
+    ymin, ymax = mpl.transforms.nonsingular(y.min(), y.max(), expander=0.1)
+    extent = (xmin, xmax, ymin, ymax)
+    # Same padding as matplotlib so that the edge points are binned identically
+    padding = 1.e-9 * (xmax - xmin)
+    xmin, xmax = xmin - padding, xmax + padding
+    padding = 1.e-9 * (ymax - ymin)
+    ymin, ymax = ymin - padding, ymax + padding
+    sx = (xmax - xmin) / nx
+    sy = (ymax - ymin) / ny
+
+    # Lattice coordinates
+    ix = (x - xmin) / sx
+    iy = (y - ymin) / sy
+    ix1 = np.round(ix).astype(np.int64)
+    iy1 = np.round(iy).astype(np.int64)
+    ix2 = np.floor(ix).astype(np.int64)
+    iy2 = np.floor(iy).astype(np.int64)
+    # Distances (in lattice units, y scaled by sqrt(3)) to the two candidate centers
+    d1 = (ix - ix1) ** 2 + 3.0 * (iy - iy1) ** 2
+    d2 = (ix - ix2 - 0.5) ** 2 + 3.0 * (iy - iy2 - 0.5) ** 2
+    on_lattice1 = d1 < d2
+
+    # Lattice 1 has (nx + 1) x (ny + 1) cells, lattice 2 has nx x ny cells
+    n1 = (nx + 1) * (ny + 1)
+    cell = np.where(
+        on_lattice1,
+        ix1 * (ny + 1) + iy1,
+        n1 + ix2 * ny + iy2
+    )
+    counts = np.bincount(cell, minlength=n1 + nx * ny)
+    occupied = np.nonzero(counts >= max(mincnt, 1))[0]
+    counts = counts[occupied]
+
+    is_lattice1 = occupied < n1
+    cell1 = occupied[is_lattice1]
+    cell2 = occupied[~is_lattice1] - n1
+    hex_x = np.empty(occupied.size, dtype=np.float64)
+    hex_y = np.empty(occupied.size, dtype=np.float64)
+    hex_x[is_lattice1] = xmin + (cell1 // (ny + 1)) * sx
+    hex_y[is_lattice1] = ymin + (cell1 % (ny + 1)) * sy
+    hex_x[~is_lattice1] = xmin + (cell2 // ny + 0.5) * sx
+    hex_y[~is_lattice1] = ymin + (cell2 % ny + 0.5) * sy
+    return hex_x, hex_y, counts, extent
+
+
 @mpl.rc_context({'lines.linewidth': 1, 'font.family': 'Arial', 'font.sans-serif': 'Arial'})
 def plot_metrics_distribution(
     input: Union[str, Path, pd.DataFrame],
     save_path: Union[str, Path],
     save_mode: Literal['png', 'pdf', 'svg'] = 'png',
     prefix: Literal['esm', 'af2'] = 'esm',
-    dpi: Union[int, float] = 800
+    dpi: Union[int, float] = 800,
+    gridsize: int = 30,
+    rect_bins: bool = False
     ) -> None:
+    """
+    Set `rect_bins` to draw the 2D density with rectangular bins (histogram2d + pcolormesh)
+    instead of hexagons, which is much cheaper to compute on large result sets.
+    """
 
-    results = pd.read_csv(input) if isinstance(input, (str or Path)) else input
+    owned = isinstance(input, (str, Path))
+    if owned:
+        # Only parse the two columns needed for plotting
+        convert_options = pac.ConvertOptions(
+            include_columns=['motif_rmsd', 'rmsd'],
+            column_types={'motif_rmsd': pa.float32(), 'rmsd': pa.float32()}
+        )
+        results = pac.read_csv(input, convert_options=convert_options).to_pandas()
+    else:
+        results = input
+    # Single precision is plenty for plotting and halves the memory traffic below
+    results = results.astype({'motif_rmsd': np.float32, 'rmsd': np.float32}, copy=False)
+    # Work on the underlying arrays and compute the ranges only once
+    motif_rmsd = results['motif_rmsd'].to_numpy(copy=False)
+    rmsd = results['rmsd'].to_numpy(copy=False)
+    motif_rmsd_range = (motif_rmsd.min(), motif_rmsd.max())
+    rmsd_range = (rmsd.min(), rmsd.max())
     
     # Calculate sequence hit
     #results['seq_hit'] = results['seq_hit'].astype(int)
@@ -133,10 +342,19 @@ def plot_metrics_distribution(
     ax_histx = fig.add_axes([0.1, 0.76, 0.65, 0.2], sharex=ax_main)
     ax_histy = fig.add_axes([0.8, 0.25, 0.25, 0.65], sharey=ax_main)
     
-    truncated_cmap = truncate_colormap(plt.get_cmap('PuBu'), min_val=0.1, max_val=1.0)
+    truncated_cmap = _PUBU_TRUNC
 
-    # Main hexbin plot (motif_rmsd on x-axis, rmsd on y-axis)
-    hb = ax_main.hexbin(results['motif_rmsd'], results['rmsd'], gridsize=30, cmap=truncated_cmap, mincnt=1)
+    # Main 2D density plot (motif_rmsd on x-axis, rmsd on y-axis)
+    if rect_bins:
+        H, xedges, yedges = np.histogram2d(motif_rmsd, rmsd, bins=gridsize, range=[motif_rmsd_range, rmsd_range])
+        hb = ax_main.pcolormesh(xedges, yedges, np.ma.masked_less(H, 1).T, cmap=truncated_cmap, shading='auto', rasterized=True, zorder=-1)
+    else:
+        # Bin the points beforehand and only hand the occupied hexagons to matplotlib,
+        # whose own binning loops over every point in Python.
+        hex_x, hex_y, hex_counts, hex_extent = _hexbin_counts(motif_rmsd, rmsd, gridsize=gridsize, mincnt=1)
+        hb = ax_main.hexbin(hex_x, hex_y, C=hex_counts, reduce_C_function=np.sum, gridsize=gridsize, extent=hex_extent, cmap=truncated_cmap, rasterized=True, zorder=-1)
+    # Only the density layer is rasterized in vector outputs, axes and curves stay vectors
+    ax_main.set_rasterization_zorder(0)
     ax_main.set_xlabel('Motif-RMSD (Å)', fontweight='bold', fontsize=12)
     ax_main.set_ylabel('Backbone-RMSD (Å)', fontweight='bold', fontsize=12)
     
@@ -145,31 +363,49 @@ def plot_metrics_distribution(
     cb.set_label('Counts', fontweight='bold')
 
     # Marginal histogram on the top for motif_rmsd
-    ax_histx.hist(results['motif_rmsd'], bins=50, color='#0888B5', alpha=0.6, density=True, edgecolor='black')
+    motif_hist, motif_bins, _ = ax_histx.hist(motif_rmsd, bins=50, range=motif_rmsd_range, color=_MOTIF_RMSD_COLOR, alpha=0.6, density=True, edgecolor='black')
     ax_histx.axis('off')  # Hide ticks and labels
     
     # Marginal histogram on the right for rmsd
-    ax_histy.hist(results['rmsd'], bins=50, color='#EE8400', alpha=0.6, density=True, orientation='horizontal', edgecolor='black')
+    rmsd_hist, rmsd_bins, _ = ax_histy.hist(rmsd, bins=50, range=rmsd_range, color=_RMSD_COLOR, alpha=0.6, density=True, orientation='horizontal', edgecolor='black')
     ax_histy.axis('off')  # Hide ticks and labels
 
     # Add KDE curves to the histograms
-    motif_rmsd_kde = gaussian_kde(results['motif_rmsd'])
-    rmsd_kde = gaussian_kde(results['rmsd'])
+    if len(motif_rmsd) >= _KDE_MAX_SAMPLES:
+        x_motif = (motif_bins[:-1] + motif_bins[1:]) / 2
+        x_rmsd = (rmsd_bins[:-1] + rmsd_bins[1:]) / 2
+        motif_density = np.convolve(motif_hist, np.ones(3) / 3, mode='same')
+        rmsd_density = np.convolve(rmsd_hist, np.ones(3) / 3, mode='same')
+    elif rect_bins:
+        # The marginals fall out of the 2D histogram of the main plot
+        x_motif, motif_density = _binned_kde_1d(H.sum(axis=1), xedges)
+        x_rmsd, rmsd_density = _binned_kde_1d(H.sum(axis=0), yedges)
+    else:
+        motif_grid, motif_density = _fast_kde_1d(motif_rmsd)
+        rmsd_grid, rmsd_density = _fast_kde_1d(rmsd)
 
-    x_motif = np.linspace(results['motif_rmsd'].min(), results['motif_rmsd'].max(), 100)
-    x_rmsd = np.linspace(results['rmsd'].min(), results['rmsd'].max(), 100)
+        x_motif = np.linspace(*motif_rmsd_range, 100)
+        x_rmsd = np.linspace(*rmsd_range, 100)
+        motif_density = np.interp(x_motif, motif_grid, motif_density)
+        rmsd_density = np.interp(x_rmsd, rmsd_grid, rmsd_density)
     
-    ax_histx.fill_between(x_motif, motif_rmsd_kde(x_motif), color='#0888B5', lw=1.5, alpha=0.4)
-    ax_histy.fill_between(rmsd_kde(x_rmsd), x_rmsd, color='#EE8400', lw=1.5, alpha=0.4)
+    ax_histx.fill_between(x_motif, motif_density, color=_MOTIF_RMSD_COLOR, lw=1.5, alpha=0.4)
+    ax_histy.fill_between(rmsd_density, x_rmsd, color=_RMSD_COLOR, lw=1.5, alpha=0.4)
     
     ax_main.spines['top'].set_visible(False)
     ax_main.spines['right'].set_visible(False)
     
-    ax_main.axhline(2.0, color='#EE8400', linestyle="--", linewidth=2)
-    ax_main.axvline(1.0, color='#0888B5', linestyle="--", linewidth=2)
+    ax_main.axhline(2.0, color=_RMSD_COLOR, linestyle="--", linewidth=2)
+    ax_main.axvline(1.0, color=_MOTIF_RMSD_COLOR, linestyle="--", linewidth=2)
+
+    # Release the loaded metrics before the large raster buffer of savefig is allocated.
+    # A DataFrame passed in by the caller stays alive anyway.
+    del results, motif_rmsd, rmsd
+    if owned:
+        gc.collect()
 
     #plt.show()
-    plt.savefig(os.path.join(save_path, f'{prefix}_metric_distribution.{save_mode}'), dpi=dpi)
+    fig.savefig(os.path.join(save_path, f'{prefix}_metric_distribution.{save_mode}'), dpi=dpi)
     
     #return mean_seq_hit
 
@@ -185,15 +421,18 @@ def plot_novelty_distribution(
     if not os.path.exists(input):
         log.warning(f"Input file {input} does not exist. This will not affect the successful counts")
         return None
-    results = pd.read_csv(input) if isinstance(input, (str or Path)) else input
+    results = pd.read_csv(input) if isinstance(input, (str, Path)) else input
+    # Extract the column once, the range is reused by the KDE and the ticks
+    pdbTM_values = results['pdbTM'].to_numpy(dtype=np.float64, na_value=np.nan)
+    pdbTM_min, pdbTM_max = np.nanmin(pdbTM_values), np.nanmax(pdbTM_values)
 
     fig, ax_main = plt.subplots(figsize=(10, 6))
     
     ax_main.set_xlabel('Novelty (pdbTM) Among Successful Scaffolds', fontweight='bold', fontsize=16, labelpad=15)
-    ax_main.hist(results['pdbTM'], color='#95C991', alpha=0.6, density=True, edgecolor='black')
+    ax_main.hist(pdbTM_values, color='#95C991', alpha=0.6, density=True, edgecolor='black')
     try:
-        novelty_kde = gaussian_kde(results['pdbTM'])
-        x_novelty = np.linspace(results['pdbTM'].min(), results['pdbTM'].max(), 100)
+        novelty_kde = gaussian_kde(pdbTM_values)
+        x_novelty = np.linspace(pdbTM_min, pdbTM_max, 100)
         ax_main.fill_between(x_novelty, novelty_kde(x_novelty), color='#95C991', lw=1.5, alpha=0.3)
     except:
         log.warning("Failed to plot KDE curve for novelty distribution. Not a critical issue.")
@@ -202,7 +441,7 @@ def plot_novelty_distribution(
     ax_main.get_yaxis().set_visible(False)
     ax_main.set_yticks([])
     
-    novelty = results['pdbTM'].unique()
+    novelty = np.unique(pdbTM_values)
     quartile_to_calculate = [0.25, 0.5, 0.75]
     quartile_results = {}
     for val in quartile_to_calculate:
@@ -210,7 +449,7 @@ def plot_novelty_distribution(
     
     for _, vals in quartile_results.items():
         ax_main.axvline(vals, color='#BC94C2', linestyle="--", linewidth=2)
-    xticks_positions = sorted([results['pdbTM'].min(), results['pdbTM'].max()] + list(quartile_results.values()))
+    xticks_positions = sorted([pdbTM_min, pdbTM_max] + list(quartile_results.values()))
     ax_main.set_xticks(xticks_positions)
     ax_main.set_xticklabels([f"{tick:.3f}" for tick in xticks_positions],
                              fontsize=12, fontweight="bold")
@@ -4,9 +4,12 @@ import subprocess
 import typing as T
 import random
 import shutil
+import time
 import json
+import hashlib
 import logging
 import glob
+import functools
 import pandas as pd
 from typing import Optional, Union, List, Tuple, Dict
 from pathlib import Path
@@ -32,6 +35,19 @@ from pymol import cmd
 
 log = logging.getLogger(__name__)
 
+
+@functools.lru_cache(maxsize=256)
+def _load_structure_cached(structure_path: str, mtime_ns: int, size: int) -> struc.AtomArray:
+    """Parse a PDB once per (path, mtime, size); callers only slice the returned AtomArray."""
+    return strucio.load_structure(structure_path, model=1)
+
+
+def load_structure_cached(structure_path: Union[str, Path]) -> struc.AtomArray:
+    """Load the first model of a structure through an LRU cache, so that a native PDB
+    shared by many backbones is only parsed once. Rewritten files are parsed again."""
+    stat = os.stat(structure_path)
+    return _load_structure_cached(os.fspath(structure_path), stat.st_mtime_ns, stat.st_size)
+
 def reference_motif_extract(
     structure_path: Union[str, struc.AtomArray],
     atom_part: Optional[str] = "all-atom",
@@ -99,7 +115,7 @@ def motif_extract(
 
     position = position.split(split_char)
     if isinstance(structure_path, str):
-        array = strucio.load_structure(structure_path, model=1)
+        array = load_structure_cached(structure_path)
     else:
         array = structure_path
 
@@ -685,6 +701,23 @@ def write_contig_into_header(
         f.writelines(file_lines)
 
 
+# Numeric columns of the per-backbone `{prefix}_eval_results.csv` files.
+# Single precision is plenty for these metrics and halves the memory of the merged results.
+EVAL_RESULTS_DTYPES = {
+    'rmsd': 'float32',
+    'motif_rmsd': 'float32',
+    'refold_motif_rmsd': 'float32',
+    'backbone_motif_rmsd': 'float32',
+    'tm_score': 'float32',
+    'plddt': 'float32',
+    'ptm': 'float32',
+    'pae': 'float32',
+    'mpnn_score': 'float32',
+    'length': 'int32',
+    'sample_idx': 'int32',
+}
+
+
 def csv_merge(
     root_dir: Union[str, Path],
     prefix: str = "esm",
@@ -706,7 +739,8 @@ def csv_merge(
     if prefix not in ['esm', 'af2', 'joint']:
         raise ValueError("Prefix must be 'esm', 'af2' or 'joint'!")
 
-    merged_data = pd.DataFrame()
+    # Collect the per-backbone frames and concatenate them once at the end
+    frames = []
     log.info(f'Merging evaluation results from {root_dir}......')
     file_count = 0
     for root, dirs, files in os.walk(root_dir, followlinks=True):
@@ -714,7 +748,7 @@ def csv_merge(
             if file == f'{prefix}_eval_results.csv':
                 file_count += 1
                 csv_path = os.path.join(root, file)
-                df = pd.read_csv(csv_path)
+                df = pd.read_csv(csv_path, dtype=EVAL_RESULTS_DTYPES, engine='c')
 
                 parent_dir = os.path.abspath(os.path.join(root, os.pardir))
                 #print(parent_dir)
@@ -733,8 +767,9 @@ def csv_merge(
                 elif prefix == 'af2':
                     df['folding_method'] = 'AlphaFold2'
 
-                merged_data = pd.concat([merged_data, df], ignore_index=True)
+                frames.append(df)
 
+    merged_data = pd.concat(frames, ignore_index=True, copy=False) if frames else pd.DataFrame()
     log.info(f'Collected evaluation results from {file_count} protein backbones.')
 
     return merged_data, file_count
@@ -761,41 +796,49 @@ def analyze_success_rate(
     ):
 
     # Define success criteria for each sample
-    merged_data = pd.read_csv(merged_data) if isinstance(merged_data, str) or isinstance(merged_data, Path) else merged_data
+    merged_data = pd.read_csv(merged_data, dtype=EVAL_RESULTS_DTYPES, engine='c') if isinstance(merged_data, str) or isinstance(merged_data, Path) else merged_data
 
     #merged_data['backbone_success'] = (merged_data['rmsd'] < 2)
     #merged_data['motif_success'] = (merged_data['motif_rmsd'] < 1)
 
 
-    merged_data['seq_hit'] = (merged_data['rmsd'] < 2) & (merged_data['motif_rmsd'] < 1)
-    merged_data['seq_backbone_hit'] = (merged_data['rmsd'] < 2)
-    merged_data['seq_motif_hit'] = (merged_data['motif_rmsd'] < 1)
+    rmsd = merged_data['rmsd'].to_numpy(dtype=np.float32, na_value=np.nan)
+    motif_rmsd = merged_data['motif_rmsd'].to_numpy(dtype=np.float32, na_value=np.nan)
+    seq_backbone_hit = rmsd < 2
+    seq_motif_hit = motif_rmsd < 1
+    seq_hit = seq_backbone_hit & seq_motif_hit
+    merged_data['seq_hit'] = seq_hit
+    merged_data['seq_backbone_hit'] = seq_backbone_hit
+    merged_data['seq_motif_hit'] = seq_motif_hit
 
     #merged_data['all_success'] = merged_data['motif_success'] & merged_data['backbone_success']
-    # Group by 'backbone_path' and aggregate the success criteria
-    group_success = merged_data.groupby('backbone_path').agg({
-        'seq_hit': 'any',
-        'seq_backbone_hit': 'any',
-        'seq_motif_hit': 'any'
-    }).rename(columns={
-        'seq_hit': 'Success',
-        'seq_backbone_hit': 'backbone_success',
-        'seq_motif_hit': 'motif_success'
-    })
-
-    # Join the aggregated results back to the original DataFrame
-    merged_data = merged_data.merge(group_success, on='backbone_path', how='left')
-
+    # Aggregate the success criteria per 'backbone_path' (any hit among its sequences)
+    # and broadcast them back to every row, using integer codes instead of groupby + merge
+    codes, _ = pd.factorize(merged_data['backbone_path'])
+    has_backbone = codes >= 0
+    num_backbones = codes.max() + 1 if len(codes) else 0
+
+    def _any_per_backbone(hit: np.ndarray) -> np.ndarray:
+        hit_counts = np.bincount(codes[has_backbone], weights=hit[has_backbone], minlength=num_backbones)
+        backbone_hit = np.zeros(len(codes), dtype=bool)
+        backbone_hit[has_backbone] = hit_counts[codes[has_backbone]] > 0
+        return backbone_hit
+
+    merged_data['Success'] = _any_per_backbone(seq_hit)
+    merged_data['backbone_success'] = _any_per_backbone(seq_backbone_hit)
+    merged_data['motif_success'] = _any_per_backbone(seq_motif_hit)
+
+    successful_data = merged_data[merged_data['Success'].to_numpy()]
     successful_backbones = set()
     if group_mode == 'all':
-        success_count = merged_data[merged_data['Success'] == True]['backbone_path'].nunique()
-        successful_backbones = set(merged_data[merged_data['Success'] == True]['backbone_path'])
+        success_count = successful_data['backbone_path'].nunique()
+        successful_backbones = set(successful_data['backbone_path'])
     elif group_mode == 'PDB id':
         success_count = dict.fromkeys(merged_data['PDB id'].unique(), 0)
-        success_per_pdb = merged_data[merged_data['Success'] == True].groupby('PDB id')['backbone_path'].nunique()
+        success_per_pdb = successful_data.groupby('PDB id')['backbone_path'].nunique()
         success_count.update(success_per_pdb.to_dict())
 
-        successful_backbones = set(merged_data[merged_data['Success'] == True]['backbone_path'])
+        successful_backbones = set(successful_data['backbone_path'])
 
     #print(f'merged_data.columns: {set(merged_data.columns)}')
 
@@ -919,14 +962,16 @@ def write_summary_results(
     prefix: Optional[str] = None
 ) -> None:
 
-    designable_fraction = f'{(designable_count / (pdb_count + 1e-6) * 100):.2f}'
+    designable_fraction = f'{(100.0 * designable_count / pdb_count):.2f}' if pdb_count else '0.00'
     number_of_solutions = f'{diversity_result["Clusters"]}'
-    novelty_value = round(novelty_value, 3)
-    novelty_value = f'{novelty_value:.3f}' if isinstance(novelty_value, (int or float)) else novelty_value
+    # 'null' is passed through when no backbone was designable
+    novelty_value = novelty_value if isinstance(novelty_value, str) else f'{novelty_value:.3f}'
+    abs_path = os.path.abspath(stored_path)
+    protein_name = os.path.basename(os.path.normpath(stored_path))
 
     # Formatting
     summary_table = [
-        ["Evaluated Protein", os.path.basename(os.path.normpath(stored_path))],
+        ["Evaluated Protein", protein_name],
         ["Number of Unique Solutions (Unique designable scaffolds)", number_of_solutions],
         ["Novelty (Weighted across each cluster)", novelty_value],
         ["Success Rate", f"{designable_fraction}%"],
@@ -934,14 +979,16 @@ def write_summary_results(
     ]
     formatted_table = tabulate(summary_table, tablefmt="grid", numalign="center")
 
-    with open (os.path.join(stored_path, f'{prefix}_summary.txt'), 'w') as f:
-        f.write('----------Summary----------\n\n')
-        f.write(f'The following are evaluation results for {os.path.abspath(stored_path)}:\n\n')
-        f.write(formatted_table + "\n")
-        #f.write(f'Evaluated protein: {os.path.basename(os.path.normpath(stored_path))}\n')
-        #f.write(f'Number of unique solutions (Unique designable scaffolds): {number_of_solutions}\n')
-        #f.write(f'Novelty (Weighted across each cluster): {novelty_value}\n')
-        #f.write(f'Success rate: {designable_fraction}%\n')
+    # Written to a temporary file and renamed, so readers never see a partial summary
+    summary_path = os.path.join(stored_path, f'{prefix}_summary.txt')
+    tmp_path = f'{summary_path}.tmp'
+    with open (tmp_path, 'w') as f:
+        f.write(
+            '----------Summary----------\n\n'
+            f'The following are evaluation results for {abs_path}:\n\n'
+            f'{formatted_table}\n'
+        )
+    os.replace(tmp_path, summary_path)
 
 
 def parse_contig(contig: str) -> List[Tuple[str, int, int]]:
@@ -1230,3 +1277,115 @@ def check_motif_AA_type(
     else:
         log.info(f"Residue types in designed backbone are consistent to standard motifs, continue.")
         return True
+
+
+def get_most_free_gpu() -> int:
+    """Return the CUDA device with the most free memory.
+
+    Memory is queried through CUDA rather than NVML, as NVML indices ignore CUDA_VISIBLE_DEVICES
+    and the CUDA device order. This initializes CUDA on every visible device.
+
+    Returns:
+        gpu_id (int): CUDA device index to be used as f"cuda:{gpu_id}".
+    """
+    import torch
+
+    free_memory = [(i, torch.cuda.mem_get_info(i)[0]) for i in range(torch.cuda.device_count())]
+    return max(free_memory, key=lambda x: x[1])[0]
+
+def run_with_retries(
+    args: List[str],
+    name: str,
+    env: Optional[Dict[str, str]] = None,
+    max_tries: int = 5,
+    timeout: Optional[float] = None
+):
+    """Run a subprocess until it exits with code 0, retrying with exponential backoff (capped at 60 s).
+
+    Args:
+        args (List[str]): Command to be executed.
+        name (str): Name of the tool, used in log and error messages.
+        env (Optional[Dict[str, str]]): Environment of the subprocess, defaults to the current one.
+        max_tries (int): Attempts before giving up with a RuntimeError.
+        timeout (Optional[float]): Seconds after which a hung attempt is killed and retried, None waits indefinitely.
+    """
+    for num_tries in range(1, max_tries + 1):
+        try:
+            ret = subprocess.run(
+                args,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.STDOUT,
+                timeout=timeout,
+                check=False
+            ).returncode
+        except subprocess.TimeoutExpired:
+            log.info(f'{name} timed out after {timeout} s. Attempt {num_tries}/{max_tries}')
+        else:
+            if ret == 0:
+                return
+            log.info(f'Failed {name} (exit code {ret}). Attempt {num_tries}/{max_tries}')
+        if num_tries < max_tries:
+            time.sleep(min(2 ** num_tries, 60))
+    raise RuntimeError(f'{name} failed after {max_tries} attempts: {" ".join(map(str, args))}')
+
+def link_or_copy(src: Union[str, Path], dst: Union[str, Path]):
+    """Hardlink `src` to `dst`, falling back to a copy (e.g. across filesystems or if `dst` exists).
+
+    Args:
+        src (Union[str, Path]): File to be linked.
+        dst (Union[str, Path]): Destination file path.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Already staged by an earlier run
+        if not os.path.samefile(src, dst):
+            shutil.copy2(src, dst)
+    except OSError:
+        # copy2 keeps the modification time, so `pdb_dir_signature` stays stable across reruns
+        shutil.copy2(src, dst)
+
+
+def stage_files(paths: List[Union[str, Path]], dst_dir: Union[str, Path]):
+    """Hardlink (or copy) every file in `paths` into `dst_dir`, keeping their basenames."""
+    paths = list(paths)
+    dst_dir = os.fspath(dst_dir)
+    dsts = [os.path.join(dst_dir, os.path.basename(path)) for path in paths]
+    list(map(link_or_copy, paths, dsts))
+
+
+def dir_has_entries(path: Union[str, Path]) -> bool:
+    """Check whether a directory is non-empty without listing all of its entries."""
+    with os.scandir(path) as entries:
+        return next(entries, None) is not None
+
+
+def pdb_dir_signature(path: Union[str, Path]) -> str:
+    """
+    Fingerprint the set of PDB files in a directory from their names, sizes and modification times.
+    Used to tell whether cached Foldseek results still match the backbones they were computed on.
+    """
+    with os.scandir(path) as entries:
+        stats = sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in entries
+            if entry.is_file() and entry.name.endswith('.pdb') and entry.name != 'assist_protein.pdb'
+        )
+    digest = hashlib.blake2b(digest_size=16)
+    for name, size, mtime in stats:
+        digest.update(f'{name}\t{size}\t{mtime}\n'.encode())
+    return digest.hexdigest()
+
+
+def signature_matches(signature_path: Union[str, Path], signature: str) -> bool:
+    """Check whether the signature stored at `signature_path` (if any) equals `signature`."""
+    if not os.path.exists(signature_path):
+        return False
+    with open(signature_path, 'r') as f:
+        return f.read().strip() == signature
+
+
+def write_signature(signature_path: Union[str, Path], signature: str):
+    with open(signature_path, 'w') as f:
+        f.write(signature)
@@ -20,7 +20,6 @@ import os
 from typing import List, Mapping, Tuple
 
 import numpy as np
-import tree
 
 # Internal import (35fd).
 
@@ -736,8 +735,9 @@ chi_atom_2_one_hot = chi_angle_atom(2)
 
 # An array like chi_angles_atoms but using indices rather than names.
 chi_angles_atom_indices = [chi_angles_atoms[restype_1to3[r]] for r in restypes]
-chi_angles_atom_indices = tree.map_structure(
-    lambda atom_name: atom_order[atom_name], chi_angles_atom_indices)
+chi_angles_atom_indices = [
+    [[atom_order[atom_name] for atom_name in chi_group] for chi_group in chi_atoms]
+    for chi_atoms in chi_angles_atom_indices]
 chi_angles_atom_indices = np.array([
     chi_atoms + ([[0, 0, 0, 0]] * (4 - len(chi_atoms)))
     for chi_atoms in chi_angles_atom_indices])
@@ -13,6 +13,7 @@ from torch.utils import data
 
 from Bio import PDB
 from Bio.PDB.Chain import Chain
+import biotite.structure.io as strucio
 from tmtools import tm_align
 
 from data import residue_constants
@@ -84,6 +85,16 @@ def parse_pdb_feats(
         raise ValueError(f'Unrecognized chain list {chain_id}')
 
 
+def parse_folded_pdb(pdb_path: str):
+    """
+    Load a predicted structure once and return both the Biotite AtomArray
+    (for motif extraction) and its (L, 3) CA coordinates (for scTM/RMSD).
+    """
+    atoms = strucio.load_structure(pdb_path, model=1)
+    ca_atoms = atoms[(atoms.atom_name == 'CA') & (atoms.hetero == False)]
+    return atoms, ca_atoms.coord.astype(np.float64)
+
+
 def parse_chain_feats(chain_feats, scale_factor=1.):
     ca_idx = residue_constants.atom_order['CA'] # 1
     chain_feats['bb_mask'] = chain_feats['atom_mask'][:, ca_idx] 
@@ -163,6 +174,28 @@ def calc_aligned_rmsd(pos_1, pos_2):
     return np.mean(np.linalg.norm(aligned_pos_1 - pos_2, axis=-1))
 
 
+def batched_aligned_rmsd(ref, preds):
+    """
+    Batched version of calc_aligned_rmsd: superimpose ref (L, 3) onto each
+    of preds (B, L, 3) with one batched SVD and return the (B,) aligned RMSDs.
+    """
+    ref = np.asarray(ref, dtype=np.float64)
+    preds = np.asarray(preds, dtype=np.float64)
+    ref_c = ref - ref.mean(axis=0)
+    preds_centroid = preds.mean(axis=1, keepdims=True)
+    preds_c = preds - preds_centroid
+
+    H = np.einsum('li,blj->bij', ref_c, preds_c)
+    U, S, Vt = np.linalg.svd(H)
+    # Correct for reflections so that every R is a proper rotation
+    d = np.where(np.linalg.det(np.transpose(Vt, (0, 2, 1)) @ np.transpose(U, (0, 2, 1))) < 0, -1., 1.)
+    Vt[:, 2, :] *= d[:, None]
+    R = np.transpose(Vt, (0, 2, 1)) @ np.transpose(U, (0, 2, 1))
+
+    aligned_ref = np.einsum('bij,lj->bli', R, ref_c) + preds_centroid
+    return np.mean(np.linalg.norm(aligned_ref - preds, axis=-1), axis=-1)
+
+
 def rigid_transform_3D(A, B, verbose=False):
     # Transforms A to look like B
     # https://github.com/nghiaho12/rigid_transform_3D
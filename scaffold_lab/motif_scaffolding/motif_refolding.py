@@ -11,31 +11,39 @@ To run ESMFold and AlphaFold2 simultaneously:
 """
 
 import os
-import tree
 import time
 import json
 import numpy as np
 import hydra
 import torch
 import subprocess
+import concurrent.futures
+import multiprocessing
+import dataclasses
 import re
-import random
 import logging
+import functools
+import importlib
+import hashlib
+import joblib
 import warnings
 import pandas as pd
 import sys
 import rootutils
 import shutil
-import GPUtil
 from pathlib import Path
 from typing import Optional, Dict, Union, List
 from omegaconf import DictConfig, OmegaConf
-from collections import defaultdict
+from collections import OrderedDict
 
-import esm
 import biotite.structure.io as strucio
 from biotite.sequence.io import fasta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 path = rootutils.find_root(search_from='./', indicator=[".git", "setup.cfg"])
 rootutils.set_root(
@@ -52,6 +60,388 @@ from data import structure_utils as su
 from analysis import diversity as du
 from analysis import novelty as nu
 from analysis import plot as pu
+from analysis import folding as fu
+from analysis import mpnn as mu
+
+
+# Global score in the headers of ProteinMPNN outputs
+_GLOBAL_SCORE_RE = re.compile(r'global_score=([-\d.]+)')
+
+# Sample index in the headers of ProteinMPNN outputs
+_SAMPLE_IDX_RE = re.compile(r'sample=(\d+)')
+
+# Backbone file names: "{case_num}_{backbone_name}_{sample_num}" or "{backbone_name}_{sample_num}"
+_PDB_NAME_RE = re.compile(r'^(?:([^_]+)_)?([^_]+)_(\d+)$')
+
+
+@functools.lru_cache(maxsize=128)
+def _load_native(reference_pdb: str):
+    """
+    Parse a native PDB once; its motifs are then sliced from the in-memory AtomArray.
+    """
+    return strucio.load_structure(reference_pdb, model=1)
+
+
+@functools.lru_cache(maxsize=None)
+def _reference_motif_extract(contig: str, reference_pdb: str, atom_part: str):
+    """
+    Cached `au.motif_extract` for native motifs, which are shared by all samples of a benchmark case.
+    The returned AtomArray is shared between callers and must not be modified in place.
+    """
+    return au.motif_extract(contig, _load_native(reference_pdb), atom_part=atom_part)
+
+
+@functools.lru_cache(maxsize=128)
+def _reference_contig_from_segments(reference_pdb: str, segments_order: str):
+    """
+    Cached `au.reference_contig_from_segments`, which otherwise re-parses the native PDB for every sample.
+    """
+    return au.reference_contig_from_segments(reference_pdb, segments_order)
+
+
+def _file_sha1(file_path: Union[str, Path]) -> str:
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _backbone_motif_rmsd(
+    reference_contig: str,
+    design_contig: str,
+    reference_pdb: str,
+    design_pdb: str
+) -> float:
+    """CA motif-RMSD between the native motif and the generated backbone (without refolding)."""
+    reference_motif_CA = _reference_motif_extract(reference_contig, reference_pdb, "CA")
+    design_motif_CA = au.motif_extract(design_contig, design_pdb, atom_part="CA")
+    return au.rmsd(reference_motif_CA, design_motif_CA)
+
+
+def _hashed_backbone_motif_rmsd(
+    reference_contig: str,
+    reference_sha1: str,
+    design_contig: str,
+    design_sha1: str,
+    reference_pdb: str,
+    design_pdb: str
+) -> float:
+    """
+    `_backbone_motif_rmsd` for the on-disk cache. The file hashes key the cache,
+    so the paths themselves are not part of the key.
+    """
+    return _backbone_motif_rmsd(reference_contig, design_contig, reference_pdb, design_pdb)
+
+
+def _json_bytes(obj, indent: bool = False) -> bytes:
+    """
+    Serialize to JSON with sorted keys. Compact output uses orjson when it is installed.
+    Indented output (motif_info.json) always goes through the standard library, since orjson
+    only indents by 2 spaces and the file has always been written with 4.
+    """
+    if indent:
+        return json.dumps(obj, indent=4, separators=(",", ": "), sort_keys=True).encode()
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode()
+
+
+class _ESMEmbeddingCache:
+    """
+    LRU cache of the ESM-2 representations computed inside ESMFold, keyed by the unpadded tokens of
+    each sequence, so a sequence is found again whatever batch (and padding) it lands in.
+    Only the unpadded slice is kept, in host memory, and the cache is bounded by its size in bytes
+    since each entry holds every ESM-2 layer. Only the sequences missing from the cache are recomputed.
+    """
+
+    def __init__(self, compute_fn, padding_idx: int, max_bytes: int):
+        self._compute_fn = compute_fn
+        self._padding_idx = padding_idx
+        self._max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key: bytes, representation: torch.Tensor):
+        representation = representation.clone()
+        nbytes = representation.numel() * representation.element_size()
+        if nbytes > self._max_bytes:
+            return
+        self._cache[key] = representation
+        self._nbytes += nbytes
+        while self._nbytes > self._max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._nbytes -= evicted.numel() * evicted.element_size()
+
+    def __call__(self, esmaa: torch.Tensor) -> torch.Tensor:
+        tokens = esmaa.cpu()
+        lengths = (tokens != self._padding_idx).sum(dim=1).tolist()
+        keys = [tokens[i, :length].numpy().tobytes() for i, length in enumerate(lengths)]
+        missing = [i for i, key in enumerate(keys) if key not in self._cache]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            max_length = max(lengths[i] for i in missing)
+            esm_s = self._compute_fn(esmaa[missing, :max_length])
+            if len(missing) == len(keys) and max_length == esmaa.shape[1]:
+                computed = esm_s.detach().cpu()
+                for i, key in enumerate(keys):
+                    self._store(key, computed[i, :lengths[i]])
+                return esm_s
+            computed = dict(zip(missing, esm_s.detach().cpu()))
+        else:
+            computed = {}
+
+        representations = []
+        for i, key in enumerate(keys):
+            if i in computed:
+                representation = computed[i][:lengths[i]]
+                self._store(key, representation)
+            else:
+                representation = self._cache[key]
+                self._cache.move_to_end(key)
+            representations.append(representation)
+        # Padding positions are masked out by the folding trunk
+        output = representations[0].new_zeros((len(keys), esmaa.shape[1], *representations[0].shape[1:]))
+        for i, representation in enumerate(representations):
+            output[i, :representation.shape[0]] = representation
+        return output.to(esmaa.device, non_blocking=True)
+
+
+@dataclasses.dataclass
+class _PreparedJob:
+    """
+    Inputs of `MotifRefolder.run_self_consistency` for one backbone, prepared on CPU.
+    """
+    backbone_name: str
+    sample_num: str
+    motif_info: Dict
+    refold: bool = True
+    pdb_path: Optional[str] = None
+    sc_output_dir: Optional[str] = None
+    motif_mask: Optional[np.ndarray] = None
+    fixed_indices: Optional[Union[List, str]] = None
+    backbone_motif_rmsd: Optional[float] = None
+    ref_motif: Optional[object] = None
+    sample_contig: Optional[str] = None
+
+
+_prep_log = logging.getLogger('MotifRefolder')
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_backbone_motif_rmsd(cache_dir: Optional[str]):
+    """
+    `_backbone_motif_rmsd`, cached on disk under `cache_dir` by file content if it is given.
+    Built once per process, so preparation workers set up their own `joblib.Memory`.
+    """
+    if cache_dir is None:
+        return _backbone_motif_rmsd
+    memory = joblib.Memory(location=cache_dir, verbose=0)
+    cached = memory.cache(_hashed_backbone_motif_rmsd, ignore=['reference_pdb', 'design_pdb'])
+
+    def backbone_motif_rmsd(reference_contig, design_contig, reference_pdb, design_pdb):
+        # The PDBs are only hashed when there is a cache to look them up in
+        return cached(reference_contig, _file_sha1(reference_pdb),
+                      design_contig, _file_sha1(design_pdb),
+                      reference_pdb, design_pdb)
+    return backbone_motif_rmsd
+
+
+@dataclasses.dataclass
+class _BackbonePreparer:
+    """
+    CPU-only preparation of a single backbone before refolding: name and motif parsing,
+    output directories, motif residue types and the backbone motif-RMSD.
+    Holds no model or CUDA state, so it is pickled into spawned preparation workers.
+    """
+    sample_dir: str
+    output_dir: str
+    motif_pdb: str
+    motif_csv: Optional[str]
+    benchmark_contigs: Optional[Dict]
+    whole_benchmark_set: Optional[object]
+    max_backbones: Optional[int]
+    forward_folding: List[str]
+    force_motif_AA_type: bool
+    motif_cache_dir: Optional[str]
+
+    def prepare(self, pdb_file: str) -> Optional[_PreparedJob]:
+        """Returns None if the backbone is skipped."""
+        name_match = _PDB_NAME_RE.match(os.path.splitext(pdb_file)[0])
+
+        naming_number = 1
+
+        # Backbone name handling
+        all_name = os.path.splitext(pdb_file)[0]
+        design_pdb = os.path.join(self.sample_dir, pdb_file)
+        if name_match is not None:
+            case_num, backbone_name, sample_num = name_match.groups() # "01_1BCF_1.pdb" or "1BCF_1.pdb"
+            if self.max_backbones and int(sample_num) >= self.max_backbones:
+                _prep_log.info(f"Skipping sample {sample_num} because "
+                        f"max_backbones={self.max_backbones}")
+                return None
+
+            if case_num is not None:
+                backbone_name = case_num + "_" + backbone_name
+                _prep_log.info(f"case_num: {case_num}, tested case: {backbone_name}, sample_num: {sample_num}")
+            else:
+                _prep_log.info(f"tested case :{backbone_name}, sample_num: {sample_num}")
+            reference_pdb = self.motif_pdb
+        else:
+            _prep_log.warning(f"The naming format {all_name} is not as default. \
+            Try to rename the PDB file to format.")
+            for native_pdb in self.whole_benchmark_set:
+                print(f"native_pdb: {native_pdb}")
+                if native_pdb in all_name.upper():
+                    print(f"all name upper: {all_name.upper()}")
+                    backbone_name = native_pdb
+                    break
+                else:
+                    raise ValueError(f"No benchmark case detected in {all_name}. Try to reformat.")
+            reference_pdb = self.motif_pdb
+            rename_design_pdb = os.path.join(self.output_dir, f"{backbone_name}_{naming_number}.pdb")
+            shutil.copy2(design_pdb, rename_design_pdb)
+            design_pdb = rename_design_pdb
+            naming_number += 1
+
+
+        # The following part is a test version and needed to be cleaned up.
+        if self.benchmark_contigs is not None:
+            try:
+                reference_contig = self.benchmark_contigs[backbone_name]
+
+                #motif_pdb = os.path.join(, f"{backbone_name}.pdb")
+                reference_motif = _reference_motif_extract(reference_contig, reference_pdb, "backbone")
+            except KeyError:
+                raise ValueError(f"No contig value found for the name {backbone_name} in benchmark information.")
+            except Exception as e:
+                pass
+                #raise RuntimeError(f"An error occured while processing {pdb_file}.")
+            
+
+        # Read motif information data and save into json file
+        if self.motif_csv is not None and os.path.exists(self.motif_csv):
+            csv_data = au.get_csv_data(self.motif_csv, backbone_name, sample_num)
+        else:
+            csv_data = au.parse_input_scaffold(
+                os.path.join(self.sample_dir, pdb_file))
+
+        if csv_data == None:
+            _prep_log.warning(f'Motif information is missing for {pdb_file}. Skipping...')
+            return None
+        contig, mask, motif_indices, redesign_info, segments_order = csv_data
+
+        # Directly extract contig from motif_pdb files
+        reference_contig = _reference_contig_from_segments(reference_pdb, segments_order)
+        # The contig in designed pdb files
+        design_contig = au.motif_indices_to_contig(motif_indices)
+
+        
+        # Store information for later pymol visualization
+        motif_info = {
+            "contig": reference_contig,
+            "motif_idx": motif_indices,
+            "redesign_info": redesign_info
+        }
+        
+        # Save outputs
+        backbone_dir = os.path.join(self.output_dir, f'{backbone_name}_{sample_num}')
+        if "ESMFold" in self.forward_folding:
+            summary_fn = os.path.join(backbone_dir, 'self_consistency/esm_eval_results.csv')
+        else:
+            assert 'AlphaFold2' in self.forward_folding
+            summary_fn = os.path.join(backbone_dir, 'self_consistency/af2_eval_results.csv')
+        if os.path.exists(summary_fn):
+            _prep_log.warning(f'Backbone {backbone_name}_{sample_num} results already exists. Continuing...')
+            return _PreparedJob(backbone_name, sample_num, motif_info, refold=False)
+
+        os.makedirs(backbone_dir, exist_ok=True)
+        _prep_log.info(f'Running self-consistency on {backbone_name}, '
+                f'sample {sample_num}')
+        au.link_or_copy(os.path.join(self.sample_dir, pdb_file),
+                os.path.join(backbone_dir, pdb_file))
+        _prep_log.info(f'Linked {pdb_file} to {backbone_dir}')
+
+        
+        # Handle redesigned positions
+        _prep_log.info(f'Positions allowed to be redesigned: {redesign_info}')
+
+        if redesign_info is not None:
+            _prep_log.info(f'Positions allowed to be redesigned: {redesign_info}')
+        else:
+            _prep_log.info(f'No positions need to be redesigned.')
+        # Will return standard mapping list and fixed positions if no residue within motifs need to be redesigned
+        redesign_mapping_dict, redesign_position_list, fixed_idx_for_mpnn = au.motif_mapping(
+            motif_indices=motif_indices, 
+            redesign_positions=redesign_info, 
+            contig=contig
+            )
+            
+        if self.force_motif_AA_type:
+            modified_design_pdb_path = os.path.join(backbone_dir, f"{backbone_name}_{sample_num}.pdb")
+            
+            # This will overwrite original protein if AA types of motifs are not all correct.
+            # The original pdb will be copied to another directory named "original_pdb" as a reference.
+            motif_AA_correct = au.check_motif_AA_type(
+                design_file=design_pdb,
+                reference_file=reference_pdb,
+                position_mapping=redesign_mapping_dict,
+                redesign_list=redesign_position_list,
+                output_file=modified_design_pdb_path
+            )
+            if motif_AA_correct == False:
+                original_pdb_dir = os.path.join(backbone_dir, "original_pdb")
+                os.makedirs(original_pdb_dir, exist_ok=True)
+                shutil.copy2(design_pdb, original_pdb_dir)
+                _prep_log.info(f"Copied original PDB to {original_pdb_dir} as reference.")
+                design_pdb = modified_design_pdb_path   
+
+        # Extract motif and calculate backbone motif-RMSD, which is the `backbone_motif_rmsd` metric in outputs.
+        # !!Note: This `rms` is the motif-RMSD between native motif and initially-generated backbone,
+        # i.e. without refolding procedure.
+        backbone_motif_rmsd = _cached_backbone_motif_rmsd(self.motif_cache_dir)(
+            reference_contig, design_contig, reference_pdb, design_pdb
+        )
+
+        # Extract motif with all backbone atoms for subsequent
+        # motif_rmsd computation on predicted folded structure.
+        reference_motif = _reference_motif_extract(reference_contig, reference_pdb, "backbone")
+
+
+        if self.force_motif_AA_type and motif_AA_correct == False:
+            pdb_path = modified_design_pdb_path
+        else:
+            pdb_path = os.path.join(backbone_dir, pdb_file)
+
+        sc_output_dir = os.path.join(backbone_dir, 'self_consistency')
+        os.makedirs(sc_output_dir, exist_ok=True)
+        au.link_or_copy(pdb_path, os.path.join(
+            sc_output_dir, os.path.basename(pdb_path)))
+
+        return _PreparedJob(
+            backbone_name, sample_num, motif_info,
+            pdb_path=pdb_path,
+            sc_output_dir=sc_output_dir,
+            motif_mask=mask,
+            fixed_indices=fixed_idx_for_mpnn,
+            backbone_motif_rmsd=backbone_motif_rmsd,
+            ref_motif=reference_motif,
+            sample_contig=design_contig
+        )
+
+
+# Preparer of the current preparation worker process
+_worker_preparer = None
+
+
+def _init_prep_worker(preparer: _BackbonePreparer):
+    global _worker_preparer
+    _worker_preparer = preparer
+
+
+def _prepare_in_worker(pdb_file: str):
+    return _worker_preparer.prepare(pdb_file)
 
 
 class MotifRefolder:
@@ -95,11 +485,7 @@ class MotifRefolder:
         # Set-up accelerator
         if torch.cuda.is_available():
             if self._infer_conf.gpu_id is None:
-                available_gpus = ''.join(
-                    [str(x) for x in GPUtil.getAvailable(
-                        order="memory", limit = 8)]
-                )
-                self.device = f'cuda:{available_gpus[0]}'
+                self.device = f'cuda:{au.get_most_free_gpu()}'
             else:
                 self.device = f'cuda:{self._infer_conf.gpu_id}'
         else:
@@ -110,11 +496,15 @@ class MotifRefolder:
         self._forward_folding = self._infer_conf.predict_method
         if 'AlphaFold2' in self._forward_folding:
             self._af2_conf = self._infer_conf.af2
-            colabfold_path = self._af2_conf.executive_colabfold_path
-            current_path = os.environ.get('PATH', '')
-            os.environ['PATH'] = colabfold_path + ":" + current_path
-            if self.device == 'cpu':
-                self._log.info(f"You're running AlphaFold2 on {self.device}.")
+            fu.setup_af2(self._af2_conf, self.device)
+            # Run ColabFold inside this process so that JAX compilation and AF2 weights are reused across backbones.
+            # This requires ColabFold to be importable from the current environment.
+            self._af2_in_process = self._af2_conf.get('in_process', False)
+            if self._af2_in_process:
+                self._colabfold_batch = importlib.import_module('colabfold.batch')
+                colabfold_download = importlib.import_module('colabfold.download')
+                self._colabfold_data_dir = Path(self._af2_conf.get('data_dir', None) or colabfold_download.default_data_dir)
+                colabfold_download.download_alphafold_params(self._af2_conf.model_type, self._colabfold_data_dir)
         # Set-up directories
         output_dir = self._infer_conf.output_dir
 
@@ -131,6 +521,7 @@ class MotifRefolder:
             self._motif_csv = self._infer_conf.motif_csv_path
         self._motif_pdb = self._infer_conf.motif_pdb
         self._whole_benchmark_set = None
+        self._atom_types_checked = False
 
         # Save config
         config_folder = os.path.basename(Path(self._output_dir))
@@ -140,11 +531,39 @@ class MotifRefolder:
         self._log.info(f'Saving self-consistency config to {config_path}')
 
         # Load models and experiment
-        if 'cuda' in self.device:
-            self._folding_model = esm.pretrained.esmfold_v1().eval()
-        elif self.device == 'cpu': # ESMFold is not supported for half-precision model when running on CPU
-            self._folding_model = esm.pretrained.esmfold_v1().float().eval()
-        self._folding_model = self._folding_model.to(self.device)
+        self._folding_model, self._esmfold_autocast, self._esmfold_autocast_dtype = fu.load_esmfold(self.device, self._infer_conf)
+        # Reuse ESM-2 representations of sequences that recur across samples and backbones
+        self._esm_cache = None
+        esm_embedding_cache_mb = self._infer_conf.get('esm_embedding_cache_mb', 0)
+        compute_fn = self._folding_model._compute_language_model_representations
+        if isinstance(compute_fn, _ESMEmbeddingCache):
+            # Drop the cache installed on the shared model by an earlier refolder
+            compute_fn = compute_fn._compute_fn
+            self._folding_model._compute_language_model_representations = compute_fn
+        if esm_embedding_cache_mb:
+            self._esm_cache = _ESMEmbeddingCache(
+                compute_fn, self._folding_model.esm_dict.padding_idx, int(esm_embedding_cache_mb * 2 ** 20))
+            self._folding_model._compute_language_model_representations = self._esm_cache
+        # Backbone motif-RMSDs are cached on disk by file content, so reruns on the same
+        # backbone set (e.g. with another predict_method) skip the motif extraction.
+        self._motif_cache_dir = None
+        if self._infer_conf.get('motif_disk_cache', True):
+            self._motif_cache_dir = os.path.join(self._output_dir, '.cache')
+
+        # ESMFold outputs are written to disk in the background while the GPU folds the next batch
+        self._pdb_writer = fu.PDBWriter()
+
+        # Load ProteinMPNN into this process once instead of spawning it for every backbone
+        self._mpnn_in_process = self._infer_conf.get('mpnn_in_process', True)
+        if self._mpnn_in_process:
+            # Same GPU as `--device gpu_id` of the ProteinMPNN subprocess
+            if self._hide_GPU_from_pmpnn or not torch.cuda.is_available():
+                mpnn_device = 'cpu'
+            elif self._infer_conf.gpu_id is not None:
+                mpnn_device = f'cuda:{self._infer_conf.gpu_id}'
+            else:
+                mpnn_device = self.device
+            self._mpnn = mu.ProteinMPNNSampler(self._pmpnn_dir, mpnn_device)
 
 
     def run_sampling(self):
@@ -152,198 +571,95 @@ class MotifRefolder:
         # Run ProteinMPNN
         motif_info_dict = {}
 
-        for pdb_file in os.listdir(self._sample_dir):
-
-            naming_number = 1
-
-            if ".pdb" not in pdb_file:
-                continue
-
-            # Backbone name handling
-            all_name = os.path.splitext(pdb_file)[0]
-            design_pdb = os.path.join(self._sample_dir, pdb_file)
+        # Benchmark information is read once and looked up by backbone name
+        benchmark_contigs = None
+        if self._whole_benchmark_set is not None:
             try:
-                case_num, backbone_name, sample_num = all_name.split("_") # "01_1BCF_1.pdb"
-                if self._max_backbones and int(sample_num) >= self._max_backbones:
-                    self._log.info(f"Skipping sample {sample_num} because "
-                            f"max_backbones={self._max_backbones}")
-                    continue
-
-                
-                backbone_name = case_num + "_" + backbone_name
-                self._log.info(f"case_num: {case_num}, tested case: {backbone_name}, sample_num: {sample_num}")
-                reference_pdb = os.path.join(self._motif_pdb)
-            except ValueError:
-                self._log.warning(f"The naming format {all_name} is not as default. \
-                Try to use another format.")
-                try:
-                    assert len(all_name.split("_")) == 2, f"{all_name} not following default!"
-                    backbone_name, sample_num = all_name.split("_") # "1BCF_1.pdb"
-                    self._log.info(f"tested case :{backbone_name}, sample_num: {sample_num}")
-                    reference_pdb = self._motif_pdb
-                except (ValueError, AssertionError):
-                    self._log.warning(f"The naming format {all_name} is not as default. \
-                    Try to rename the PDB file to format.")
-                    for native_pdb in self._whole_benchmark_set:
-                        print(f"native_pdb: {native_pdb}")
-                        if native_pdb in all_name.upper():
-                            print(f"all name upper: {all_name.upper()}")
-                            backbone_name = native_pdb
-                            break
-                        else:
-                            raise ValueError(f"No benchmark case detected in {all_name}. Try to reformat.")
-                    reference_pdb = self._motif_pdb
-                    rename_design_pdb = os.path.join(self._output_dir, f"{backbone_name}_{naming_number}.pdb")
-                    shutil.copy2(design_pdb, rename_design_pdb)
-                    design_pdb = rename_design_pdb
-                    naming_number += 1
-
-
-            # The following part is a test version and needed to be cleaned up.
-            if self._whole_benchmark_set is not None:
-                try:
-                    benchmark_set_info = pd.read_csv(self._whole_benchmark_set)
-                    reference_contig = benchmark_set_info.iloc[
-                        benchmark_set_info.iloc[:, 0] == backbone_name, 1
-                    ].values[0]
-
-                    #motif_pdb = os.path.join(, f"{backbone_name}.pdb")
-                    reference_motif = au.motif_extract(reference_contig, reference_pdb, atom_part="backbone")
-                except FileNotFoundError:
-                    raise FileNotFoundError(f"Benchmark Information not found in {benchmark_set_info}.")
-                except IndexError:
-                    raise ValueError(f"No contig value found for the name {backbone_name} in benchmark information.")
-                except Exception as e:
-                    pass
-                    #raise RuntimeError(f"An error occured while processing {pdb_file}.")
-                
-
-            # Read motif information data and save into json file
-            if os.path.exists(self._motif_csv):
-                csv_data = au.get_csv_data(self._motif_csv, backbone_name, sample_num)
-            else:
-                csv_data = au.parse_input_scaffold(
-                    os.path.join(self._sample_dir, pdb_file))
-
-            if csv_data == None:
-                self._log.warning(f'Motif information is missing for {pdb_file}. Skipping...')
-                continue
-            contig, mask, motif_indices, redesign_info, segments_order = csv_data
-
-            # Directly extract contig from motif_pdb files
-            reference_contig = au.reference_contig_from_segments(reference_pdb, segments_order)
-            # The contig in designed pdb files
-            design_contig = au.motif_indices_to_contig(motif_indices)
-
-            
-            # Store information for later pymol visualization
-            motif_info_dict[f'{backbone_name}_{sample_num}'] = {
-                "contig": reference_contig,
-                "motif_idx": motif_indices,
-                "redesign_info": redesign_info
-            }
-            
-            # Save outputs
-            backbone_dir = os.path.join(self._output_dir, f'{backbone_name}_{sample_num}')
-            if "ESMFold" in self._forward_folding:
-                summary_fn = os.path.join(backbone_dir, 'self_consistency/esm_eval_results.csv')
-            else:
-                assert 'AlphaFold2' in self._forward_folding
-                summary_fn = os.path.join(backbone_dir, 'self_consistency/af2_eval_results.csv')
-            if os.path.exists(summary_fn):
-                self._log.warning(f'Backbone {backbone_name}_{sample_num} results already exists. Continuing...')
-                continue
-
-            os.makedirs(backbone_dir, exist_ok=True)
-            self._log.info(f'Running self-consistency on {backbone_name}, '
-                    f'sample {sample_num}')
-            shutil.copy2(os.path.join(self._sample_dir, pdb_file), backbone_dir)
-            print(f'copied {pdb_file} to {backbone_dir}')
-
-            
-            # Handle redesigned positions
-            self._log.info(f'Positions allowed to be redesigned: {redesign_info}')
+                benchmark_set_info = pd.read_csv(self._whole_benchmark_set)
+            except FileNotFoundError:
+                raise FileNotFoundError(f"Benchmark Information not found in {self._whole_benchmark_set}.")
+            benchmark_contigs = dict(zip(benchmark_set_info.iloc[:, 0], benchmark_set_info.iloc[:, 1]))
+
+        # Parse all backbone names in one pass and process the samples of each case together
+        pdb_entries = sorted(
+            ((pdb.name, _PDB_NAME_RE.match(pdb.stem)) for pdb in Path(self._sample_dir).glob('*.pdb')),
+            key=lambda x: (x[1].group(1) or '', x[1].group(2), int(x[1].group(3))) if x[1] is not None else ('', x[0], -1)
+        )
 
-            if redesign_info is not None:
-                self._log.info(f'Positions allowed to be redesigned: {redesign_info}')
-            else:
-                self._log.info(f'No positions need to be redesigned.')
-            # Will return standard mapping list and fixed positions if no residue within motifs need to be redesigned
-            redesign_mapping_dict, redesign_position_list, fixed_idx_for_mpnn = au.motif_mapping(
-                motif_indices=motif_indices, 
-                redesign_positions=redesign_info, 
-                contig=contig
-                )
-                
-            if self._infer_conf.force_motif_AA_type:
-                modified_design_pdb_path = os.path.join(backbone_dir, f"{backbone_name}_{sample_num}.pdb")
-                
-                # This will overwrite original protein if AA types of motifs are not all correct.
-                # The original pdb will be copied to another directory named "original_pdb" as a reference.
-                motif_AA_correct = au.check_motif_AA_type(
-                    design_file=design_pdb,
-                    reference_file=reference_pdb,
-                    position_mapping=redesign_mapping_dict,
-                    redesign_list=redesign_position_list,
-                    output_file=modified_design_pdb_path
-                )
-                if motif_AA_correct == False:
-                    original_pdb_dir = os.path.join(backbone_dir, "original_pdb")
-                    os.makedirs(original_pdb_dir, exist_ok=True)
-                    shutil.copy2(design_pdb, original_pdb_dir)
-                    self._log.info(f"Copied original PDB to {original_pdb_dir} as reference.")
-                    design_pdb = modified_design_pdb_path   
-
-            # Extract motif and calculate backbone motif-RMSD, which is the `backbone_motif_rmsd` metric in outputs.
-            # !!Note: This `rms` is the motif-RMSD between native motif and initially-generated backbone,
-            # i.e. without refolding procedure.
-            reference_motif_CA = au.motif_extract(reference_contig,
-                    reference_pdb, atom_part="CA")
-            design_motif_CA = au.motif_extract(design_contig, design_pdb,
-                    atom_part="CA")
-            backbone_motif_rmsd = au.rmsd(reference_motif_CA, design_motif_CA)
-
-            # Extract motif with all backbone atoms for subsequent
-            # motif_rmsd computation on predicted folded structure.
-            design_motif = au.motif_extract(design_contig, design_pdb, atom_part="backbone")
-            reference_motif = au.motif_extract(reference_contig, reference_pdb, atom_part="backbone")
-
-
-            if self._infer_conf.force_motif_AA_type and motif_AA_correct == False:
-                pdb_path = modified_design_pdb_path
-            else:
-                pdb_path = os.path.join(backbone_dir, pdb_file)
-
-            sc_output_dir = os.path.join(backbone_dir, 'self_consistency')
-            os.makedirs(sc_output_dir, exist_ok=True)
-            shutil.copy(pdb_path, os.path.join(
-                sc_output_dir, os.path.basename(pdb_path)))
-
-
-            if backbone_name == '6VW1':
-                _ = self.run_self_consistency(
-                decoy_pdb_dir=sc_output_dir,
-                reference_pdb_path=pdb_path,
-                motif_mask=mask,
-                fixed_indices=fixed_idx_for_mpnn,
-                backbone_motif_rmsd=backbone_motif_rmsd,
-                #complex_motif=chain_B_indices
+        # Prepare backbones in a pool of worker processes while the main process runs
+        # ProteinMPNN and structure prediction on the prepared ones as they become ready.
+        preparer = _BackbonePreparer(
+            sample_dir=self._sample_dir,
+            output_dir=self._output_dir,
+            motif_pdb=self._motif_pdb,
+            motif_csv=getattr(self, '_motif_csv', None),
+            benchmark_contigs=benchmark_contigs,
+            whole_benchmark_set=self._whole_benchmark_set,
+            max_backbones=self._max_backbones,
+            forward_folding=list(self._forward_folding),
+            force_motif_AA_type=self._infer_conf.force_motif_AA_type,
+            motif_cache_dir=self._motif_cache_dir
+        )
+        num_prep_workers = self._infer_conf.get('num_prep_workers', 4)
+        if num_prep_workers is None:
+            num_prep_workers = min(4, os.cpu_count())
+        prep_pool = None
+        if num_prep_workers > 1 and len(pdb_entries) > 1:
+            # Workers are spawned rather than forked, as this process already holds
+            # a CUDA context, the models and running threads
+            prep_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_prep_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_prep_worker,
+                initargs=(preparer,)
             )
-
-            else:
-                _ = self.run_self_consistency(
-                    decoy_pdb_dir=sc_output_dir,
-                    reference_pdb_path=pdb_path,
-                    motif_mask=mask,
-                    fixed_indices=fixed_idx_for_mpnn,
-                    backbone_motif_rmsd=backbone_motif_rmsd,
-                    ref_motif=reference_motif,
-                    sample_contig=design_contig
-                )
-            self._log.info(f'Done sample: {pdb_path}')
+            futures = [prep_pool.submit(_prepare_in_worker, pdb_file) for pdb_file, _ in pdb_entries]
+            # Results are taken in submission order, so backbones are refolded in the same order as without workers
+            prepared_jobs = (future.result() for future in futures)
+        else:
+            prepared_jobs = (preparer.prepare(pdb_file) for pdb_file, _ in pdb_entries)
+
+        try:
+            motif_info_log_path = os.path.join(self._output_dir, 'motif_info.jsonl')
+            with open(motif_info_log_path, 'wb') as motif_info_log:
+                for job in prepared_jobs:
+                    if job is None:
+                        continue
+                    motif_info_dict[f'{job.backbone_name}_{job.sample_num}'] = job.motif_info
+                    # Also append each entry to a JSON-lines log so that a crash does not lose the motif information
+                    motif_info_log.write(_json_bytes({f'{job.backbone_name}_{job.sample_num}': job.motif_info}) + b'\n')
+                    motif_info_log.flush()
+                    if not job.refold:
+                        continue
+
+                    if job.backbone_name == '6VW1':
+                        _ = self.run_self_consistency(
+                        decoy_pdb_dir=job.sc_output_dir,
+                        reference_pdb_path=job.pdb_path,
+                        motif_mask=job.motif_mask,
+                        fixed_indices=job.fixed_indices,
+                        backbone_motif_rmsd=job.backbone_motif_rmsd,
+                        #complex_motif=chain_B_indices
+                    )
+
+                    else:
+                        _ = self.run_self_consistency(
+                            decoy_pdb_dir=job.sc_output_dir,
+                            reference_pdb_path=job.pdb_path,
+                            motif_mask=job.motif_mask,
+                            fixed_indices=job.fixed_indices,
+                            backbone_motif_rmsd=job.backbone_motif_rmsd,
+                            ref_motif=job.ref_motif,
+                            sample_contig=job.sample_contig
+                        )
+                    self._log.info(f'Done sample: {job.pdb_path}')
+        finally:
+            if prep_pool is not None:
+                prep_pool.shutdown(cancel_futures=True)
+            self._pdb_writer.shutdown()
         output_json_path = os.path.join(self._output_dir, 'motif_info.json')
-        with open(output_json_path, 'w') as json_file:
-            json.dump(motif_info_dict, json_file, indent=4, separators=(",", ": "), sort_keys=True)
+        with open(output_json_path, 'wb') as json_file:
+            json_file.write(_json_bytes(motif_info_dict, indent=True))
         self._log.info(f'Motif information saved into {output_json_path}')
 
 
@@ -376,109 +692,110 @@ class MotifRefolder:
             Writes results in decoy_pdb_dir/sc_results.csv
         """
 
-        # Check whether given backbones are CA-only
-        file_to_be_checked = os.path.join(
-            decoy_pdb_dir,
-            random.choice([f for f in os.listdir(decoy_pdb_dir) if f.endswith('.pdb')]))
-        checked_structure = strucio.load_structure(file_to_be_checked)
-        # Assume all backbones with atom types <= 3 to be used with CA-only-ProteinMPNN
-        if len(set(checked_structure.atom_name)) <= 3:
-            self._log.warning(f'The input protein only has atom type(s): {set(checked_structure.atom_name)}\n\
-            Deprecating ProteinMPNN to CA-only version.')
-            self._CA_only = True
-        else:
-            self._log.info(f'The input protein has atom types: {set(checked_structure.atom_name)}\n\
-            Recommend using full-backbone version of ProteinMPNN.')
-            pass
+        # Check whether given backbones are CA-only.
+        # All backbones come from the same sample directory, so this is only done once.
+        if not self._atom_types_checked:
+            checked_structure = strucio.load_structure(reference_pdb_path)
+            # Assume all backbones with atom types <= 3 to be used with CA-only-ProteinMPNN
+            if len(set(checked_structure.atom_name)) <= 3:
+                self._log.warning(f'The input protein only has atom type(s): {set(checked_structure.atom_name)}\n\
+                Deprecating ProteinMPNN to CA-only version.')
+                self._CA_only = True
+            else:
+                self._log.info(f'The input protein has atom types: {set(checked_structure.atom_name)}\n\
+                Recommend using full-backbone version of ProteinMPNN.')
+                pass
+            self._atom_types_checked = True
 
 
         # Run ProteinMPNN
 
-        jsonl_path = os.path.join(decoy_pdb_dir, "parsed_pdbs.jsonl")
-        process = subprocess.Popen([
-            'python',
-            f'{self._pmpnn_dir}/helper_scripts/parse_multiple_chains.py',
-            f'--input_path={decoy_pdb_dir}',
-            f'--output_path={jsonl_path}',
-        ])
-
-        _ = process.wait()
-        num_tries = 0
-        ret = -1
-        pmpnn_args = [
-            sys.executable,
-            f'{self._pmpnn_dir}/protein_mpnn_run.py',
-            '--out_folder',
-            decoy_pdb_dir,
-            '--jsonl_path',
-            jsonl_path,
-            '--num_seq_per_target',
-            str(self._sample_conf.seq_per_sample),
-            '--sampling_temp',
-            '0.1',
-            '--seed',
-            '33',
-            '--batch_size',
-            str(self._sample_conf.mpnn_batch_size),
-        ]
-        self._log.info(f'Running ProteinMPNN with command {" ".join(pmpnn_args)}')
-        if self._infer_conf.gpu_id is not None:
-            pmpnn_args.append('--device')
-            pmpnn_args.append(str(self._infer_conf.gpu_id))
-        if self._CA_only == True:
-            pmpnn_args.append('--ca_only')
-
         # Fix desired motifs
+        fixed_positions = None
+        chains_to_design = "A"
         if (fixed_indices is not None) and (len(fixed_indices) !=0):
             fixed_positions = au.motif_indices_to_fixed_positions(fixed_indices)
             print(f"fix positions: {fixed_positions}")
-            chains_to_design = "A"
             # This is particularlly for 6VW1
             if complex_motif is not None:
-                fixed_indices = fixed_indices.strip('[]').split(', ')
-                fixed_indices = sorted([int(index) for index in fixed_indices])
-                fixed_indices = [element for element in fixed_indices if element not in complex_motif]
+                complex_set = set(complex_motif)
+                fixed_indices = sorted(int(index) for index in fixed_indices.strip('[]').split(', ') if int(index) not in complex_set)
                 complex_motif = " ".join(map(str, complex_motif)) # List2str
                 fixed_positions = " ".join(map(str, fixed_indices)) # List2str
                 fixed_positions = fixed_positions + ", " + complex_motif
                 chains_to_design = "A B"
-            path_for_fixed_positions = os.path.join(decoy_pdb_dir, "fixed_pdbs.jsonl")
 
-
-            subprocess.call([
+        if self._mpnn_in_process:
+            fixed_positions_per_chain = None
+            if fixed_positions is not None:
+                fixed_positions_per_chain = {
+                    chain: [int(idx) for idx in positions.split()]
+                    for chain, positions in zip(chains_to_design.split(), fixed_positions.split(","))
+                }
+            self._mpnn.sample(
+                pdb_path=os.path.join(decoy_pdb_dir, os.path.basename(reference_pdb_path)),
+                out_dir=decoy_pdb_dir,
+                num_seqs=self._sample_conf.seq_per_sample,
+                batch_size=self._sample_conf.mpnn_batch_size,
+                ca_only=bool(self._CA_only),
+                fixed_positions=fixed_positions_per_chain
+            )
+        else:
+            jsonl_path = os.path.join(decoy_pdb_dir, "parsed_pdbs.jsonl")
+            process = subprocess.Popen([
                 'python',
-                os.path.join(self._pmpnn_dir, 'helper_scripts/make_fixed_positions_dict.py'),
-                '--input_path', jsonl_path,
-                '--output_path', path_for_fixed_positions,
-                '--chain_list', chains_to_design,
-                '--position_list', fixed_positions
-            ])
-
-            pmpnn_args.extend([
-                '--chain_id_jsonl', os.path.join(decoy_pdb_dir, "assigned_pdbs.jsonl"),
-                '--fixed_positions_jsonl', path_for_fixed_positions
+                f'{self._pmpnn_dir}/helper_scripts/parse_multiple_chains.py',
+                f'--input_path={decoy_pdb_dir}',
+                f'--output_path={jsonl_path}',
             ])
 
-        while ret < 0:
-            try:
-                print("Running ProteinMPNN...")
-                # Setting CUDA_VISIBLE_DEVICES to an empty string to hide all GPUs
-                env = os.environ.copy()
-                if self._hide_GPU_from_pmpnn:
-                    env["CUDA_VISIBLE_DEVICES"] = ""
-                process = subprocess.Popen(
-                    pmpnn_args,
-                    env=env,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT
-                )
-                ret = process.wait()
-            except Exception as e:
-                num_tries += 1
-                self._log.info(f'Failed ProteinMPNN. Attempt {num_tries}/5')
-                torch.cuda.empty_cache()
-                if num_tries > 4:
-                    raise e
+            _ = process.wait()
+            pmpnn_args = [
+                sys.executable,
+                f'{self._pmpnn_dir}/protein_mpnn_run.py',
+                '--out_folder',
+                decoy_pdb_dir,
+                '--jsonl_path',
+                jsonl_path,
+                '--num_seq_per_target',
+                str(self._sample_conf.seq_per_sample),
+                '--sampling_temp',
+                '0.1',
+                '--seed',
+                '33',
+                '--batch_size',
+                str(self._sample_conf.mpnn_batch_size),
+            ]
+            self._log.info(f'Running ProteinMPNN with command {" ".join(pmpnn_args)}')
+            if self._infer_conf.gpu_id is not None:
+                pmpnn_args.append('--device')
+                pmpnn_args.append(str(self._infer_conf.gpu_id))
+            if self._CA_only == True:
+                pmpnn_args.append('--ca_only')
+
+            if fixed_positions is not None:
+                path_for_fixed_positions = os.path.join(decoy_pdb_dir, "fixed_pdbs.jsonl")
+
+                subprocess.call([
+                    'python',
+                    os.path.join(self._pmpnn_dir, 'helper_scripts/make_fixed_positions_dict.py'),
+                    '--input_path', jsonl_path,
+                    '--output_path', path_for_fixed_positions,
+                    '--chain_list', chains_to_design,
+                    '--position_list', fixed_positions
+                ])
+
+                pmpnn_args.extend(['--fixed_positions_jsonl', path_for_fixed_positions])
+                # Single-chain backbones have nothing to assign, ProteinMPNN designs their only chain
+                if len(chains_to_design.split()) > 1:
+                    pmpnn_args.extend(['--chain_id_jsonl', os.path.join(decoy_pdb_dir, "assigned_pdbs.jsonl")])
+
+            print("Running ProteinMPNN...")
+            # Setting CUDA_VISIBLE_DEVICES to an empty string to hide all GPUs
+            env = os.environ.copy()
+            if self._hide_GPU_from_pmpnn:
+                env["CUDA_VISIBLE_DEVICES"] = ""
+            au.run_with_retries(pmpnn_args, 'ProteinMPNN', env=env, timeout=self._infer_conf.get('subprocess_timeout', None))
         mpnn_fasta_path = os.path.join(
             decoy_pdb_dir,
             'seqs',
@@ -486,43 +803,25 @@ class MotifRefolder:
         )
 
         # Run ESMFold on each ProteinMPNN sequence and calculate metrics.
-        mpnn_results = {
-            'tm_score': [],
-            'sample_path': [],
-            'header': [],
-            'sequence': [],
-            'rmsd': [],
-            'pae': [],
-            'ptm': [],
-            'plddt': [],
-            'length': [],
-            'backbone_motif_rmsd': [],
-            'motif_rmsd': [],
-            'mpnn_score': [],
-            'sample_idx': []
-        }
-        if motif_mask is not None:
-            # Only calculate motif RMSD if mask is specified.
-            mpnn_results['refold_motif_rmsd'] = []
         esmf_dir = os.path.join(decoy_pdb_dir, 'esmf')
         af2_raw_dir = os.path.join(decoy_pdb_dir, 'af2_raw_outputs')
         fasta_seqs = fasta.FastaFile.read(mpnn_fasta_path)
         filtered_seqs = {header: seq for header, seq in fasta_seqs.items() if header.startswith("T=0")} # Drop original sequence
         if self._sample_conf.sort_by_score:
         # Only take seqs with lowerst global score to enter refolding
-            scores = []
-            for i, (header, string) in enumerate(filtered_seqs.items()):
-                #if i == 0:
-                #    global_score = float(header.split(", ")[2].split("=")[1])
-                #    original_seq = (global_score, header, string)
-                #else:
-                global_score = float(header.split(", ")[3].split("=")[1])
-                scores.append((global_score, header, string))
-            scores.sort(key=lambda x: x[0])
-
-            top_seqs_list = scores[:self._sample_conf.seq_per_sample]
-            #top_seqs_list.insert(0, original_seq) # Include the original seq
-            top_seqs = {header: seq for _, header, seq in top_seqs_list}
+            headers = list(filtered_seqs)
+            seqs = list(filtered_seqs.values())
+            scores = np.fromiter(
+                (float(_GLOBAL_SCORE_RE.search(header).group(1)) for header in headers),
+                dtype=np.float32, count=len(headers)
+            )
+            num_top = self._sample_conf.seq_per_sample
+            if num_top < len(scores):
+                top_idx = np.argpartition(scores, num_top)[:num_top]
+            else:
+                top_idx = np.arange(len(scores))
+            top_idx = top_idx[np.argsort(scores[top_idx], kind='stable')]
+            top_seqs = {headers[i]: seqs[i] for i in top_idx}
 
             top_seqs_path = os.path.join(
                 decoy_pdb_dir,
@@ -538,65 +837,100 @@ class MotifRefolder:
 
         seqs_to_refold = top_seqs_path if self._sample_conf.sort_by_score else mpnn_fasta_path
         seqs_dict = fasta.FastaFile.read(seqs_to_refold)
+        # Parse the sample index and ProteinMPNN global score of every header once for all folding methods.
+        # The native sequence (if kept) has no sample index and is indexed as 0.
+        seq_entries = []
+        for header, string in seqs_dict.items():
+            idx_match = _SAMPLE_IDX_RE.search(header) if header.startswith("T=0") else None
+            idx = int(idx_match.group(1)) if idx_match is not None else 0
+            score = float(_GLOBAL_SCORE_RE.search(header).group(1))
+            seq_entries.append((idx, header, string, score))
 
 
         sample_feats = su.parse_pdb_feats('sample', reference_pdb_path)
+        # Constant for the whole backbone, shared by the ESMFold and AlphaFold2 metrics
+        sample_seq = su.aatype_to_seq(sample_feats['aatype'])
+        sample_bb = sample_feats['bb_positions']
 
         if 'ESMFold' in self._forward_folding:
             os.makedirs(esmf_dir, exist_ok=True)
-            for i, (header, string) in enumerate(seqs_dict.items()):
 
-                # Get score for ProteinMPNN
-                if header.startswith("T=0"):
-                    idx = header.split('sample=')[1].split(',')[0]
-                    score = float(header.split(", ")[3].split("=")[1])
-                else:
-                    idx = 0
-                    score = float(header.split(", ")[2].split("=")[1])
-            # Run ESMFold
-                self._log.info(f'Running ESMFold......')
-                esmf_sample_path = os.path.join(esmf_dir, f'sample_{idx}.pdb')
-                _, full_output = self.run_esmfold(string, esmf_sample_path)
-                esmf_feats = su.parse_pdb_feats('folded_sample', esmf_sample_path)
-                sample_seq = su.aatype_to_seq(sample_feats['aatype'])
+            # Run ESMFold on batches of sequences with similar lengths to keep padding low
+            self._log.info(f'Running ESMFold......')
+            esmf_entries = sorted(seq_entries, key=lambda x: len(x[2]))
+            esmfold_batch_size = self._sample_conf.get('esmfold_batch_size', 1)
+            esmf_outputs = []
+            for start in range(0, len(esmf_entries), esmfold_batch_size):
+                batch = esmf_entries[start:start + esmfold_batch_size]
+                batch_paths = [os.path.join(esmf_dir, f'sample_{idx}.pdb') for idx, *_ in batch]
+                batch_outputs = self.run_esmfold_batch([string for _, _, string, _ in batch], batch_paths)
+                esmf_outputs.extend(zip(batch, batch_paths, batch_outputs))
+            self._pdb_writer.wait()
+            if self._esm_cache is not None:
+                self._log.info(f'ESM-2 embedding cache: {self._esm_cache.hits} hits, {self._esm_cache.misses} misses')
+
+            # Compute the structural metrics of the whole set in one batched pass,
+            # using the CA coordinates returned by ESMFold instead of re-parsing the PDBs.
+            esmf_bb_positions = np.stack([full_output['bb_positions'] for *_, full_output in esmf_outputs])
+            rmsds = su.batched_aligned_rmsd(sample_bb, esmf_bb_positions)
+            if motif_mask is not None:
+                refold_motif_rmsds = su.batched_aligned_rmsd(
+                    sample_bb[motif_mask], esmf_bb_positions[:, motif_mask])
+
+            # Result columns are preallocated and filled by index
+            num_seqs = len(esmf_outputs)
+            mpnn_results = {
+                'tm_score': np.empty(num_seqs, dtype=np.float32),
+                'sample_path': np.empty(num_seqs, dtype=object),
+                'header': np.empty(num_seqs, dtype=object),
+                'sequence': np.empty(num_seqs, dtype=object),
+                'rmsd': np.empty(num_seqs, dtype=np.float32),
+                'pae': np.empty(num_seqs, dtype=np.float32),
+                'ptm': np.empty(num_seqs, dtype=np.float32),
+                'plddt': np.empty(num_seqs, dtype=np.float32),
+                'length': np.empty(num_seqs, dtype=np.int32),
+                'backbone_motif_rmsd': np.full(num_seqs, np.nan, dtype=np.float32),
+                'motif_rmsd': np.empty(num_seqs, dtype=np.float32),
+                'mpnn_score': np.empty(num_seqs, dtype=np.float32),
+                'sample_idx': np.empty(num_seqs, dtype=np.int32)
+            }
+            if motif_mask is not None:
+                # Only calculate motif RMSD if mask is specified.
+                mpnn_results['refold_motif_rmsd'] = np.empty(num_seqs, dtype=np.float32)
 
+            for i, ((idx, header, string, score), esmf_sample_path, full_output) in enumerate(esmf_outputs):
                 esm_predict_motif = au.motif_extract(sample_contig, esmf_sample_path, atom_part="backbone")
                 motif_rmsd = au.rmsd(ref_motif, esm_predict_motif)
-                mpnn_results['motif_rmsd'].append(f'{motif_rmsd:.3f}')
+                mpnn_results['motif_rmsd'][i] = motif_rmsd
                 # Calculate scTM of ESMFold outputs with reference protein
                 _, tm_score = su.calc_tm_score(
-                    sample_feats['bb_positions'], esmf_feats['bb_positions'],
+                    sample_bb, esmf_bb_positions[i].astype(np.float64),
                     sample_seq, sample_seq)
-                rmsd = su.calc_aligned_rmsd(
-                    sample_feats['bb_positions'], esmf_feats['bb_positions'])
+                rmsd = rmsds[i]
                 pae = torch.mean(full_output['predicted_aligned_error']).item()
                 ptm = full_output['ptm'].item()
                 plddt = full_output['mean_plddt'].item()
                 if motif_mask is not None:
-                    sample_motif = sample_feats['bb_positions'][motif_mask]
-                    esm_motif = esmf_feats['bb_positions'][motif_mask]
-                    refold_motif_rmsd = su.calc_aligned_rmsd(
-                        sample_motif, esm_motif)
-                    mpnn_results['refold_motif_rmsd'].append(f'{refold_motif_rmsd:.3f}')
+                    mpnn_results['refold_motif_rmsd'][i] = refold_motif_rmsds[i]
                 if backbone_motif_rmsd is not None:
-                    mpnn_results['backbone_motif_rmsd'].append(f'{backbone_motif_rmsd:.3f}')
-                mpnn_results['sample_idx'].append(int(idx))
-                mpnn_results['rmsd'].append(f'{rmsd:.3f}')
-                mpnn_results['tm_score'].append(f'{tm_score:.3f}')
-                mpnn_results['sample_path'].append(os.path.abspath(esmf_sample_path))
-                mpnn_results['header'].append(header)
-                mpnn_results['sequence'].append(string)
-                mpnn_results['pae'].append(f'{pae:.3f}')
-                mpnn_results['ptm'].append(f'{ptm:.3f}')
-                mpnn_results['plddt'].append(f'{plddt:.3f}')
-                mpnn_results['length'].append(len(string))
-                mpnn_results['mpnn_score'].append(f'{score:.3f}')
+                    mpnn_results['backbone_motif_rmsd'][i] = backbone_motif_rmsd
+                mpnn_results['sample_idx'][i] = int(idx)
+                mpnn_results['rmsd'][i] = rmsd
+                mpnn_results['tm_score'][i] = tm_score
+                mpnn_results['sample_path'][i] = os.path.abspath(esmf_sample_path)
+                mpnn_results['header'][i] = header
+                mpnn_results['sequence'][i] = string
+                mpnn_results['pae'][i] = pae
+                mpnn_results['ptm'][i] = ptm
+                mpnn_results['plddt'][i] = plddt
+                mpnn_results['length'][i] = len(string)
+                mpnn_results['mpnn_score'][i] = score
 
             # Save results to CSV
             esm_csv_path = os.path.join(decoy_pdb_dir, 'esm_eval_results.csv')
             mpnn_results = pd.DataFrame(mpnn_results)
             mpnn_results.sort_values('sample_idx', inplace=True)
-            mpnn_results.to_csv(esm_csv_path, index=False)
+            mpnn_results.to_csv(esm_csv_path, index=False, float_format='%.3f')
 
         # Run AlphaFold2 (No MSA)
         if 'AlphaFold2' in self._forward_folding:
@@ -611,44 +945,39 @@ class MotifRefolder:
                 remove_after_cleanup=self._af2_conf.remove_raw_outputs
             )
 
-            for i, (header, string) in enumerate(seqs_dict.items()):
-                # Find index and score
-                if header.startswith("T=0"):
-                    idx = header.split('sample=')[1].split(',')[0]
-                    score = float(header.split(", ")[3].split("=")[1])
-                else:
-                    idx = 0
-                    score = float(header.split(", ")[2].split("=")[1])
+            # Parse each prediction once for both the motif and the CA metrics,
+            # then superimpose the whole set onto the sample in one batched pass.
+            af2_parsed = [
+                su.parse_folded_pdb(os.path.join(af2_dir, f'sample_{idx}.pdb')) for idx, *_ in seq_entries]
+            af2_bb_stack = np.stack([bb_positions for _, bb_positions in af2_parsed])
+            rmsds = su.batched_aligned_rmsd(sample_bb, af2_bb_stack)
+            if motif_mask is not None:
+                refold_motif_rmsds = su.batched_aligned_rmsd(
+                    sample_bb[motif_mask], af2_bb_stack[:, motif_mask])
 
-                af2_sample_path = os.path.join(af2_dir, f'sample_{idx}.pdb')
-                af2_feats = su.parse_pdb_feats('folded_sample', af2_sample_path)
-                sample_seq = su.aatype_to_seq(sample_feats['aatype'])
+            for i, (idx, header, string, score) in enumerate(seq_entries):
+                af2_atoms, af2_bb_positions = af2_parsed[i]
 
-                af2_predict_motif = au.motif_extract(sample_contig, af2_sample_path, atom_part="backbone")
+                af2_predict_motif = au.motif_extract(sample_contig, af2_atoms, atom_part="backbone")
                 motif_rmsd = au.rmsd(ref_motif, af2_predict_motif)
-                af2_outputs[f'sample_{idx}']['motif_rmsd'] = f'{motif_rmsd:.3f}'
+                af2_outputs[f'sample_{idx}']['motif_rmsd'] = motif_rmsd
 
 
                 # Calculation
                 _, tm_score = su.calc_tm_score(
-                    sample_feats['bb_positions'], af2_feats['bb_positions'],
+                    sample_bb, af2_bb_positions,
                     sample_seq, sample_seq)
-                rmsd = su.calc_aligned_rmsd(
-                    sample_feats['bb_positions'], af2_feats['bb_positions'])
+                rmsd = rmsds[i]
                 if motif_mask is not None:
-                    sample_motif = sample_feats['bb_positions'][motif_mask]
-                    af2_motif = af2_feats['bb_positions'][motif_mask]
-                    refold_motif_rmsd = su.calc_aligned_rmsd(
-                        sample_motif, af2_motif)
-                    af2_outputs[f'sample_{idx}']['refold_motif_rmsd'] = f'{refold_motif_rmsd:.3f}'
+                    af2_outputs[f'sample_{idx}']['refold_motif_rmsd'] = refold_motif_rmsds[i]
                 if backbone_motif_rmsd is not None:
-                    af2_outputs[f'sample_{idx}']['backbone_motif_rmsd'] = f'{backbone_motif_rmsd:.3f}'
-                af2_outputs[f'sample_{idx}']['rmsd'] = f'{rmsd:.3f}'
-                af2_outputs[f'sample_{idx}']['tm_score'] = f'{tm_score:.3f}'
+                    af2_outputs[f'sample_{idx}']['backbone_motif_rmsd'] = backbone_motif_rmsd
+                af2_outputs[f'sample_{idx}']['rmsd'] = rmsd
+                af2_outputs[f'sample_{idx}']['tm_score'] = tm_score
                 af2_outputs[f'sample_{idx}']['header'] = header
                 af2_outputs[f'sample_{idx}']['sequence'] = string
                 af2_outputs[f'sample_{idx}']['length'] = len(string)
-                af2_outputs[f'sample_{idx}']['mpnn_score'] = f'{score:.3f}'
+                af2_outputs[f'sample_{idx}']['mpnn_score'] = score
                 af2_outputs[f'sample_{idx}']['sample_idx'] = int(idx)
             print(f'final_outputs: {af2_outputs}')
             af2_csv_path = os.path.join(decoy_pdb_dir, 'af2_eval_results.csv')
@@ -657,15 +986,15 @@ class MotifRefolder:
             af2_df.rename(columns={'index': 'sample'}, inplace=True)
             af2_df.drop('sample', axis=1, inplace=True)
             af2_df.sort_values('sample_idx', inplace=True)
-            af2_df.to_csv(af2_csv_path, index=False)
+            af2_df.to_csv(af2_csv_path, index=False, float_format='%.3f')
 
         if 'ESMFold' in self._forward_folding and 'AlphaFold2' in self._forward_folding:
-            esm_results = pd.read_csv(esm_csv_path)
-            af2_results = pd.read_csv(af2_csv_path)
-            esm_results['folding_method'] = 'ESMFold'
-            af2_results['folding_method'] = 'AlphaFold2'
-            joint_results = pd.concat([esm_results, af2_results], ignore_index=True)
-            joint_results.to_csv(os.path.join(decoy_pdb_dir, 'joint_eval_results.csv'), index=False)
+            # Both result tables are still in memory, so there is no need to read the CSVs back
+            joint_results = pd.concat([
+                mpnn_results.assign(folding_method='ESMFold'),
+                af2_df.assign(folding_method='AlphaFold2')
+            ], ignore_index=True)
+            joint_results.to_csv(os.path.join(decoy_pdb_dir, 'joint_eval_results.csv'), index=False, float_format='%.3f')
 
 
 
@@ -674,66 +1003,44 @@ class MotifRefolder:
         Run ESMFold on sequence.
         TBD: Add options for OmegaFold and AlphaFold2.
         """
-        with torch.no_grad():
-            output = self._folding_model.infer(sequence)
-            output_dict = {key: value.cpu() for key, value in output.items()}
-            output = self._folding_model.output_to_pdb(output)
-        with open(save_path, "w") as f:
-            f.write(output[0])
-        return output, output_dict
+        return fu.run_esmfold(self._folding_model, sequence, save_path, self.device,
+                              self._esmfold_autocast, self._esmfold_autocast_dtype)
+
+    def run_esmfold_batch(self, sequences: List[str], save_paths: List[Union[str, Path]]):
+        """
+        Run ESMFold on a batch of sequences in a single forward pass. The PDB files are
+        written in the background, `self._pdb_writer.wait()` before reading them.
+        """
+        return fu.run_esmfold_batch(self._folding_model, sequences, save_paths, self.device,
+                                    self._esmfold_autocast, self._esmfold_autocast_dtype,
+                                    pdb_writer=self._pdb_writer)
 
     def run_af2(self, sequence: str, save_path: Union[str, Path]):
         """
         Run AlphaFold2 (single-sequence) through LocalColabFold.
         """
+        if self._af2_in_process:
+            queries, is_complex = self._colabfold_batch.get_queries(sequence)
+            self._colabfold_batch.run(
+                queries=queries,
+                result_dir=save_path,
+                num_models=self._af2_conf.num_models,
+                is_complex=is_complex,
+                num_recycles=self._af2_conf.recycle,
+                model_type=self._colabfold_batch.set_model_type(is_complex, self._af2_conf.model_type),
+                msa_mode='single_sequence',
+                use_templates=False,
+                random_seed=self._af2_conf.seed,
+                rank_by=self._af2_conf.rank if self._af2_conf.num_models > 1 else 'auto',
+                num_relax=self._af2_conf.num_relax if self._af2_conf.use_amber_relax else 0,
+                use_gpu_relax=self._af2_conf.use_gpu_relax,
+                data_dir=self._colabfold_data_dir,
+            )
+            return
 
-        #_ = process.wait()
-        num_tries_af2 = 0
-        ret_af2 = -1
-
-        # Setting AF2 args
-        af2_args = [
-            #sys.executable,
-            'colabfold_batch',
-            sequence,
-            save_path,
-            '--msa-mode',
-            'single_sequence',
-            '--num-recycle',
-            str(self._af2_conf.recycle),
-            '--random-seed',
-            str(self._af2_conf.seed),
-            '--model-type',
-            self._af2_conf.model_type,
-            '--num-models',
-            str(self._af2_conf.num_models),
-        ]
-        if self._af2_conf.num_models > 1:
-            af2_args.append('--rank')
-            af2_args.append(self._af2_conf.rank)
-        if self._af2_conf.use_amber_relax:
-            af2_args.append('--amber')
-            af2_args.append('--num-relax')
-            af2_args.append(str(self._af2_conf.num_relax))
-            if self._af2_conf.use_gpu_relax:
-                af2_args.append('--use-gpu-relax')
-
-        # Run AF2
-        while ret_af2 < 0:
-            try:
-                process_af2 = subprocess.Popen(
-                    af2_args,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT
-                )
-
-                ret_af2 = process_af2.wait()
-            except Exception as e:
-                num_tries_af2 += 1
-                self._log.info(f'Hmm...Maybe some error occurs during executing AlphaFold2. Tried {num_tries_af2}/5')
-                torch.cuda.empty_cache()
-                if num_tries_af2 > 10:
-                    raise e
+        fu.run_colabfold(fu.colabfold_args(self._af2_conf), sequence, save_path,
+                         gpu_ids=self._af2_conf.get('gpu_ids', None),
+                         timeout=self._infer_conf.get('subprocess_timeout', None))
 
 class MotifEvaluator:
 
@@ -754,7 +1061,8 @@ class MotifEvaluator:
         self._result_dir = self._infer_conf.output_dir
         self._motif_pdb = self._infer_conf.motif_pdb
 
-        self._foldseek_path = self._eval_conf.foldseek_path
+        # `foldseek_path: None` in the yaml configs is the string "None", i.e. foldseek from PATH
+        self._foldseek_path = self._eval_conf.foldseek_path if self._eval_conf.foldseek_path not in (None, "None") else None
         self._foldseek_database = self._eval_conf.foldseek_database
         self._package_dir = "/".join(scaffold_lab.__path__._path[0].split("/")[:-1])
         self._assist_protein_path = os.path.join(self._package_dir, self._eval_conf.assist_protein)
@@ -778,6 +1086,9 @@ class MotifEvaluator:
             it is recommend to set `evaluation.foldseek_cores.for_pdbTM` in configuration.
             """)
 
+        self._foldseek_dbs = nu.FoldseekDatabases.from_eval_conf(
+            self._eval_conf, threads=self._num_cpu_cores, foldseek_path=self._foldseek_path)
+
         # Merge results into one csv file
         if 'ESMFold' in self.folding_method and 'AlphaFold2' in self.folding_method:
             self.prefix = 'joint'
@@ -823,18 +1134,30 @@ class MotifEvaluator:
         successful_backbone_dir = os.path.join(self._result_dir, f"{prefix}_successful_backbones")
         os.makedirs(successful_backbone_dir, exist_ok=True)
 
-        for pdb in backbones:
-            shutil.copy(pdb, os.path.join(successful_backbone_dir, os.path.basename(pdb)))
-
-        diversity = du.foldseek_cluster(
-            input=successful_backbone_dir,
-            assist_protein_path=self._assist_protein_path,
-            tmscore_threshold=self._tm_threshold,
-            alignment_type=1,
-            output_mode="DICT",
-            save_tmp=True,
-            foldseek_path=self._foldseek_path,
-        )
+        # Backbones are hardlinked rather than copied, as they are only read from here on
+        au.stage_files(backbones, successful_backbone_dir)
+
+        # Reuse the cluster table on reruns as long as the backbones and the TM-score threshold are unchanged
+        diversity_result_path = os.path.join(successful_backbone_dir, "diversity_cluster.tsv")
+        diversity_signature = f"{au.pdb_dir_signature(successful_backbone_dir)}-tm{self._tm_threshold}"
+        diversity_signature_path = os.path.join(self._result_dir, f".{prefix}_diversity.sig")
+        if os.path.exists(diversity_result_path) and au.signature_matches(diversity_signature_path, diversity_signature):
+            self._log.info(f"Diversity results for {prefix} already exist. Continuing...")
+            diversity = du.cluster_summary(diversity_result_path)
+        else:
+            diversity = du.foldseek_cluster(
+                input=successful_backbone_dir,
+                assist_protein_path=self._assist_protein_path,
+                tmscore_threshold=self._tm_threshold,
+                alignment_type=1,
+                output_mode="DICT",
+                save_tmp=True,
+                foldseek_path=self._foldseek_path,
+                threads=self._num_cpu_cores,
+                query_db=self._foldseek_dbs.query_db(successful_backbone_dir, self._query_db_path(prefix))
+                if au.dir_has_entries(successful_backbone_dir) else None,
+            )
+            au.write_signature(diversity_signature_path, diversity_signature)
         self._log.info(
             f"Diversity Calculation for {prefix} finished.\t"
             f"Designable scaffolds: {diversity['Samples']}\t"
@@ -842,7 +1165,6 @@ class MotifEvaluator:
         )
 
         # Create unique designable backbone directory
-        diversity_result_path = os.path.join(successful_backbone_dir, "diversity_cluster.tsv")
         unique_backbones_dir = os.path.join(self._result_dir, f"{prefix}_unique_designable_backbones")
         os.makedirs(unique_backbones_dir, exist_ok=True)
 
@@ -850,25 +1172,18 @@ class MotifEvaluator:
         cluster_dict = {}
 
         if os.path.exists(diversity_result_path):
-            with open(diversity_result_path, "r") as f:
-                cluster_info = f.readlines()
-
-            cluster_map = defaultdict(list)
-            for line in cluster_info:
-                center, member = line.strip().split("\t")
-                cluster_map[center].append(member)
-            cluster_map.pop("assist_protein.pdb", None)
+            cluster_info = pd.read_csv(diversity_result_path, sep="\t", header=None,
+                                       names=["center", "member"], dtype="string")
+            cluster_info = cluster_info[cluster_info["center"] != "assist_protein.pdb"]
+            # Clusters keep the order in which Foldseek reports their centers
+            cluster_map = cluster_info.groupby("center", sort=False)["member"].agg(list)
 
             for idx, (center, members) in enumerate(cluster_map.items(), start=1):
                 cluster_centers.add(center)
                 cluster_dict[str(idx)] = {"center": center, "member": members}
 
-            if "assist_protein.pdb" in cluster_centers:
-                cluster_info.remove("assist_protein.pdb")
-
-            for pdb in cluster_centers:
-                old_path = os.path.join(successful_backbone_dir, pdb)
-                shutil.copy(old_path, unique_backbones_dir)
+            au.stage_files([os.path.join(successful_backbone_dir, pdb) for pdb in cluster_centers],
+                           unique_backbones_dir)
         else:
             self._log.info(
                 f"Diversity results for {prefix} not found. Please check if Foldseek clustered properly or no designable backbones are present."
@@ -877,6 +1192,19 @@ class MotifEvaluator:
         return diversity, successful_backbone_dir, unique_backbones_dir, cluster_dict
 
 
+    def _query_db_path(self, prefix: str) -> str:
+        return os.path.join(self._result_dir, f"{prefix}_foldseek_query_db", "queryDB")
+
+
+    def prefetch_foldseek_database(self):
+        """Load the Foldseek database into memory (if configured) in the background, e.g. while refolding."""
+        self._foldseek_dbs.prefetch()
+
+    def release_foldseek_database(self):
+        """Wait for a prefetch still running and drop the in-memory copy of the Foldseek database."""
+        self._foldseek_dbs.close()
+
+
     def _evaluate_novelty(
         self, 
         complete_results: Union[str, Path, pd.DataFrame], 
@@ -886,15 +1214,25 @@ class MotifEvaluator:
         prefix: str = "esm"
         ):
         """Run novelty evaluation."""
-        success_results = complete_results[complete_results["Success"] == True]
+        success_results = complete_results[complete_results["Success"].astype(bool)]
         novelty_csv_path = os.path.join(self._result_dir, f"{prefix}_novelty_results.csv")
-        if os.listdir(successful_backbone_dir):
-            if not os.path.exists(novelty_csv_path): 
+        novelty_signature_path = os.path.join(self._result_dir, f".{prefix}_novelty.sig")
+        if au.dir_has_entries(successful_backbone_dir):
+            # The pdbTM values also depend on the database searched and on the search mode
+            batch_search = self._eval_conf.get('novelty_batch_search', True)
+            novelty_signature = (f"{au.pdb_dir_signature(successful_backbone_dir)}"
+                                 f"-db{self._foldseek_dbs.resolved_path}-batch{batch_search}")
+            if not (os.path.exists(novelty_csv_path) and au.signature_matches(novelty_signature_path, novelty_signature)):
+                foldseek_database = self._foldseek_dbs.database()
                 results_with_novelty = nu.calculate_novelty(
                     input_csv=success_results,
-                    foldseek_database_path=self._eval_conf.foldseek_database,
+                    foldseek_database_path=foldseek_database,
                     max_workers=self._num_cpu_cores,
                     cpu_threshold=75.0,
+                    batch_search=batch_search,
+                    tmp_dir=os.path.join(self._result_dir, 'novelty_search_tmp'),
+                    foldseek_path=self._foldseek_path,
+                    query_db=self._foldseek_dbs.query_db(successful_backbone_dir, self._query_db_path(prefix)),
                 )
             else:
                 results_with_novelty = pd.read_csv(novelty_csv_path)
@@ -927,13 +1265,14 @@ class MotifEvaluator:
             """)
 
             novelty_score = 1 - weighted_novelty
-            max_novelty = results_with_novelty["pdbTM"].min()
+            max_novelty = np.nanmin(results_with_novelty["pdbTM"].to_numpy(dtype=np.float32, na_value=np.nan))
             self._log.info(
                 f"Novelty Calculation for {prefix} finished.\n"
                 f"Novelty score (1 - pdbTM) among successful backbones weighted by number of clusters: {novelty_score:.3f}\n"
                 f"The most novel designable backbone has a pdbTM of {max_novelty:.3f}"
             )
             results_with_novelty.to_csv(novelty_csv_path, index=False)
+            au.write_signature(novelty_signature_path, novelty_signature)
         else:
             self._log.info(f"No successful backbone was found for {prefix}. Skipping novelty calculation.")
             novelty_score = 0
@@ -967,6 +1306,9 @@ class MotifEvaluator:
             designability_counts[prefix] = designability_count
             pdb_counts[prefix] = pdb_count
 
+        # Novelty search is done for every method
+        self.release_foldseek_database()
+
         # Write summary outputs
         for prefix in diversity_results.keys():
             au.write_summary_results(
@@ -980,35 +1322,41 @@ class MotifEvaluator:
 
         # Optional visualization
         if self._visualize:
-            for method in self.folding_method:
-                self._log.info(f"Performing visualization for {method}.")
-                prefix = "esm" if method == "ESMFold" else "af2"
-                pu.plot_metrics_distribution(
-                    input=os.path.join(self._result_dir, f"{prefix}_complete_results.csv"),
-                    save_path=self._result_dir,
-                    prefix=prefix
-                )
-
-                pu.plot_novelty_distribution(
-                    input=os.path.join(self._result_dir, f"{prefix}_success_novelty_results.csv"),
-                    save_path=self._result_dir,
-                    prefix=prefix
-                )
-
-                pymol_reference_pdb = os.path.join(self._motif_pdb)
-
-                pu.motif_scaffolding_pymol_write(
-                    unique_designable_backbones=os.path.join(self._result_dir, f'{prefix}_unique_designable_backbones'),
-                    reference_pdb=pymol_reference_pdb,
-                    motif_json=os.path.join(self._result_dir, 'motif_info.json'),
-                    save_path=os.path.join(self._result_dir, f'{prefix}_pymol_session.pse')
-                    )   
-
-
-@hydra.main(version_base=None, config_path="../../config",
-        config_name="motif_scaffolding.yaml")
-def run(conf: DictConfig) -> None:
-
+            # PyMol sessions are written on a single background thread (PyMol's `cmd` is global state)
+            # while the matplotlib plots are drawn on the main thread
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pymol_pool:
+                pymol_futures = []
+                for method in self.folding_method:
+                    self._log.info(f"Performing visualization for {method}.")
+                    prefix = "esm" if method == "ESMFold" else "af2"
+
+                    pymol_reference_pdb = os.path.join(self._motif_pdb)
+
+                    pymol_futures.append(pymol_pool.submit(
+                        pu.motif_scaffolding_pymol_write,
+                        unique_designable_backbones=os.path.join(self._result_dir, f'{prefix}_unique_designable_backbones'),
+                        reference_pdb=pymol_reference_pdb,
+                        motif_json=os.path.join(self._result_dir, 'motif_info.json'),
+                        save_path=os.path.join(self._result_dir, f'{prefix}_pymol_session.pse')
+                        ))
+
+                    pu.plot_metrics_distribution(
+                        input=os.path.join(self._result_dir, f"{prefix}_complete_results.csv"),
+                        save_path=self._result_dir,
+                        prefix=prefix
+                    )
+
+                    pu.plot_novelty_distribution(
+                        input=os.path.join(self._result_dir, f"{prefix}_success_novelty_results.csv"),
+                        save_path=self._result_dir,
+                        prefix=prefix
+                    )
+
+                for future in pymol_futures:
+                    future.result()
+
+
+def run_one(conf: DictConfig) -> None:
 
     # Check that path to foldseek database has been specified
     if not conf.evaluation.get("foldseek_database"):
@@ -1016,18 +1364,38 @@ def run(conf: DictConfig) -> None:
 
     # Perform fixed backbone design and forward folding
     print('Starting refolding for motif-scaffolding task......')
-    start_time = time.time()
+    t0 = time.perf_counter()
     refolder = MotifRefolder(conf)
-    refolder.run_sampling()
-    elapsed_time = time.time() - start_time
-    print(f"Refolding finished in {elapsed_time:.2f}s.")
-
-    # Perform analysis on outputs
-    start_time = time.time()
+    # The Foldseek database does not depend on the refolding outputs, so it is
+    # loaded into memory (if configured) while the GPU is busy refolding
     evaluator = MotifEvaluator(conf)
-    evaluator.run_evaluation()
-    elapsed_time = time.time() - start_time
-    print(f'Evaluation finished in {elapsed_time:.2f}s. Voila!')
+    evaluator.prefetch_foldseek_database()
+    try:
+        refolder.run_sampling()
+        t1 = time.perf_counter()
+
+        # Perform analysis on outputs
+        evaluator.run_evaluation()
+        t2 = time.perf_counter()
+    finally:
+        evaluator.release_foldseek_database()
+    print(f'Refolding finished in {t1 - t0:.2f}s | Evaluation finished in {t2 - t1:.2f}s. Voila!')
+
+
+@hydra.main(version_base=None, config_path="../../config", config_name="motif_scaffolding.yaml")
+def run(conf: DictConfig) -> None:
+
+    # Every entry of `sweep` is applied on top of the running config (including the command
+    # line overrides) and evaluated in this process, so the imports and the cached models
+    # are shared between them
+    sweep = conf.get('sweep', None)
+    base_conf = OmegaConf.masked_copy(conf, [key for key in conf.keys() if key != 'sweep'])
+    if not sweep:
+        run_one(base_conf)
+        return
+    for overrides in sweep:
+        print(f'Running sweep entry {list(overrides)}......')
+        run_one(OmegaConf.merge(base_conf, OmegaConf.from_dotlist(list(overrides))))
 
 if __name__ == '__main__':
     run()
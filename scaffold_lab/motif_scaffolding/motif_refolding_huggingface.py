@@ -11,28 +11,27 @@ To run ESMFold and AlphaFold2 simultaneously:
 """
 
 import os
-import tree
 import time
 import json
 import numpy as np
 import hydra
 import torch
 import subprocess
+import concurrent.futures
 import re
 import random
 import logging
+import functools
 import warnings
 import pandas as pd
 import sys
 import rootutils
 import shutil
-import GPUtil
 from pathlib import Path
 from typing import Optional, Dict, Union, List
 from omegaconf import DictConfig, OmegaConf
 
 import esm
-from transformers import AutoTokenizer, EsmForProteinFolding
 import biotite.structure.io as strucio
 from biotite.sequence.io import fasta
 
@@ -51,6 +50,24 @@ from data import structure_utils as su
 from analysis import diversity as du
 from analysis import novelty as nu
 from analysis import plot as pu
+from analysis import folding as fu
+from analysis import mpnn as mu
+
+
+# Motif segments of a contig, e.g. "A1-7" in "5-10/A1-7/20-30"
+_CONTIG_RE = re.compile(r'[A-Za-z]+\d+-\d+')
+
+# Sample index and global score in ProteinMPNN FASTA headers
+_SAMPLE_IDX_RE = re.compile(r'sample=(\d+)')
+_GLOBAL_SCORE_RE = re.compile(r'global_score=([-\d.]+)')
+
+
+@functools.lru_cache(maxsize=None)
+def _reference_contig(contig: str) -> str:
+    """
+    Keep only the motif segments of a design contig; length variants of a case share one contig.
+    """
+    return '/'.join(_CONTIG_RE.findall(contig))
 
 
 class Refolder:
@@ -92,11 +109,7 @@ class Refolder:
         # Set-up accelerator
         if torch.cuda.is_available():
             if self._infer_conf.gpu_id is None:
-                available_gpus = ''.join(
-                    [str(x) for x in GPUtil.getAvailable(
-                        order="memory", limit = 8)]
-                )
-                self.device = f'cuda:{available_gpus[0]}'
+                self.device = f'cuda:{au.get_most_free_gpu()}'
             else:
                 self.device = f'cuda:{self._infer_conf.gpu_id}'
         else:
@@ -109,11 +122,7 @@ class Refolder:
         self._forward_folding = self._infer_conf.predict_method
         if 'AlphaFold2' in self._forward_folding:
             self._af2_conf = self._infer_conf.af2
-            colabfold_path = self._af2_conf.executive_colabfold_path
-            current_path = os.environ.get('PATH', '')
-            os.environ['PATH'] = colabfold_path + ":" + current_path
-            if self.device == 'cpu':
-                self._log.info(f"You're running AlphaFold2 on {self.device}.")
+            fu.setup_af2(self._af2_conf, self.device)
         # Set-up directories
         output_dir = self._infer_conf.output_dir
 
@@ -124,6 +133,18 @@ class Refolder:
         self._CA_only = self._infer_conf.CA_only
         self._hide_GPU_from_pmpnn = self._infer_conf.hide_GPU_from_pmpnn
 
+        # Load ProteinMPNN into this process once instead of spawning it for every backbone
+        self._mpnn_in_process = self._infer_conf.get('mpnn_in_process', True)
+        if self._mpnn_in_process:
+            # Same GPU as `--device gpu_id` of the ProteinMPNN subprocess
+            if self._hide_GPU_from_pmpnn or not torch.cuda.is_available():
+                mpnn_device = 'cpu'
+            elif self._infer_conf.gpu_id is not None:
+                mpnn_device = f'cuda:{self._infer_conf.gpu_id}'
+            else:
+                mpnn_device = self.device
+            self._mpnn = mu.ProteinMPNNSampler(self._pmpnn_dir, mpnn_device)
+
         # Configs for motif-scaffolding
         if self._infer_conf.motif_csv_path is not None:
             self._motif_csv = self._infer_conf.motif_csv_path
@@ -137,25 +158,7 @@ class Refolder:
         self._log.info(f'Saving self-consistency config to {config_path}')
 
         # Load models and experiment in huggingface style
-        if 'cuda' in self.device:
-
-            tokenizer = AutoTokenizer.from_pretrained("facebook/esmfold_v1")
-            model = EsmForProteinFolding.from_pretrained("facebook/esmfold_v1", low_cpu_mem_usage=True)
-            model = model.cuda()
-            # Uncomment to switch the stem to float16
-            model.esm = model.esm.half()
-            torch.backends.cuda.matmul.allow_tf32 = True
-            # Uncomment this line if your GPU memory is 16GB or less, or if you're folding longer (over 600 or so) sequences
-            model.trunk.set_chunk_size(64)
-            self._folding_model = model.eval()
-        elif self.device == 'cpu': # ESMFold is not supported for half-precision model when running on CPU
-
-            tokenizer = AutoTokenizer.from_pretrained("facebook/esmfold_v1")
-            model = EsmForProteinFolding.from_pretrained("facebook/esmfold_v1", low_cpu_mem_usage=True)
-            # Uncomment to switch the stem to float16
-            self._folding_model = model.float().eval()
-
-        self._folding_model = self._folding_model.to(self.device)
+        self._folding_model, self._esmfold_autocast, self._esmfold_autocast_dtype = fu.load_esmfold_hf(self.device, self._infer_conf)
 
 
     def run_sampling(self):
@@ -163,109 +166,169 @@ class Refolder:
         # Run ProteinMPNN
         motif_info_dict = {}
 
-        for pdb_file in os.listdir(self._sample_dir):
-            if ".pdb" in pdb_file:
-                backbone_name = os.path.splitext(pdb_file)[0]
-                sample_num = backbone_name.split("_")[-1]
-                parts = backbone_name.split('_')
-                backbone_name = parts[0] if len(parts) == 2 else '_'.join(parts[:-1])
-
-                # Read motif information data and save into json file
-                if os.path.exists(self._motif_csv):
-                    csv_data = au.get_csv_data(self._motif_csv, backbone_name, sample_num)
-                else:
-                    csv_data = au.parse_input_scaffold(
-                        os.path.join(self._sample_dir, pdb_file))
-
-                if csv_data == None:
-                    self._log.warning(f'Motif information is missing for {pdb_file}. Skipping...')
-                    continue
-                contig, mask, motif_indices, redesign_info = csv_data
-                
-                motif_info_dict[f'{backbone_name}_{sample_num}'] = {
-                    "contig": contig,
-                    "motif_idx": motif_indices,
-                    "redesign_info": redesign_info
-                }
-
-                # Deal with contig
-                if 'IL17RA' in pdb_file:
-                    reference_contig = "E63-70/E101-110"
-                elif '6VW1' not in pdb_file:
-                    reference_contig = '/'.join(re.findall(r'[A-Za-z]+\d+-\d+', contig))
-                design_contig = au.motif_indices_to_contig(motif_indices)
-                print(f'design_contig: {design_contig}')
-
-                # Handle redesigned positions
-                if redesign_info is not None:
-                    self._log.info(f'Positions allowed to be redesigned: {redesign_info}')
-                    motif_indices = au.introduce_redesign_positions(motif_indices, redesign_info)
-
-                # Handle complex case for PDB 6VW1
-                if backbone_name == '6VW1':
-                    reference_contig = "A24-42/A64-82"
-                    parts_6VW1 = design_contig.split("/")
-                    design_contig = '/'.join(parts_6VW1[:-1])
-                    chain_B = parts_6VW1[-1]
-                    start, end = map(int, chain_B[1:].split("-"))
-                    chain_B_indices = list(range(start, end + 1))
-
-                if '_' in backbone_name: # Handle length-variable design for different PDB cases
-                    reference_pdb = os.path.join(self._native_pdbs_dir, f'{backbone_name.split("_")[0]}.pdb')
-                else:
-                    reference_pdb = os.path.join(self._native_pdbs_dir, f'{backbone_name}.pdb')
-                design_pdb = os.path.join(self._sample_dir, pdb_file)
-
-                # Extract motif and calculate motif-RMSD
-                reference_motif_CA = au.motif_extract(reference_contig,
-                        reference_pdb, atom_part="CA")
-                design_motif = au.motif_extract(design_contig, design_pdb,
-                        atom_part="CA")
-                rms = au.rmsd(reference_motif_CA, design_motif)
-
-                # Extract motif with all backbone atoms for subsequent
-                # motif_rmsd computation on predicted folded structure.
-                reference_motif = au.motif_extract(reference_contig, reference_pdb, atom_part="backbone")
-
-                # Save outputs
-                basename_dir = os.path.basename(os.path.normpath(self._sample_dir))
-                backbone_dir = os.path.join(self._output_dir, basename_dir, f'{backbone_name}_{sample_num}')
-                if os.path.exists(backbone_dir):
-                    self._log.info(f'Backbone {backbone_name} already existed, pass then.')
-                    continue
-
-                os.makedirs(backbone_dir, exist_ok=True)
-                self._log.info(f'Running self-consistency on {backbone_name}')
-                shutil.copy2(os.path.join(self._sample_dir, pdb_file), backbone_dir)
-                print(f'copied {pdb_file} to {backbone_dir}')
-
-                #seperate_pdb_folder = os.path.join(backbone_dir, backbone_name)
-                pdb_path = os.path.join(backbone_dir, pdb_file)
-                sc_output_dir = os.path.join(backbone_dir, 'self_consistency')
-                os.makedirs(sc_output_dir, exist_ok=True)
-                shutil.copy(pdb_path, os.path.join(
-                    sc_output_dir, os.path.basename(pdb_path)))
-
-
-                if backbone_name == '6VW1':
-                    _ = self.run_self_consistency(
+        # ProteinMPNN designs for later backbones are produced by worker threads
+        # while the GPU refolds earlier ones.
+        mpnn_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._infer_conf.get('num_mpnn_workers', 2))
+        pending = {}
+
+        # Stat the motif CSV and the finished backbones once rather than for every sample
+        motif_csv_exists = os.path.exists(self._motif_csv)
+        basename_dir = os.path.basename(os.path.normpath(self._sample_dir))
+        sample_output_dir = os.path.join(self._output_dir, basename_dir)
+        done_backbones = set()
+        if os.path.isdir(sample_output_dir):
+            with os.scandir(sample_output_dir) as it:
+                done_backbones = {entry.name for entry in it if entry.is_dir()}
+        with os.scandir(self._sample_dir) as it:
+            pdb_entries = [entry for entry in it if ".pdb" in entry.name]
+
+        for pdb_entry in pdb_entries:
+            pdb_file = pdb_entry.name
+            backbone_name = os.path.splitext(pdb_file)[0]
+            sample_num = backbone_name.split("_")[-1]
+            parts = backbone_name.split('_')
+            backbone_name = parts[0] if len(parts) == 2 else '_'.join(parts[:-1])
+
+            # Read motif information data and save into json file
+            if motif_csv_exists:
+                csv_data = au.get_csv_data(self._motif_csv, backbone_name, sample_num)
+            else:
+                csv_data = au.parse_input_scaffold(pdb_entry.path)
+
+            if csv_data == None:
+                self._log.warning(f'Motif information is missing for {pdb_file}. Skipping...')
+                continue
+            contig, mask, motif_indices, redesign_info = csv_data
+            
+            motif_info_dict[f'{backbone_name}_{sample_num}'] = {
+                "contig": contig,
+                "motif_idx": motif_indices,
+                "redesign_info": redesign_info
+            }
+
+            if f'{backbone_name}_{sample_num}' in done_backbones:
+                self._log.info(f'Backbone {backbone_name} already existed, pass then.')
+                continue
+
+            # Deal with contig
+            if 'IL17RA' in pdb_file:
+                reference_contig = "E63-70/E101-110"
+            elif '6VW1' not in pdb_file:
+                reference_contig = _reference_contig(contig)
+            design_contig = au.motif_indices_to_contig(motif_indices)
+            print(f'design_contig: {design_contig}')
+
+            # Handle redesigned positions
+            if redesign_info is not None:
+                self._log.info(f'Positions allowed to be redesigned: {redesign_info}')
+                motif_indices = au.introduce_redesign_positions(motif_indices, redesign_info)
+
+            # Handle complex case for PDB 6VW1
+            if backbone_name == '6VW1':
+                reference_contig = "A24-42/A64-82"
+                parts_6VW1 = design_contig.split("/")
+                design_contig = '/'.join(parts_6VW1[:-1])
+                chain_B = parts_6VW1[-1]
+                start, end = map(int, chain_B[1:].split("-"))
+                chain_B_indices = list(range(start, end + 1))
+
+            if '_' in backbone_name: # Handle length-variable design for different PDB cases
+                reference_pdb = os.path.join(self._native_pdbs_dir, f'{backbone_name.split("_")[0]}.pdb')
+            else:
+                reference_pdb = os.path.join(self._native_pdbs_dir, f'{backbone_name}.pdb')
+            design_pdb = pdb_entry.path
+
+            # Extract motif and calculate motif-RMSD
+            reference_motif_CA = au.motif_extract(reference_contig,
+                    reference_pdb, atom_part="CA")
+            design_motif = au.motif_extract(design_contig, design_pdb,
+                    atom_part="CA")
+            rms = au.rmsd(reference_motif_CA, design_motif)
+
+            # Extract motif with all backbone atoms for subsequent
+            # motif_rmsd computation on predicted folded structure.
+            reference_motif = au.motif_extract(reference_contig, reference_pdb, atom_part="backbone")
+
+            # Save outputs
+            backbone_dir = os.path.join(sample_output_dir, f'{backbone_name}_{sample_num}')
+            os.makedirs(backbone_dir, exist_ok=True)
+            self._log.info(f'Running self-consistency on {backbone_name}')
+            au.link_or_copy(pdb_entry.path, os.path.join(backbone_dir, pdb_file))
+            print(f'linked {pdb_file} to {backbone_dir}')
+
+            #seperate_pdb_folder = os.path.join(backbone_dir, backbone_name)
+            pdb_path = os.path.join(backbone_dir, pdb_file)
+            sc_output_dir = os.path.join(backbone_dir, 'self_consistency')
+            os.makedirs(sc_output_dir, exist_ok=True)
+            au.link_or_copy(pdb_path, os.path.join(
+                sc_output_dir, os.path.basename(pdb_path)))
+
+
+            if backbone_name == '6VW1':
+                future = mpnn_pool.submit(
+                    self.design_sequences,
                     sc_output_dir,
                     pdb_path,
-                    motif_mask=mask,
                     motif_indices=motif_indices,
-                    rms=rms,
                     complex_motif=chain_B_indices
                 )
+                pending[future] = (sc_output_dir, pdb_path, dict(
+                    motif_mask=mask,
+                    rms=rms
+                ))
+            else:
+                future = mpnn_pool.submit(
+                    self.design_sequences,
+                    sc_output_dir,
+                    pdb_path,
+                    motif_indices=motif_indices
+                )
+                pending[future] = (sc_output_dir, pdb_path, dict(
+                    motif_mask=mask,
+                    rms=rms,
+                    ref_motif=reference_motif,
+                    sample_contig=design_contig
+                ))
+
+        # With `af2.batch_backbones`, AlphaFold2 runs once for all backbones after ESMFold,
+        # so ColabFold loads its weights a single time.
+        batch_af2 = 'AlphaFold2' in self._forward_folding and self._af2_conf.get('batch_backbones', False)
+        folding_methods = [method for method in ['ESMFold'] if method in self._forward_folding] \
+            if batch_af2 else None
+        af2_jobs = []
+
+        # Refold on the main thread in the order ProteinMPNN finishes
+        try:
+            for future in concurrent.futures.as_completed(pending):
+                sc_output_dir, pdb_path, refold_kwargs = pending[future]
+                seqs_to_refold, seqs_dict = future.result()
+                refold_kwargs = dict(refold_kwargs, seqs_dict=seqs_dict)
+                self.refold_and_evaluate(
+                    sc_output_dir,
+                    pdb_path,
+                    seqs_to_refold,
+                    folding_methods=folding_methods,
+                    **refold_kwargs
+                )
+                if batch_af2:
+                    af2_jobs.append((sc_output_dir, pdb_path, seqs_to_refold, refold_kwargs))
                 else:
-                    _ = self.run_self_consistency(
-                        sc_output_dir,
-                        pdb_path,
-                        motif_mask=mask,
-                        motif_indices=motif_indices,
-                        rms=rms,
-                        ref_motif=reference_motif,
-                        sample_contig=design_contig
-                    )
+                    self._log.info(f'Done sample: {pdb_path}')
+        finally:
+            mpnn_pool.shutdown(wait=True, cancel_futures=True)
+
+        if len(af2_jobs) > 0:
+            self.run_af2_batch([(sc_output_dir, seqs_to_refold) for sc_output_dir, _, seqs_to_refold, _ in af2_jobs])
+            for sc_output_dir, pdb_path, seqs_to_refold, refold_kwargs in af2_jobs:
+                self.refold_and_evaluate(
+                    sc_output_dir,
+                    pdb_path,
+                    seqs_to_refold,
+                    folding_methods=['AlphaFold2'],
+                    af2_predicted=True,
+                    **refold_kwargs
+                )
                 self._log.info(f'Done sample: {pdb_path}')
 
         output_json_path = os.path.join(self._output_dir, (os.path.basename(os.path.normpath(self._sample_dir))), 'motif_info.json')
@@ -296,6 +359,35 @@ class Refolder:
             Writes ESMFold outputs to decoy_pdb_dir/esmf
             Writes results in decoy_pdb_dir/sc_results.csv
         """
+        seqs_to_refold, seqs_dict = self.design_sequences(
+            decoy_pdb_dir,
+            reference_pdb_path,
+            motif_indices=motif_indices,
+            complex_motif=complex_motif
+        )
+        self.refold_and_evaluate(
+            decoy_pdb_dir,
+            reference_pdb_path,
+            seqs_to_refold,
+            seqs_dict=seqs_dict,
+            motif_mask=motif_mask,
+            rms=rms,
+            ref_motif=ref_motif,
+            sample_contig=sample_contig
+        )
+
+    def design_sequences(
+            self,
+            decoy_pdb_dir: str,
+            reference_pdb_path: str,
+            motif_indices: Optional[Union[List, str]]=None,
+            complex_motif: Optional[List]=None
+            ) -> tuple:
+        """
+        Run ProteinMPNN on the backbone in `decoy_pdb_dir` and return the FASTA file of sequences
+        to refold together with its {header: sequence} dict.
+        Safe to call from worker threads, in-process ProteinMPNN runs are serialized by a lock.
+        """
 
         # Check whether given backbones are CA-only
         file_to_be_checked = os.path.join(
@@ -306,8 +398,9 @@ class Refolder:
         if len(set(checked_structure.atom_name)) <= 3:
             self._log.warning(f'The input protein only has atom type(s): {set(checked_structure.atom_name)}\n\
             Deprecating ProteinMPNN to CA-only version.')
-            self._CA_only = True
+            ca_only = True
         else:
+            ca_only = self._CA_only
             self._log.info(f'The input protein has atom types: {set(checked_structure.atom_name)}\n\
             Recommend using backbone version of ProteinMPNN.')
             pass
@@ -315,8 +408,86 @@ class Refolder:
 
         # Run ProteinMPNN
 
-        
+        # Fix desired motifs
+        fixed_positions = None
+        chains_to_design = "A"
+        if motif_indices is not None:
+            fixed_positions = au.motif_indices_to_fixed_positions(motif_indices)
+            # This is particularlly for 6VW1
+            if complex_motif is not None:
+                complex_set = set(complex_motif)
+                motif_indices = sorted(int(index) for index in motif_indices.strip('[]').split(', ') if int(index) not in complex_set)
+                complex_motif = " ".join(map(str, complex_motif)) # List2str
+                fixed_positions = " ".join(map(str, motif_indices)) # List2str
+                fixed_positions = fixed_positions + ", " + complex_motif
+                chains_to_design = "A B"
+
+        if self._mpnn_in_process:
+            fixed_positions_per_chain = None
+            if fixed_positions is not None:
+                fixed_positions_per_chain = {
+                    chain: [int(idx) for idx in positions.split()]
+                    for chain, positions in zip(chains_to_design.split(), fixed_positions.split(","))
+                }
+            self._mpnn.sample(
+                pdb_path=os.path.join(decoy_pdb_dir, os.path.basename(reference_pdb_path)),
+                out_dir=decoy_pdb_dir,
+                num_seqs=self._sample_conf.seq_per_sample,
+                batch_size=self._sample_conf.mpnn_batch_size,
+                ca_only=ca_only,
+                fixed_positions=fixed_positions_per_chain
+            )
+        else:
+            self._run_pmpnn_subprocess(decoy_pdb_dir, ca_only, fixed_positions, chains_to_design)
+
+        mpnn_fasta_path = os.path.join(
+            decoy_pdb_dir,
+            'seqs',
+            os.path.basename(reference_pdb_path).replace('.pdb', '.fa')
+        )
+
+        fasta_seqs = fasta.FastaFile.read(mpnn_fasta_path)
+        filtered_seqs = {header: seq for header, seq in fasta_seqs.items() if header.startswith("T=0")} # Drop original sequence
+        # The chosen sequences are handed to the refolding stage in memory, the FASTA is kept for ColabFold
+        if self._sample_conf.sort_by_score:
+        # Only take seqs with lowerst global score to enter refolding
+            scores = []
+            for i, (header, string) in enumerate(filtered_seqs.items()):
+                #if i == 0:
+                #    global_score = float(header.split(", ")[2].split("=")[1])
+                #    original_seq = (global_score, header, string)
+                #else:
+                global_score = float(header.split(", ")[3].split("=")[1])
+                scores.append((global_score, header, string))
+            scores.sort(key=lambda x: x[0])
 
+            top_seqs_list = scores[:self._sample_conf.seq_per_sample]
+            #top_seqs_list.insert(0, original_seq) # Include the original seq
+            top_seqs = {header: seq for _, header, seq in top_seqs_list}
+
+            top_seqs_path = os.path.join(
+                decoy_pdb_dir,
+                'seqs',
+                f'top_score_{os.path.basename(reference_pdb_path)}'.replace('.pdb', '.fa')
+            )
+            print(f'top seqs: {top_seqs}\ntype: {type(top_seqs)}\n')
+            _ = au.write_seqs_to_fasta(top_seqs, top_seqs_path)
+            return top_seqs_path, top_seqs
+        else:
+            #print(f'filtered_seqs: {filtered_seqs}')
+            _ = au.write_seqs_to_fasta(filtered_seqs, mpnn_fasta_path)
+            return mpnn_fasta_path, filtered_seqs
+
+    def _run_pmpnn_subprocess(
+            self,
+            decoy_pdb_dir: str,
+            ca_only: bool,
+            fixed_positions: Optional[str]=None,
+            chains_to_design: str="A"
+            ):
+        """
+        Run ProteinMPNN through its own scripts, writing sequences to decoy_pdb_dir/seqs.
+        """
         jsonl_path = os.path.join(decoy_pdb_dir, "parsed_pdbs.jsonl")
         process = subprocess.Popen([
             'python',
@@ -326,8 +497,6 @@ class Refolder:
         ])
 
         _ = process.wait()
-        num_tries = 0
-        ret = -1
         pmpnn_args = [
             sys.executable,
             f'{self._pmpnn_dir}/protein_mpnn_run.py',
@@ -347,28 +516,12 @@ class Refolder:
         if self._infer_conf.gpu_id is not None:
             pmpnn_args.append('--device')
             pmpnn_args.append(str(self._infer_conf.gpu_id))
-        if self._CA_only == True:
+        if ca_only == True:
             pmpnn_args.append('--ca_only')
 
-        # Fix desired motifs
-        if motif_indices is not None:
-            fixed_positions = au.motif_indices_to_fixed_positions(motif_indices)
-            chains_to_design = "A"
-            # This is particularlly for 6VW1
-            if complex_motif is not None:
-                motif_indices = motif_indices.strip('[]').split(', ')
-                motif_indices = sorted([int(index) for index in motif_indices])
-                motif_indices = [element for element in motif_indices if element not in complex_motif]
-                complex_motif = " ".join(map(str, complex_motif)) # List2str
-                fixed_positions = " ".join(map(str, motif_indices)) # List2str
-                print(motif_indices)
-                print(fixed_positions)
-                fixed_positions = fixed_positions + ", " + complex_motif
-                print(fixed_positions)
-                chains_to_design = "A B"
+        if fixed_positions is not None:
             path_for_fixed_positions = os.path.join(decoy_pdb_dir, "fixed_pdbs.jsonl")
 
-
             subprocess.call([
                 'python',
                 os.path.join(self._pmpnn_dir, 'helper_scripts/make_fixed_positions_dict.py'),
@@ -378,155 +531,132 @@ class Refolder:
                 '--position_list', fixed_positions
             ])
 
-            pmpnn_args.extend([
-                '--chain_id_jsonl', os.path.join(decoy_pdb_dir, "assigned_pdbs.jsonl"),
-                '--fixed_positions_jsonl', path_for_fixed_positions
-            ])
+            pmpnn_args.extend(['--fixed_positions_jsonl', path_for_fixed_positions])
+            # Single-chain backbones have nothing to assign, ProteinMPNN designs their only chain
+            if len(chains_to_design.split()) > 1:
+                pmpnn_args.extend(['--chain_id_jsonl', os.path.join(decoy_pdb_dir, "assigned_pdbs.jsonl")])
 
-        while ret < 0:
-            try:
-                print("Running ProteinMPNN...")
-                # Setting CUDA_VISIBLE_DEVICES to an empty string to hide all GPUs
-                env = os.environ.copy()
-                if self._hide_GPU_from_pmpnn:
-                    env["CUDA_VISIBLE_DEVICES"] = ""
-                process = subprocess.Popen(
-                    pmpnn_args,
-                    env=env,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT
-                )
-                ret = process.wait()
-            except Exception as e:
-                num_tries += 1
-                self._log.info(f'Failed ProteinMPNN. Attempt {num_tries}/5')
-                torch.cuda.empty_cache()
-                if num_tries > 4:
-                    raise e
-        mpnn_fasta_path = os.path.join(
-            decoy_pdb_dir,
-            'seqs',
-            os.path.basename(reference_pdb_path).replace('.pdb', '.fa')
-        )
+        print("Running ProteinMPNN...")
+        # Setting CUDA_VISIBLE_DEVICES to an empty string to hide all GPUs
+        env = os.environ.copy()
+        if self._hide_GPU_from_pmpnn:
+            env["CUDA_VISIBLE_DEVICES"] = ""
+        au.run_with_retries(pmpnn_args, 'ProteinMPNN', env=env, timeout=self._infer_conf.get('subprocess_timeout', None))
+
+    def refold_and_evaluate(
+            self,
+            decoy_pdb_dir: str,
+            reference_pdb_path: str,
+            seqs_to_refold: str,
+            seqs_dict: Optional[Dict[str, str]]=None,
+            motif_mask: Optional[np.ndarray]=None,
+            rms: Optional[float]=None,
+            ref_motif=None,
+            sample_contig=None,
+            folding_methods: Optional[List[str]]=None,
+            af2_predicted: bool=False
+            ):
+        """
+        Refold the designed sequences in `seqs_to_refold` and write the evaluation results of one backbone.
+        `folding_methods` restricts the run to some of `inference.predict_method`, and `af2_predicted`
+        skips ColabFold when its outputs are already in decoy_pdb_dir/af2_raw_outputs.
+        `seqs_dict` holds the sequences of `seqs_to_refold` if they are already in memory.
+        """
+        folding_methods = self._forward_folding if folding_methods is None else folding_methods
+        if seqs_dict is None:
+            seqs_dict = fasta.FastaFile.read(seqs_to_refold)
 
-        # Run ESMFold on each ProteinMPNN sequence and calculate metrics.
-        mpnn_results = {
-            'tm_score': [],
-            'sample_path': [],
-            'header': [],
-            'sequence': [],
-            'rmsd': [],
-            'pae': [],
-            'ptm': [],
-            'plddt': [],
-            'length': [],
-            'backbone_motif_rmsd': [],
-            'motif_rmsd': [],
-            'mpnn_score': [],
-            'sample_idx': []
-        }
-        if motif_mask is not None:
-            # Only calculate motif RMSD if mask is specified.
-            mpnn_results['refold_motif_rmsd'] = []
         esmf_dir = os.path.join(decoy_pdb_dir, 'esmf')
         af2_raw_dir = os.path.join(decoy_pdb_dir, 'af2_raw_outputs')
-        fasta_seqs = fasta.FastaFile.read(mpnn_fasta_path)
-        filtered_seqs = {header: seq for header, seq in fasta_seqs.items() if header.startswith("T=0")} # Drop original sequence
-        if self._sample_conf.sort_by_score:
-        # Only take seqs with lowerst global score to enter refolding
-            scores = []
-            for i, (header, string) in enumerate(filtered_seqs.items()):
-                #if i == 0:
-                #    global_score = float(header.split(", ")[2].split("=")[1])
-                #    original_seq = (global_score, header, string)
-                #else:
-                global_score = float(header.split(", ")[3].split("=")[1])
-                scores.append((global_score, header, string))
-            scores.sort(key=lambda x: x[0])
-
-            top_seqs_list = scores[:self._sample_conf.seq_per_sample]
-            #top_seqs_list.insert(0, original_seq) # Include the original seq
-            top_seqs = {header: seq for _, header, seq in top_seqs_list}
-
-            top_seqs_path = os.path.join(
-                decoy_pdb_dir,
-                'seqs',
-                f'top_score_{os.path.basename(reference_pdb_path)}'.replace('.pdb', '.fa')
-            )
-            print(f'top seqs: {top_seqs}\ntype: {type(top_seqs)}\n')
-            _ = au.write_seqs_to_fasta(top_seqs, top_seqs_path)
-        else:
-            filtered_seqs = {header: seq for header, seq in fasta_seqs.items() if header.startswith("T=0")}
-            #print(f'filtered_seqs: {filtered_seqs}')
-            _ = au.write_seqs_to_fasta(filtered_seqs, mpnn_fasta_path)
 
-        seqs_to_refold = top_seqs_path if self._sample_conf.sort_by_score else mpnn_fasta_path
-        seqs_dict = fasta.FastaFile.read(seqs_to_refold)
 
+        # Index and ProteinMPNN score of each sequence, used by both folding methods.
+        # Sequences without a sample index (the native one) get index 0.
+        seq_entries = []
+        for header, string in seqs_dict.items():
+            idx_match = _SAMPLE_IDX_RE.search(header) if header.startswith("T=0") else None
+            idx = int(idx_match.group(1)) if idx_match is not None else 0
+            score = float(_GLOBAL_SCORE_RE.search(header).group(1))
+            seq_entries.append((idx, header, string, score))
 
         sample_feats = su.parse_pdb_feats('sample', reference_pdb_path)
+        # Same for every refolded sequence of this backbone
+        sample_seq = su.aatype_to_seq(sample_feats['aatype'])
+        sample_bb = sample_feats['bb_positions']
 
-        if 'ESMFold' in self._forward_folding:
+        if 'ESMFold' in folding_methods:
             os.makedirs(esmf_dir, exist_ok=True)
-            for i, (header, string) in enumerate(seqs_dict.items()):
-
-                # Get score for ProteinMPNN
-                if header.startswith("T=0"):
-                    idx = header.split('sample=')[1].split(',')[0]
-                    score = float(header.split(", ")[3].split("=")[1])
-                else:
-                    idx = 0
-                    score = float(header.split(", ")[2].split("=")[1])
-            # Run ESMFold
-                self._log.info(f'Running ESMFold......')
-                esmf_sample_path = os.path.join(esmf_dir, f'sample_{idx}.pdb')
-                _, full_output = self.run_folding(string, esmf_sample_path)
-                esmf_feats = su.parse_pdb_feats('folded_sample', esmf_sample_path)
-                sample_seq = su.aatype_to_seq(sample_feats['aatype'])
-
-                esm_predict_motif = au.motif_extract(sample_contig, esmf_sample_path, atom_part="backbone")
-                motif_rmsd = au.rmsd(ref_motif, esm_predict_motif)
-                mpnn_results['motif_rmsd'].append(f'{motif_rmsd:.3f}')
+            # Run ESMFold on batches of sequences with similar lengths to keep padding low
+            self._log.info(f'Running ESMFold......')
+            esmf_entries = sorted(seq_entries, key=lambda x: len(x[2]))
+            esmfold_batch_size = self._sample_conf.get('esmfold_batch_size', 1)
+            esmf_outputs = []
+            for start in range(0, len(esmf_entries), esmfold_batch_size):
+                batch = esmf_entries[start:start + esmfold_batch_size]
+                batch_paths = [os.path.join(esmf_dir, f'sample_{idx}.pdb') for idx, *_ in batch]
+                batch_outputs = self.run_folding_batch([string for _, _, string, _ in batch], batch_paths)
+                esmf_outputs.extend(zip(batch, batch_paths, batch_outputs))
+
+            # One parse per prediction feeds both RMSDs, and all predictions are aligned to the sample at once
+            esmf_parsed = [su.parse_folded_pdb(esmf_sample_path) for _, esmf_sample_path, _ in esmf_outputs]
+            esmf_bb_stack = np.stack([bb_positions for _, bb_positions in esmf_parsed])
+            rmsds = su.batched_aligned_rmsd(sample_bb, esmf_bb_stack)
+            if motif_mask is not None:
+                refold_motif_rmsds = su.batched_aligned_rmsd(
+                    sample_bb[motif_mask], esmf_bb_stack[:, motif_mask])
+
+            # Result columns are preallocated numerically and formatted once when the CSV is written
+            num_seqs = len(esmf_outputs)
+            mpnn_results = {
+                'tm_score': np.empty(num_seqs, dtype=np.float32),
+                'sample_path': np.empty(num_seqs, dtype=object),
+                'header': np.empty(num_seqs, dtype=object),
+                'sequence': np.empty(num_seqs, dtype=object),
+                'rmsd': rmsds.astype(np.float32),
+                'pae': np.empty(num_seqs, dtype=np.float32),
+                'ptm': np.empty(num_seqs, dtype=np.float32),
+                'plddt': np.empty(num_seqs, dtype=np.float32),
+                'length': np.empty(num_seqs, dtype=np.int32),
+                'backbone_motif_rmsd': np.full(num_seqs, np.nan if rms is None else rms, dtype=np.float32),
+                'motif_rmsd': np.empty(num_seqs, dtype=np.float32),
+                'mpnn_score': np.empty(num_seqs, dtype=np.float32),
+                'sample_idx': np.empty(num_seqs, dtype=np.int32)
+            }
+            if motif_mask is not None:
+                # Only calculate motif RMSD if mask is specified.
+                mpnn_results['refold_motif_rmsd'] = refold_motif_rmsds.astype(np.float32)
+
+            for i, ((idx, header, string, score), esmf_sample_path, full_output) in enumerate(esmf_outputs):
+                esmf_atoms, esmf_bb_positions = esmf_parsed[i]
+
+                esm_predict_motif = au.motif_extract(sample_contig, esmf_atoms, atom_part="backbone")
+                mpnn_results['motif_rmsd'][i] = au.rmsd(ref_motif, esm_predict_motif)
                 # Calculate scTM of ESMFold outputs with reference protein
                 _, tm_score = su.calc_tm_score(
-                    sample_feats['bb_positions'], esmf_feats['bb_positions'],
+                    sample_bb, esmf_bb_positions,
                     sample_seq, sample_seq)
-                rmsd = su.calc_aligned_rmsd(
-                    sample_feats['bb_positions'], esmf_feats['bb_positions'])
-                pae = torch.mean(full_output['predicted_aligned_error']).item()
-                ptm = full_output['ptm'].item()
-                plddt = full_output['mean_plddt'].item()
-                if motif_mask is not None:
-                    sample_motif = sample_feats['bb_positions'][motif_mask]
-                    esm_motif = esmf_feats['bb_positions'][motif_mask]
-                    refold_motif_rmsd = su.calc_aligned_rmsd(
-                        sample_motif, esm_motif)
-                    mpnn_results['refold_motif_rmsd'].append(f'{refold_motif_rmsd:.3f}')
-                if rms is not None:
-                    mpnn_results['backbone_motif_rmsd'].append(f'{rms:.3f}')
-                mpnn_results['sample_idx'].append(int(idx))
-                mpnn_results['rmsd'].append(f'{rmsd:.3f}')
-                mpnn_results['tm_score'].append(f'{tm_score:.3f}')
-                mpnn_results['sample_path'].append(os.path.abspath(esmf_sample_path))
-                mpnn_results['header'].append(header)
-                mpnn_results['sequence'].append(string)
-                mpnn_results['pae'].append(f'{pae:.3f}')
-                mpnn_results['ptm'].append(f'{ptm:.3f}')
-                mpnn_results['plddt'].append(f'{plddt:.3f}')
-                mpnn_results['length'].append(len(string))
-                mpnn_results['mpnn_score'].append(f'{score:.3f}')
+                mpnn_results['tm_score'][i] = tm_score
+                mpnn_results['pae'][i] = torch.mean(full_output['predicted_aligned_error']).item()
+                mpnn_results['ptm'][i] = full_output['ptm'].item()
+                mpnn_results['plddt'][i] = full_output['mean_plddt'].item()
+                mpnn_results['sample_idx'][i] = int(idx)
+                mpnn_results['sample_path'][i] = os.path.abspath(esmf_sample_path)
+                mpnn_results['header'][i] = header
+                mpnn_results['sequence'][i] = string
+                mpnn_results['length'][i] = len(string)
+                mpnn_results['mpnn_score'][i] = score
 
             # Save results to CSV
             esm_csv_path = os.path.join(decoy_pdb_dir, 'esm_eval_results.csv')
             mpnn_results = pd.DataFrame(mpnn_results)
             mpnn_results.sort_values('sample_idx', inplace=True)
-            mpnn_results.to_csv(esm_csv_path, index=False)
+            mpnn_results.to_csv(esm_csv_path, index=False, float_format='%.3f')
 
         # Run AF2
-        if 'AlphaFold2' in self._forward_folding:
-            self._log.info(f'Running AlphaFold2......')
-
-            _ = self.run_af2(seqs_to_refold, af2_raw_dir)
+        if 'AlphaFold2' in folding_methods:
+            if not af2_predicted:
+                self._log.info(f'Running AlphaFold2......')
+                _ = self.run_af2(seqs_to_refold, af2_raw_dir)
             af2_dir = os.path.join(decoy_pdb_dir, 'af2')
             os.makedirs(af2_dir, exist_ok=True)
             af2_outputs = au.cleanup_af2_outputs(
@@ -534,44 +664,38 @@ class Refolder:
                 os.path.join(decoy_pdb_dir, 'af2')
             )
 
-            for i, (header, string) in enumerate(seqs_dict.items()):
-                # Find index and score
-                if header.startswith("T=0"):
-                    idx = header.split('sample=')[1].split(',')[0]
-                    score = float(header.split(", ")[3].split("=")[1])
-                else:
-                    idx = 0
-                    score = float(header.split(", ")[2].split("=")[1])
+            # As for ESMFold above
+            af2_parsed = [
+                su.parse_folded_pdb(os.path.join(af2_dir, f'sample_{idx}.pdb')) for idx, *_ in seq_entries]
+            af2_bb_stack = np.stack([bb_positions for _, bb_positions in af2_parsed])
+            rmsds = su.batched_aligned_rmsd(sample_bb, af2_bb_stack)
+            if motif_mask is not None:
+                refold_motif_rmsds = su.batched_aligned_rmsd(
+                    sample_bb[motif_mask], af2_bb_stack[:, motif_mask])
 
-                af2_sample_path = os.path.join(af2_dir, f'sample_{idx}.pdb')
-                af2_feats = su.parse_pdb_feats('folded_sample', af2_sample_path)
-                sample_seq = su.aatype_to_seq(sample_feats['aatype'])
+            for i, (idx, header, string, score) in enumerate(seq_entries):
+                af2_atoms, af2_bb_positions = af2_parsed[i]
 
-                af2_predict_motif = au.motif_extract(sample_contig, af2_sample_path, atom_part="backbone")
+                af2_predict_motif = au.motif_extract(sample_contig, af2_atoms, atom_part="backbone")
                 motif_rmsd = au.rmsd(ref_motif, af2_predict_motif)
-                af2_outputs[f'sample_{idx}']['motif_rmsd'] = f'{motif_rmsd:.3f}'
+                af2_outputs[f'sample_{idx}']['motif_rmsd'] = motif_rmsd
 
 
                 # Calculation
                 _, tm_score = su.calc_tm_score(
-                    sample_feats['bb_positions'], af2_feats['bb_positions'],
+                    sample_bb, af2_bb_positions,
                     sample_seq, sample_seq)
-                rmsd = su.calc_aligned_rmsd(
-                    sample_feats['bb_positions'], af2_feats['bb_positions'])
+                rmsd = rmsds[i]
                 if motif_mask is not None:
-                    sample_motif = sample_feats['bb_positions'][motif_mask]
-                    af2_motif = af2_feats['bb_positions'][motif_mask]
-                    refold_motif_rmsd = su.calc_aligned_rmsd(
-                        sample_motif, af2_motif)
-                    af2_outputs[f'sample_{idx}']['refold_motif_rmsd'] = f'{refold_motif_rmsd:.3f}'
+                    af2_outputs[f'sample_{idx}']['refold_motif_rmsd'] = refold_motif_rmsds[i]
                 if rms is not None:
-                    af2_outputs[f'sample_{idx}']['backbone_motif_rmsd'] = f'{rms:.3f}'
-                af2_outputs[f'sample_{idx}']['rmsd'] = f'{rmsd:.3f}'
-                af2_outputs[f'sample_{idx}']['tm_score'] = f'{tm_score:.3f}'
+                    af2_outputs[f'sample_{idx}']['backbone_motif_rmsd'] = rms
+                af2_outputs[f'sample_{idx}']['rmsd'] = rmsd
+                af2_outputs[f'sample_{idx}']['tm_score'] = tm_score
                 af2_outputs[f'sample_{idx}']['header'] = header
                 af2_outputs[f'sample_{idx}']['sequence'] = string
                 af2_outputs[f'sample_{idx}']['length'] = len(string)
-                af2_outputs[f'sample_{idx}']['mpnn_score'] = f'{score:.3f}'
+                af2_outputs[f'sample_{idx}']['mpnn_score'] = score
                 af2_outputs[f'sample_{idx}']['sample_idx'] = int(idx)
             print(f'final_outputs: {af2_outputs}')
             af2_csv_path = os.path.join(decoy_pdb_dir, 'af2_eval_results.csv')
@@ -580,15 +704,18 @@ class Refolder:
             af2_df.rename(columns={'index': 'sample'}, inplace=True)
             af2_df.drop('sample', axis=1, inplace=True)
             af2_df.sort_values('sample_idx', inplace=True)
-            af2_df.to_csv(af2_csv_path, index=False)
+            af2_df.to_csv(af2_csv_path, index=False, float_format='%.3f')
 
-        if 'ESMFold' in self._forward_folding and 'AlphaFold2' in self._forward_folding:
-            esm_results = pd.read_csv(esm_csv_path)
-            af2_results = pd.read_csv(af2_csv_path)
-            esm_results['folding_method'] = 'ESMFold'
-            af2_results['folding_method'] = 'AlphaFold2'
-            joint_results = pd.concat([esm_results, af2_results], ignore_index=True)
-            joint_results.to_csv(os.path.join(decoy_pdb_dir, 'joint_eval_results.csv'), index=False)
+        if 'ESMFold' in self._forward_folding and 'AlphaFold2' in folding_methods:
+            if 'ESMFold' not in folding_methods:
+                # ESMFold ran in an earlier call, when AlphaFold2 is batched across backbones
+                mpnn_results = pd.read_csv(os.path.join(decoy_pdb_dir, 'esm_eval_results.csv'))
+            # Both result tables are in memory, so there is no need to read the AF2 CSV back
+            joint_results = pd.concat([
+                mpnn_results.assign(folding_method='ESMFold'),
+                af2_df.assign(folding_method='AlphaFold2')
+            ], ignore_index=True)
+            joint_results.to_csv(os.path.join(decoy_pdb_dir, 'joint_eval_results.csv'), index=False, float_format='%.3f')
 
 
 
@@ -597,66 +724,59 @@ class Refolder:
         Run ESMFold on sequence.
         TBD: Add options for OmegaFold and AlphaFold2.
         """
-        with torch.no_grad():
-            output = self._folding_model.infer(sequence)
-            output_dict = {key: value.cpu() for key, value in output.items()}
-            output = self._folding_model.output_to_pdb(output)
-        with open(save_path, "w") as f:
-            f.write(output[0])
-        return output, output_dict
+        return fu.run_esmfold(self._folding_model, sequence, save_path, self.device,
+                              self._esmfold_autocast, self._esmfold_autocast_dtype)
+
+    def run_folding_batch(self, sequences, save_paths):
+        """
+        Run ESMFold on a batch of sequences in a single forward pass.
+        """
+        return fu.run_esmfold_batch(self._folding_model, sequences, save_paths, self.device,
+                                    self._esmfold_autocast, self._esmfold_autocast_dtype)
 
     def run_af2(self, sequence, save_path):
         """
         Run AlphaFold2 (single-sequence) through LocalColabFold.
         """
+        fu.run_colabfold(fu.colabfold_args(self._af2_conf), sequence, save_path,
+                         gpu_ids=self._af2_conf.get('gpu_ids', None),
+                         timeout=self._infer_conf.get('subprocess_timeout', None))
 
-        #_ = process.wait()
-        num_tries_af2 = 0
-        ret_af2 = -1
-
-        # Setting AF2 args
-        af2_args = [
-            #sys.executable,
-            'colabfold_batch',
-            sequence,
-            save_path,
-            '--msa-mode',
-            'single_sequence',
-            '--num-recycle',
-            str(self._af2_conf.recycle),
-            '--random-seed',
-            str(self._af2_conf.seed),
-            '--model-type',
-            self._af2_conf.model_type,
-            '--num-models',
-            str(self._af2_conf.num_models),
-        ]
-        if self._af2_conf.num_models > 1:
-            af2_args.append('--rank')
-            af2_args.append(self._af2_conf.rank)
-        if self._af2_conf.use_amber_relax:
-            af2_args.append('--amber')
-            af2_args.append('--num-relax')
-            af2_args.append(str(self._af2_conf.num_relax))
-            if self._af2_conf.use_gpu_relax:
-                af2_args.append('--use-gpu-relax')
-
-        # Run AF2
-        while ret_af2 < 0:
-            try:
-                process_af2 = subprocess.Popen(
-                    af2_args,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT
-                )
+    def run_af2_batch(self, jobs: List[tuple]):
+        """
+        Run AlphaFold2 for several backbones in one ColabFold invocation.
 
-                ret_af2 = process_af2.wait()
-            except Exception as e:
-                num_tries_af2 += 1
-                self._log.info(f'Hmm...Maybe some error occurs during executing AlphaFold2. Tried {num_tries_af2}/5')
-                torch.cuda.empty_cache()
-                if num_tries_af2 > 10:
-                    raise e
+        Args:
+            jobs: (decoy_pdb_dir, fasta_path) per backbone. Headers are prefixed with the
+                backbone index for the combined run, and the predictions are moved back to
+                each decoy_pdb_dir/af2_raw_outputs with the prefix stripped.
+        """
+        basename_dir = os.path.basename(os.path.normpath(self._sample_dir))
+        batch_dir = os.path.join(self._output_dir, basename_dir, 'af2_batch')
+        batch_raw_dir = os.path.join(batch_dir, 'af2_raw_outputs')
+        os.makedirs(batch_raw_dir, exist_ok=True)
+
+        combined_seqs = {}
+        for job_idx, (_, fasta_path) in enumerate(jobs):
+            for header, seq in fasta.FastaFile.read(fasta_path).items():
+                combined_seqs[f'bb{job_idx}_{header}'] = seq
+        combined_fasta = os.path.join(batch_dir, 'combined.fa')
+        au.write_seqs_to_fasta(combined_seqs, combined_fasta)
+
+        self._log.info(f'Running AlphaFold2 on {len(combined_seqs)} sequences from {len(jobs)} backbones......')
+        self.run_af2(combined_fasta, batch_raw_dir)
+
+        # Demultiplex the outputs by their backbone prefix
+        prefixes = {f'bb{job_idx}_': decoy_pdb_dir for job_idx, (decoy_pdb_dir, _) in enumerate(jobs)}
+        for decoy_pdb_dir in prefixes.values():
+            os.makedirs(os.path.join(decoy_pdb_dir, 'af2_raw_outputs'), exist_ok=True)
+        with os.scandir(batch_raw_dir) as it:
+            for entry in it:
+                prefix = entry.name.split('_', 1)[0] + '_'
+                if prefix in prefixes:
+                    shutil.move(entry.path, os.path.join(
+                        prefixes[prefix], 'af2_raw_outputs', entry.name[len(prefix):]))
+        shutil.rmtree(batch_dir, ignore_errors=True)
 
 class Evaluator:
     def __init__(
@@ -677,7 +797,8 @@ class Evaluator:
             os.path.basename(os.path.normpath(self._infer_conf.backbone_pdb_dir))
             )
 
-        self._foldseek_path = self._eval_conf.foldseek_path
+        # OmegaConf reads `foldseek_path: None` as a string, both mean the foldseek on PATH
+        self._foldseek_path = self._eval_conf.foldseek_path if self._eval_conf.foldseek_path not in (None, "None") else None
         self._foldseek_database = self._eval_conf.foldseek_database
         self._assist_protein_path = self._eval_conf.assist_protein
 
@@ -687,6 +808,8 @@ class Evaluator:
 
         # Hardware resources
         self._num_cpu_cores = os.cpu_count()
+        self._foldseek_dbs = nu.FoldseekDatabases.from_eval_conf(
+            self._eval_conf, threads=self._num_cpu_cores, foldseek_path=self._foldseek_path)
 
         # Merge results into one csv file
         if 'ESMFold' in self.folding_method and 'AlphaFold2' in self.folding_method:
@@ -696,6 +819,14 @@ class Evaluator:
         else:
             self.prefix = 'af2'
 
+    def prefetch_foldseek_database(self):
+        """Start copying or prewarming the Foldseek database while the refolder is still busy."""
+        self._foldseek_dbs.prefetch()
+
+    def release_foldseek_database(self):
+        """Settle the prefetch and remove the tmpfs copy, the database is not searched after novelty."""
+        self._foldseek_dbs.close()
+
     def run_evaluation(self):
 
         # Merge results of different backbones
@@ -706,11 +837,10 @@ class Evaluator:
 
         summary_csv_path = os.path.join(self._result_dir, 'summary_results.csv')
         complete_csv_path = os.path.join(self._result_dir, 'complete_results.csv')
-        results_df.to_csv(complete_csv_path, index=False)
 
         # Analyze outputs
-        complete_results, summary_results, designability_count, backbones = au.analyze_success_rate(
-            merged_data=complete_csv_path,
+        complete_results, summary_results, designability_count, _ = au.analyze_success_rate(
+            merged_data=results_df,
             group_mode='all'
         )
         self._log.info(f'Designable backbones for {self._result_dir}: {designability_count}.')
@@ -718,75 +848,109 @@ class Evaluator:
         complete_results.to_csv(complete_csv_path, index=False)
         summary_results.to_csv(summary_csv_path, index=False)
 
+        # Filter successful samples once, both the copied backbones and the novelty search use them
+        success_mask = complete_results['Success'].to_numpy(dtype=bool)
+        success_results = complete_results[success_mask]
+        backbones = success_results['backbone_path'].unique()
+
         # Diversity Calculation
         successful_backbone_dir = os.path.join(self._result_dir, 'successful_backbones')
-        if not os.path.exists(successful_backbone_dir):
-            os.makedirs(successful_backbone_dir, exist_ok=False)
-        for pdb in backbones:
-            new_path = os.path.join(successful_backbone_dir, os.path.basename(pdb))
-            shutil.copy(pdb, new_path)
-
-        diversity = du.foldseek_cluster(
-            input=successful_backbone_dir,
-            assist_protein_path=self._assist_protein_path,
-            tmscore_threshold=0.5,
-            alignment_type= 1,
-            output_mode='DICT',
-            save_tmp=True,
-            foldseek_path=self._foldseek_path
-        )
+        os.makedirs(successful_backbone_dir, exist_ok=True)
+        # Nothing below modifies the backbones, so hardlinks are enough
+        au.stage_files(backbones, successful_backbone_dir)
+
+        # Foldseek results are reused on reruns as long as the set of successful backbones
+        # and the Foldseek settings are unchanged
+        backbones_signature = au.pdb_dir_signature(successful_backbone_dir)
+        tm_threshold = 0.5
+        query_db_path = os.path.join(self._result_dir, 'foldseek_query_db', 'queryDB')
+        diversity_result_path = os.path.join(successful_backbone_dir, 'diversity_cluster.tsv')
+        diversity_signature = f'{backbones_signature}-tm{tm_threshold}'
+        diversity_signature_path = os.path.join(self._result_dir, '.diversity.sig')
+        if os.path.exists(diversity_result_path) and au.signature_matches(diversity_signature_path, diversity_signature):
+            self._log.info('Diversity results already exist. Continuing...')
+            diversity = du.cluster_summary(diversity_result_path)
+        else:
+            diversity = du.foldseek_cluster(
+                input=successful_backbone_dir,
+                assist_protein_path=self._assist_protein_path,
+                tmscore_threshold=tm_threshold,
+                alignment_type= 1,
+                output_mode='DICT',
+                save_tmp=True,
+                foldseek_path=self._foldseek_path,
+                threads=self._num_cpu_cores,
+                query_db=self._foldseek_dbs.query_db(successful_backbone_dir, query_db_path) if au.dir_has_entries(successful_backbone_dir) else None
+            )
+            au.write_signature(diversity_signature_path, diversity_signature)
         self._log.info(f"Diversity Calculation for {self._result_dir} finished.\n\
             Total designable backbones: {diversity['Samples']}\n\
             Unique designable backbones: {diversity['Clusters']}\n\
             Diversity: {diversity['Diversity']}")
 
-        diversity_result_path = os.path.join(successful_backbone_dir, 'diversity_cluster.tsv')
         if os.path.exists(diversity_result_path):
-            with open (diversity_result_path, 'r') as f:
-                cluster_info = f.readlines()
-            cluster_info = [i.split('\t')[0] for i in cluster_info]
-            if 'assist_protein.pdb' in cluster_info:
-                cluster_info.remove('assist_protein.pdb')
-            unique_designable_backbones = set(cluster_info)
+            cluster_centers = pd.read_csv(diversity_result_path, sep='\t', header=None,
+                                          usecols=[0], dtype='string')[0].unique()
+            unique_designable_backbones = set(cluster_centers[cluster_centers != 'assist_protein.pdb'])
 
             unique_designable_backbones_dir = os.path.join(self._result_dir, 'unique_designable_backbones')
-            if not os.path.exists(unique_designable_backbones_dir):
-                os.makedirs(unique_designable_backbones_dir, exist_ok=False)
-            for pdb in unique_designable_backbones:
-                old_path = os.path.join(successful_backbone_dir, pdb)
-                shutil.copy(old_path, unique_designable_backbones_dir)
+            os.makedirs(unique_designable_backbones_dir, exist_ok=True)
+            au.stage_files([os.path.join(successful_backbone_dir, pdb) for pdb in unique_designable_backbones],
+                           unique_designable_backbones_dir)
         else:
             self._log.info('Diversity results not found. Please check if Foldseek clustered\
                 properly or there is no designable backbone presented.')
 
 
         # Novelty Calculation
-        if len(os.listdir(successful_backbone_dir)) > 0:
-            success_results = complete_results[complete_results['Success'] == True]
-            results_with_novelty = nu.calculate_novelty(
-                input_csv=success_results,
-                foldseek_database_path=self._eval_conf.foldseek_database,
-                max_workers=self._num_cpu_cores,
-                cpu_threshold=75.0
-            )
-            mean_novelty = results_with_novelty['pdbTM'].mean()
-            max_novelty = results_with_novelty['pdbTM'].min()
+        if au.dir_has_entries(successful_backbone_dir):
+            novelty_csv_path = os.path.join(self._result_dir, 'successful_novelty_results.csv')
+            novelty_signature_path = os.path.join(self._result_dir, '.novelty.sig')
+            batch_search = self._eval_conf.get('novelty_batch_search', True)
+            novelty_signature = f'{backbones_signature}-db{self._foldseek_dbs.resolved_path}-batch{batch_search}'
+            if os.path.exists(novelty_csv_path) and au.signature_matches(novelty_signature_path, novelty_signature):
+                self._log.info('Novelty results already exist. Continuing...')
+                results_with_novelty = pd.read_csv(novelty_csv_path)
+            else:
+                foldseek_database = self._foldseek_dbs.database()
+                results_with_novelty = nu.calculate_novelty(
+                    input_csv=success_results,
+                    foldseek_database_path=foldseek_database,
+                    max_workers=self._num_cpu_cores,
+                    cpu_threshold=75.0,
+                    batch_search=batch_search,
+                    tmp_dir=os.path.join(self._result_dir, 'novelty_search_tmp'),
+                    foldseek_path=self._foldseek_path,
+                    query_db=self._foldseek_dbs.query_db(successful_backbone_dir, query_db_path)
+                )
+                results_with_novelty.to_csv(novelty_csv_path, index=False)
+                au.write_signature(novelty_signature_path, novelty_signature)
+            # NaN marks backbones without a Foldseek hit, skip them as pandas did
+            novelty_values = results_with_novelty['pdbTM'].to_numpy(dtype=np.float32, na_value=np.nan)
+            mean_novelty = np.nanmean(novelty_values)
+            max_novelty = np.nanmin(novelty_values)
             self._log.info(f'Novelty Calculation finished.\n\
                 Average novelty (pdbTM) among successful backbones: {mean_novelty:.3f}\n\
                 The most novel backbone has a pdbTM of {max_novelty:.3f}')
-            novelty_csv_path = os.path.join(self._result_dir, 'successful_novelty_results.csv')
-            results_with_novelty.to_csv(novelty_csv_path, index=False)
         else:
             self._log.info('No successful backbone was found. Pass novelty calculation.')
             mean_novelty = 'null'
+        self.release_foldseek_database()
+
+        # The summary and the PyMol session touch disjoint files, so they are written in the
+        # background while the plots (matplotlib is kept on the main thread) are drawn
+        output_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        output_futures = []
 
         # Summary outputs
-        au.write_summary_results(
+        output_futures.append(output_pool.submit(
+            au.write_summary_results,
             stored_path=self._result_dir,
             pdb_count=pdb_count,
             designable_count=designability_count,
             diversity_result=diversity,
-            mean_novelty_value=mean_novelty)
+            novelty_value=mean_novelty,
+            prefix=self.prefix))
         """
         designable_fraction = f'{(designability_count / (pdb_count + 1e-6) * 100):.2f}'
         diversity_value = diversity['Diversity']
@@ -798,40 +962,61 @@ class Evaluator:
             f.write(f'Diversity: {diversity_value}\n')
             f.write(f'Novelty: {mean_novelty}\n')
         """
-        # Visualization
-        pu.plot_metrics_distribution(
-            input=os.path.join(self._result_dir, 'complete_results.csv'),
-            save_path=self._result_dir
-        )
-
         # Pymol session files
         native_backbones = self._conf.inference.native_pdbs_dir
-        pu.motif_scaffolding_pymol_write(
+        output_futures.append(output_pool.submit(
+            pu.motif_scaffolding_pymol_write,
             unique_designable_backbones=os.path.join(self._result_dir, 'unique_designable_backbones'),
             native_backbones=native_backbones,
             motif_json=os.path.join(self._result_dir, 'motif_info.json'),
             save_path=os.path.join(self._result_dir, 'pymol_session.pse')
-        )   
+        ))
+
+        # Visualization
+        try:
+            pu.plot_metrics_distribution(
+                input=os.path.join(self._result_dir, 'complete_results.csv'),
+                save_path=self._result_dir
+            )
+        finally:
+            output_pool.shutdown(wait=True)
+        for future in output_futures:
+            future.result()
 
 
-@hydra.main(version_base=None, config_path="../../config", config_name="motif_scaffolding.yaml")
-def run(conf: DictConfig) -> None:
+def run_one(conf: DictConfig) -> None:
 
     # Perform fixed backbone design and forward folding
     print('Starting refolding for motif-scaffolding task......')
-    start_time = time.time()
+    t0 = time.perf_counter()
     refolder = Refolder(conf)
-    refolder.run_sampling()
-    elapsed_time = time.time() - start_time
-    print(f"Refolding finished in {elapsed_time:.2f}s.")
-
-    # Perform analysis on outputs
-    start_time = time.time()
+    # Overlap loading the Foldseek database with refolding
     evaluator = Evaluator(conf)
-    evaluator.run_evaluation()
-    elapsed_time = time.time() - start_time
-    print(f'Evaluation finished in {elapsed_time:.2f}s. Voila!')
+    evaluator.prefetch_foldseek_database()
+    try:
+        refolder.run_sampling()
+        t1 = time.perf_counter()
+
+        # Perform analysis on outputs
+        evaluator.run_evaluation()
+        t2 = time.perf_counter()
+    finally:
+        evaluator.release_foldseek_database()
+    print(f'Refolding finished in {t1 - t0:.2f}s | Evaluation finished in {t2 - t1:.2f}s. Voila!')
+
+
+@hydra.main(version_base=None, config_path="../../config", config_name="motif_scaffolding.yaml")
+def run(conf: DictConfig) -> None:
 
+    # Run the config once per `sweep` entry, merged over the command line config
+    sweep = conf.get('sweep', None)
+    base_conf = OmegaConf.masked_copy(conf, [key for key in conf.keys() if key != 'sweep'])
+    if not sweep:
+        run_one(base_conf)
+        return
+    for overrides in sweep:
+        print(f'Running sweep entry {list(overrides)}......')
+        run_one(OmegaConf.merge(base_conf, OmegaConf.from_dotlist(list(overrides))))
 
 if __name__ == '__main__':
     run()
@@ -11,7 +11,6 @@ To run ESMFold and AlphaFold2 simultaneously:
 """
 
 import os
-import tree
 import time
 import numpy as np
 import hydra
@@ -21,13 +20,10 @@ import logging
 import pandas as pd
 import sys
 import rootutils
-import shutil
-import GPUtil
 from pathlib import Path
 from typing import Optional, Dict, List, Union
 from omegaconf import DictConfig, OmegaConf
 
-import esm
 from biotite.sequence.io import fasta
 
 
@@ -42,6 +38,7 @@ rootutils.set_root(
 
 from analysis import utils as au
 from data import structure_utils as su
+from analysis import folding as fu
 
 
 class Refolder:
@@ -82,11 +79,7 @@ class Refolder:
         # Set-up accelerator
         if torch.cuda.is_available():
             if self._infer_conf.gpu_id is None:
-                available_gpus = ''.join(
-                    [str(x) for x in GPUtil.getAvailable(
-                        order="memory", limit = 8)]
-                )
-                self.device = f'cuda:{available_gpus[0]}'
+                self.device = f'cuda:{au.get_most_free_gpu()}'
             else:
                 self.device = f'cuda:{self._infer_conf.gpu_id}'
         else:
@@ -97,12 +90,7 @@ class Refolder:
         self._forward_folding = self._infer_conf.predict_method
         if 'AlphaFold2' in self._forward_folding:
             self._af2_conf = self._infer_conf.af2
-            colabfold_path = self._af2_conf.executive_colabfold_path
-            current_path = os.environ.get('PATH', '')
-            os.environ['PATH'] = colabfold_path + ":" + current_path
-            if self.device == 'cpu':
-                #raise ValueError("Only GPU supported for AlphaFold2 currently.")
-                self._log.info(f"You're running AlphaFold2 on {self.device}.")
+            fu.setup_af2(self._af2_conf, self.device)
         
         
         # Set-up directories
@@ -122,45 +110,47 @@ class Refolder:
         self._log.info(f'Saving self-consistency config to {config_path}')
         
         # Load models and experiment
-        if 'cuda' in self.device:
-            self._folding_model = esm.pretrained.esmfold_v1().eval()
-        elif self.device == 'cpu': # ESMFold is not supported for half-precision model when running on CPU
-            self._folding_model = esm.pretrained.esmfold_v1().float().eval()
-        self._folding_model = self._folding_model.to(self.device)
+        self._folding_model, self._esmfold_autocast, self._esmfold_autocast_dtype = fu.load_esmfold(self.device, self._infer_conf)
+        # ESMFold outputs are written to disk in the background while the GPU folds the next batch
+        self._pdb_writer = fu.PDBWriter()
     
     def run_sampling(self):
         
         # Run ProteinMPNN
 
-        for pdb_file in os.listdir(self._sample_dir):
-            backbone_name = os.path.splitext(pdb_file)[0]
-            print(f'sample_dir: {self._sample_dir}')
-            basename_dir = os.path.basename(os.path.normpath(self._sample_dir))
-            backbone_dir = os.path.join(self._output_dir, basename_dir, f'{backbone_name}')
-            if os.path.exists(backbone_dir):
-                self._log.info(f'Backbone {backbone_name} already existed, pass then.')
-                continue
+        try:
+            for pdb_file in os.listdir(self._sample_dir):
+                backbone_name = os.path.splitext(pdb_file)[0]
+                print(f'sample_dir: {self._sample_dir}')
+                basename_dir = os.path.basename(os.path.normpath(self._sample_dir))
+                backbone_dir = os.path.join(self._output_dir, basename_dir, f'{backbone_name}')
+                if os.path.exists(backbone_dir):
+                    self._log.info(f'Backbone {backbone_name} already existed, pass then.')
+                    continue
             
-            os.makedirs(backbone_dir, exist_ok=True)
-            self._log.info(f'Running self-consistency on {backbone_name}')
-            print(f'pdb_file:{pdb_file}')
-            print(f'backbone_dir:{backbone_dir}')
-            shutil.copy2(os.path.join(self._sample_dir, pdb_file), backbone_dir)
-            self._log.info(f'copied {pdb_file} to {backbone_dir}')
+                os.makedirs(backbone_dir, exist_ok=True)
+                self._log.info(f'Running self-consistency on {backbone_name}')
+                print(f'pdb_file:{pdb_file}')
+                print(f'backbone_dir:{backbone_dir}')
+                au.link_or_copy(os.path.join(self._sample_dir, pdb_file),
+                        os.path.join(backbone_dir, pdb_file))
+                self._log.info(f'linked {pdb_file} to {backbone_dir}')
             
-            #seperate_pdb_folder = os.path.join(backbone_dir, backbone_name)
-            pdb_path = os.path.join(backbone_dir, pdb_file)
-            sc_output_dir = os.path.join(backbone_dir, 'self_consistency')
-            os.makedirs(sc_output_dir, exist_ok=True)
-            shutil.copy(pdb_path, os.path.join(
-                sc_output_dir, os.path.basename(pdb_path)))
-
-            _ = self.run_self_consistency(
-                sc_output_dir,
-                pdb_path,
-                motif_mask=None
-            )
-            self._log.info(f'Done sample: {pdb_path}')
+                #seperate_pdb_folder = os.path.join(backbone_dir, backbone_name)
+                pdb_path = os.path.join(backbone_dir, pdb_file)
+                sc_output_dir = os.path.join(backbone_dir, 'self_consistency')
+                os.makedirs(sc_output_dir, exist_ok=True)
+                au.link_or_copy(pdb_path, os.path.join(
+                    sc_output_dir, os.path.basename(pdb_path)))
+
+                _ = self.run_self_consistency(
+                    sc_output_dir,
+                    pdb_path,
+                    motif_mask=None
+                )
+                self._log.info(f'Done sample: {pdb_path}')
+        finally:
+            self._pdb_writer.shutdown()
     
     def run_self_consistency(
             self,
@@ -191,8 +181,6 @@ class Refolder:
         ])
         
         _ = process.wait()
-        num_tries = 0
-        ret = -1
         pmpnn_args = [
             sys.executable,
             f'{self._pmpnn_dir}/protein_mpnn_run.py',
@@ -215,20 +203,7 @@ class Refolder:
         if self._CA_only == True:
             pmpnn_args.append('--ca_only')
         
-        while ret < 0:
-            try:
-                process = subprocess.Popen(
-                    pmpnn_args,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT
-                )
-                ret = process.wait()
-            except Exception as e:
-                num_tries += 1
-                self._log.info(f'Failed ProteinMPNN. Attempt {num_tries}/5')
-                torch.cuda.empty_cache()
-                if num_tries > 4:
-                    raise e
+        au.run_with_retries(pmpnn_args, 'ProteinMPNN', timeout=self._infer_conf.get('subprocess_timeout', None))
         mpnn_fasta_path = os.path.join(
             decoy_pdb_dir,
             'seqs',
@@ -287,8 +262,12 @@ class Refolder:
         seqs_dict = fasta.FastaFile.read(seqs_to_refold)
         
         sample_feats = su.parse_pdb_feats('sample', reference_pdb_path)
+        # The sample sequence and backbone are compared against every prediction below
+        sample_seq = su.aatype_to_seq(sample_feats['aatype'])
+        sample_bb = sample_feats['bb_positions']
         if 'ESMFold' in self._forward_folding:
             os.makedirs(esmf_dir, exist_ok=True)
+            esmf_entries = []
             for i, (header, string) in enumerate(seqs_dict.items()):
                 
                 # Get score for ProteinMPNN
@@ -298,39 +277,49 @@ class Refolder:
                 else:
                     idx = 0
                     score = float(header.split(", ")[2].split("=")[1])
-
-                # Run ESMFold
-                self._log.info(f'Running ESMFold......')
-                esmf_sample_path = os.path.join(esmf_dir, f'sample_{idx}.pdb')
-                _, full_output = self.run_folding(string, esmf_sample_path)
-                esmf_feats = su.parse_pdb_feats('folded_sample', esmf_sample_path)
-                sample_seq = su.aatype_to_seq(sample_feats['aatype'])
-
+                esmf_entries.append((idx, header, string, score))
+
+            # Run ESMFold on batches of sequences with similar lengths to keep padding low
+            self._log.info(f'Running ESMFold......')
+            esmf_entries.sort(key=lambda x: len(x[2]))
+            esmfold_batch_size = self._sample_conf.get('esmfold_batch_size', 1)
+            esmf_outputs = []
+            for start in range(0, len(esmf_entries), esmfold_batch_size):
+                batch = esmf_entries[start:start + esmfold_batch_size]
+                batch_paths = [os.path.join(esmf_dir, f'sample_{idx}.pdb') for idx, *_ in batch]
+                batch_outputs = self.run_folding_batch([string for _, _, string, _ in batch], batch_paths)
+                esmf_outputs.extend(zip(batch, batch_paths, batch_outputs))
+            self._pdb_writer.wait()
+
+            # Compute the structural metrics of the whole set in one batched pass,
+            # using the CA coordinates returned by ESMFold instead of re-parsing the PDBs.
+            esmf_bb_positions = np.stack([full_output['bb_positions'] for *_, full_output in esmf_outputs])
+            rmsds = su.batched_aligned_rmsd(sample_bb, esmf_bb_positions)
+            if motif_mask is not None:
+                motif_rmsds = su.batched_aligned_rmsd(
+                    sample_bb[motif_mask], esmf_bb_positions[:, motif_mask])
+
+            for i, ((idx, header, string, score), esmf_sample_path, full_output) in enumerate(esmf_outputs):
                 # Calculate scTM of ESMFold outputs with reference protein
                 _, tm_score = su.calc_tm_score(
-                    sample_feats['bb_positions'], esmf_feats['bb_positions'],
+                    sample_bb, esmf_bb_positions[i].astype(np.float64),
                     sample_seq, sample_seq)
-                rmsd = su.calc_aligned_rmsd(
-                    sample_feats['bb_positions'], esmf_feats['bb_positions'])
+                rmsd = rmsds[i]
                 pae = torch.mean(full_output['predicted_aligned_error']).item()
                 ptm = full_output['ptm'].item()
                 plddt = full_output['mean_plddt'].item()
                 if motif_mask is not None:
-                    sample_motif = sample_feats['bb_positions'][motif_mask]
-                    esm_motif = esmf_feats['bb_positions'][motif_mask]
-                    motif_rmsd = su.calc_aligned_rmsd(
-                        sample_motif, esm_motif)
-                    mpnn_results['motif_rmsd'].append(f'{motif_rmsd:.3f}')
-                mpnn_results['rmsd'].append(f'{rmsd:.3f}')
-                mpnn_results['tm_score'].append(f'{tm_score:.3f}')
+                    mpnn_results['motif_rmsd'].append(motif_rmsds[i])
+                mpnn_results['rmsd'].append(rmsd)
+                mpnn_results['tm_score'].append(tm_score)
                 mpnn_results['sample_path'].append(os.path.abspath(esmf_sample_path))
                 mpnn_results['header'].append(header)
                 mpnn_results['sequence'].append(string)
-                mpnn_results['pae'].append(f'{pae:.3f}')
-                mpnn_results['ptm'].append(f'{ptm:.3f}')
-                mpnn_results['plddt'].append(f'{plddt:.3f}')
+                mpnn_results['pae'].append(pae)
+                mpnn_results['ptm'].append(ptm)
+                mpnn_results['plddt'].append(plddt)
                 mpnn_results['length'].append(len(string))
-                mpnn_results['mpnn_score'].append(f'{score:.3f}')
+                mpnn_results['mpnn_score'].append(score)
                 mpnn_results['sample_idx'].append(int(idx))
 
             # Save results to CSV
@@ -339,7 +328,7 @@ class Refolder:
             #esm_columns = ['sample_idx'] + [c for c in mpnn_results.columns if c != 'sample_idx']
             #mpnn_results = mpnn_results.reindex(columns=esm_columns)
             mpnn_results.sort_values('sample_idx', inplace=True)
-            mpnn_results.to_csv(esm_csv_path, index=False)
+            mpnn_results.to_csv(esm_csv_path, index=False, float_format='%.3f')
 
         # Run AF2
         if 'AlphaFold2' in self._forward_folding:
@@ -364,25 +353,24 @@ class Refolder:
 
                 af2_sample_path = os.path.join(af2_dir, f'sample_{idx}.pdb')
                 af2_feats = su.parse_pdb_feats('folded_sample', af2_sample_path)
-                sample_seq = su.aatype_to_seq(sample_feats['aatype'])
 
                 # Calculation
                 _, tm_score = su.calc_tm_score(
-                    sample_feats['bb_positions'], af2_feats['bb_positions'],
+                    sample_bb, af2_feats['bb_positions'],
                     sample_seq, sample_seq)
                 rmsd = su.calc_aligned_rmsd(
-                    sample_feats['bb_positions'], af2_feats['bb_positions'])
+                    sample_bb, af2_feats['bb_positions'])
                 if motif_mask is not None:
-                    sample_motif = sample_feats['bb_positions'][motif_mask]
+                    sample_motif = sample_bb[motif_mask]
                     af2_motif = af2_feats['bb_positions'][motif_mask]
                     motif_rmsd = su.calc_aligned_rmsd(
                         sample_motif, af2_motif)
-                af2_outputs[f'sample_{idx}']['rmsd'] = f'{rmsd:.3f}'
-                af2_outputs[f'sample_{idx}']['tm_score'] = f'{tm_score:.3f}'
+                af2_outputs[f'sample_{idx}']['rmsd'] = rmsd
+                af2_outputs[f'sample_{idx}']['tm_score'] = tm_score
                 af2_outputs[f'sample_{idx}']['header'] = header
                 af2_outputs[f'sample_{idx}']['sequence'] = string
                 af2_outputs[f'sample_{idx}']['length'] = len(string)
-                af2_outputs[f'sample_{idx}']['mpnn_score'] = f'{score:.3f}'
+                af2_outputs[f'sample_{idx}']['mpnn_score'] = score
                 af2_outputs[f'sample_{idx}']['sample_idx'] = int(idx)
             print(f'final_outputs: {af2_outputs}')
             af2_csv_path = os.path.join(decoy_pdb_dir, 'af2_eval_results.csv')
@@ -394,15 +382,15 @@ class Refolder:
             #af2_columns = ['sample_idx'] + [c for c in af2_df.columns if c != 'sample_idx']
             #af2_df = af2_df.reindex(columns=af2_columns)
             af2_df.sort_values('sample_idx', inplace=True)
-            af2_df.to_csv(af2_csv_path, index=False)
+            af2_df.to_csv(af2_csv_path, index=False, float_format='%.3f')
 
         if 'ESMFold' in self._forward_folding and 'AlphaFold2' in self._forward_folding:
-            esm_results = pd.read_csv(esm_csv_path)
-            af2_results = pd.read_csv(af2_csv_path)
-            esm_results['folding_method'] = 'ESMFold'
-            af2_results['folding_method'] = 'AlphaFold2'
-            joint_results = pd.concat([esm_results, af2_results], ignore_index=True)
-            joint_results.to_csv(os.path.join(decoy_pdb_dir, 'joint_eval_results.csv'), index=False)
+            # Both result tables are still in memory, so there is no need to read the CSVs back
+            joint_results = pd.concat([
+                mpnn_results.assign(folding_method='ESMFold'),
+                af2_df.assign(folding_method='AlphaFold2')
+            ], ignore_index=True)
+            joint_results.to_csv(os.path.join(decoy_pdb_dir, 'joint_eval_results.csv'), index=False, float_format='%.3f')
 
 
 
@@ -411,78 +399,35 @@ class Refolder:
         Run ESMFold on sequence.
         TBD: Add options for OmegaFold and AlphaFold2.
         """
-        with torch.no_grad():
-            output = self._folding_model.infer(sequence)
-            output_dict = {key: value.cpu() for key, value in output.items()}
-            output = self._folding_model.output_to_pdb(output)
-        with open(save_path, "w") as f:
-            f.write(output[0])
-        return output, output_dict  
+        return fu.run_esmfold(self._folding_model, sequence, save_path, self.device,
+                              self._esmfold_autocast, self._esmfold_autocast_dtype)
+
+    def run_folding_batch(self, sequences, save_paths):
+        """
+        Run ESMFold on a batch of sequences in a single forward pass. The PDB files are
+        written in the background, `self._pdb_writer.wait()` before reading them.
+        """
+        return fu.run_esmfold_batch(self._folding_model, sequences, save_paths, self.device,
+                                    self._esmfold_autocast, self._esmfold_autocast_dtype,
+                                    pdb_writer=self._pdb_writer)
 
     def run_af2(self, sequence, save_path):
         """
         Run AlphaFold2 (single-sequence) through LocalColabFold.
         """
-
-        #_ = process.wait()
-        num_tries_af2 = 0
-        ret_af2 = -1
-
-        # Setting AF2 args
-        af2_args = [
-            #sys.executable,
-            'colabfold_batch',
-            sequence,
-            save_path,
-            '--msa-mode',
-            'single_sequence',
-            '--num-recycle',
-            str(self._af2_conf.recycle),
-            '--random-seed',
-            str(self._af2_conf.seed),
-            '--model-type',
-            self._af2_conf.model_type,
-            '--num-models',
-            str(self._af2_conf.num_models),
-        ]
-        if self._af2_conf.num_models > 1:
-            af2_args.append('--rank')
-            af2_args.append(self._af2_conf.rank)
-        if self._af2_conf.use_amber_relax:
-            af2_args.append('--amber')
-            af2_args.append('--num-relax')
-            af2_args.append(str(self._af2_conf.num_relax))
-            if self._af2_conf.use_gpu_relax:
-                af2_args.append('--use-gpu-relax')
-
-        # Run AF2
-        while ret_af2 < 0:
-            try:
-                process_af2 = subprocess.Popen(
-                    af2_args,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT
-                )
-                
-                ret_af2 = process_af2.wait()
-            except Exception as e:
-                num_tries_af2 += 1
-                self._log.info(f'Hmm...Maybe some error occurs during executing AlphaFold2. Tried {num_tries_af2}/5')
-                torch.cuda.empty_cache()
-                if num_tries_af2 > 10:
-                    raise e
-
-        # Handle outputs
+        fu.run_colabfold(fu.colabfold_args(self._af2_conf), sequence, save_path,
+                         gpu_ids=self._af2_conf.get('gpu_ids', None),
+                         timeout=self._infer_conf.get('subprocess_timeout', None))
 
     
 @hydra.main(version_base=None, config_path="../../config", config_name="unconditional")
 def run(conf: DictConfig) -> None:
     
     print('Starting refolding for unconditional generation......')
-    start_time = time.time()
+    start_time = time.perf_counter()
     refolder = Refolder(conf)
     refolder.run_sampling()
-    elapsed_time = time.time() - start_time
+    elapsed_time = time.perf_counter() - start_time
     print(f"Finished in {elapsed_time:.2f}s. Voila!")
     
 if __name__ == '__main__':
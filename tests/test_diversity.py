@@ -0,0 +1,32 @@
+import pytest
+
+from analysis import diversity as du
+
+
+def _write_tsv(path, rows):
+    path.write_text(''.join(f'{center}\t{member}\n' for center, member in rows))
+    return path
+
+
+def test_cluster_summary(tmp_path):
+    tsv = _write_tsv(tmp_path / 'diversity_cluster.tsv', [
+        ('a.pdb', 'a.pdb'),
+        ('a.pdb', 'b.pdb'),
+        ('a.pdb', 'c.pdb'),
+        ('d.pdb', 'd.pdb'),
+    ])
+    assert du.cluster_summary(tsv) == {"Clusters": 2, "Samples": 4, "Diversity": 0.5}
+
+
+def test_cluster_summary_detects_assist_protein(tmp_path):
+    rows = [
+        ('a.pdb', 'a.pdb'),
+        ('a.pdb', 'b.pdb'),
+        ('c.pdb', 'c.pdb'),
+        ('assist_protein.pdb', 'assist_protein.pdb'),
+    ]
+    tsv = _write_tsv(tmp_path / 'diversity_cluster.tsv', rows)
+    expected = {"Clusters": 2, "Samples": 3, "Diversity": pytest.approx(0.667)}
+    assert du.cluster_summary(tsv) == expected
+    # Passing the number of assistant proteins explicitly gives the same result
+    assert du.cluster_summary(tsv, assist_num=1) == expected
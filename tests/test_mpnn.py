@@ -0,0 +1,76 @@
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+from analysis import mpnn as mu
+
+
+PMPNN_DIR = Path(__file__).resolve().parents[1] / 'tools' / 'ProteinMPNN'
+PDB_PATH = PMPNN_DIR / 'inputs' / 'PDB_monomers' / 'pdbs' / '5L33.pdb'
+SCORE_RE = re.compile(r'^-?\d+\.\d{4}$')
+
+
+def _read_fasta(path):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    return list(zip(lines[::2], lines[1::2]))
+
+
+def _fields(header):
+    """Split a FASTA header into (key, value) pairs, the native header starts with the bare name."""
+    return [tuple(field.split('=', 1)) if '=' in field else (field,)
+            for field in re.split(r', (?![^\[]*\])', header[1:])]
+
+
+@pytest.mark.skipif(not (PMPNN_DIR / 'vanilla_model_weights' / 'v_48_020.pt').exists(),
+                    reason='ProteinMPNN weights are not available')
+def test_sampler_fasta_matches_protein_mpnn_run(tmp_path):
+    num_seqs, batch_size = 4, 2
+    run_dir = tmp_path / 'protein_mpnn_run'
+    subprocess.run([
+        sys.executable, str(PMPNN_DIR / 'protein_mpnn_run.py'),
+        '--pdb_path', str(PDB_PATH),
+        '--out_folder', str(run_dir),
+        '--num_seq_per_target', str(num_seqs),
+        '--sampling_temp', '0.1',
+        '--seed', '33',
+        '--batch_size', str(batch_size),
+    ], check=True, capture_output=True, env={**os.environ, 'CUDA_VISIBLE_DEVICES': ''})
+    expected = _read_fasta(run_dir / 'seqs' / '5L33.fa')
+
+    sampler = mu.ProteinMPNNSampler(PMPNN_DIR, 'cpu')
+    fasta_path = sampler.sample(PDB_PATH, tmp_path / 'sampler', num_seqs=num_seqs, batch_size=batch_size)
+    records = _read_fasta(fasta_path)
+
+    assert fasta_path == os.path.join(tmp_path / 'sampler', 'seqs', '5L33.fa')
+    assert len(records) == len(expected) == num_seqs + 1
+
+    # The native record is the same apart from its scores, which depend on the random decoding order
+    (header, native_seq), (expected_header, expected_native_seq) = records[0], expected[0]
+    assert native_seq == expected_native_seq
+    fields, expected_fields = _fields(header), _fields(expected_header)
+    assert [field[0] for field in fields] == [field[0] for field in expected_fields]
+    for field, expected_field in zip(fields, expected_fields):
+        if field[0] in ('score', 'global_score'):
+            assert SCORE_RE.match(field[1]) and SCORE_RE.match(expected_field[1])
+        else:
+            assert field == expected_field
+
+    # Sampled records use the same keys, sample numbering and number formats
+    for (header, seq), (expected_header, expected_seq) in zip(records[1:], expected[1:]):
+        fields, expected_fields = _fields(header), _fields(expected_header)
+        assert [key for key, _ in fields] == [key for key, _ in expected_fields]
+        assert dict(fields)['T'] == dict(expected_fields)['T'] == '0.1'
+        assert dict(fields)['sample'] == dict(expected_fields)['sample']
+        for key in ('score', 'global_score', 'seq_recovery'):
+            assert SCORE_RE.match(dict(fields)[key]) and SCORE_RE.match(dict(expected_fields)[key])
+        assert len(seq) == len(expected_seq)
+
+
+def test_join_mpnn_chains_orders_by_chain_id():
+    assert mu._join_mpnn_chains('AAABBBBC', [3, 4, 1], ['B', 'C', 'A']) == 'C/AAA/BBBB'
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from analysis import novelty as nu
+
+
+M8_HEADER = 'query\ttarget\tevalue\talntmscore\trmsd\tprob\n'
+
+
+@pytest.fixture
+def backbones(tmp_path):
+    paths = []
+    for name in ('a.pdb', 'b.pdb', 'c.pdb'):
+        path = tmp_path / 'backbones' / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text('')
+        paths.append(str(path))
+    return paths
+
+
+def _fake_foldseek(monkeypatch, tmp_dir, rows):
+    """Replace the Foldseek calls by writing `rows` as the search results."""
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd)
+        with open(os.path.join(tmp_dir, 'batched_search.m8'), 'w') as f:
+            f.write(M8_HEADER + ''.join('\t'.join(row) + '\n' for row in rows))
+
+    monkeypatch.setattr(nu.subprocess, 'run', run)
+    return commands
+
+
+def test_batched_pdbTM_takes_top_hit_and_strips_chain_suffix(tmp_path, monkeypatch, backbones):
+    tmp_dir = str(tmp_path / 'search')
+    # Staged queries are prefixed with their index, Foldseek appends the chain to the name
+    commands = _fake_foldseek(monkeypatch, tmp_dir, [
+        ('0_a.pdb_A', 'pdb1', '1e-10', '0.81234', '1.0', '1.0'),
+        ('0_a.pdb_A', 'pdb2', '1e-5', '0.9', '1.0', '1.0'),
+        ('1_b.pdb', 'pdb3', '1e-3', '0.5', '2.0', '0.8'),
+    ])
+
+    values = nu.batched_pdbTM(backbones, 'pdb_db', threads=2, tmp_dir=tmp_dir)
+
+    assert values == {
+        backbones[0]: pytest.approx(0.812),
+        backbones[1]: pytest.approx(0.5),
+        backbones[2]: None,
+    }
+    assert len(commands) == 1 and commands[0].startswith('foldseek easy-search')
+    assert not os.path.exists(tmp_dir)
+
+
+def test_batched_pdbTM_query_db(tmp_path, monkeypatch, backbones):
+    tmp_dir = str(tmp_path / 'search')
+    # Entries of a query database are named after the PDB files
+    commands = _fake_foldseek(monkeypatch, tmp_dir, [
+        ('b.pdb_A', 'pdb1', '1e-10', '0.7', '1.0', '1.0'),
+        ('c.pdb', 'pdb2', '1e-10', '0.6', '1.0', '1.0'),
+    ])
+
+    values = nu.batched_pdbTM(backbones, 'pdb_db', threads=2, tmp_dir=tmp_dir,
+                              foldseek_path='/opt/foldseek/bin/foldseek', query_db='queryDB')
+
+    assert values == {
+        backbones[0]: None,
+        backbones[1]: pytest.approx(0.7),
+        backbones[2]: pytest.approx(0.6),
+    }
+    assert [cmd.split()[:2] for cmd in commands] == [
+        ['/opt/foldseek/bin/foldseek', 'search'],
+        ['/opt/foldseek/bin/foldseek', 'convertalis'],
+    ]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from scipy.stats import gaussian_kde
+
+pu = pytest.importorskip("analysis.plot")
+
+
+def _sorted_cells(x, y, counts):
+    order = np.lexsort((y, x))
+    return np.column_stack([x, y])[order], np.asarray(counts)[order]
+
+
+@pytest.mark.parametrize('gridsize', [10, 30])
+def test_hexbin_counts_matches_matplotlib(gridsize):
+    rng = np.random.default_rng(0)
+    x = rng.gamma(2.0, 1.5, size=5000)
+    y = x + rng.normal(scale=0.8, size=x.size)
+
+    hex_x, hex_y, counts, extent = pu._hexbin_counts(x, y, gridsize=gridsize, mincnt=1)
+
+    fig, ax = plt.subplots()
+    try:
+        expected = ax.hexbin(x, y, gridsize=gridsize, mincnt=1)
+        # `plot_metrics_distribution` hands only the occupied centers and their counts to matplotlib
+        rebinned = ax.hexbin(hex_x, hex_y, C=counts, reduce_C_function=np.sum, gridsize=gridsize, extent=extent)
+    finally:
+        plt.close(fig)
+
+    expected_offsets, expected_counts = _sorted_cells(
+        expected.get_offsets()[:, 0], expected.get_offsets()[:, 1], expected.get_array())
+    for offsets_x, offsets_y, cell_counts in [
+            (hex_x, hex_y, counts),
+            (rebinned.get_offsets()[:, 0], rebinned.get_offsets()[:, 1], rebinned.get_array())]:
+        offsets, cell_counts = _sorted_cells(offsets_x, offsets_y, cell_counts)
+        np.testing.assert_allclose(offsets, expected_offsets, rtol=1e-6, atol=1e-9)
+        np.testing.assert_array_equal(cell_counts, expected_counts)
+    assert counts.sum() == x.size
+
+
+def test_hexbin_counts_mincnt_drops_sparse_cells():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=2000)
+    y = rng.normal(size=2000)
+    _, _, counts, _ = pu._hexbin_counts(x, y, gridsize=30, mincnt=5)
+    assert counts.min() >= 5
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_fast_kde_1d_matches_scipy(dtype):
+    rng = np.random.default_rng(2)
+    x = np.concatenate([rng.normal(1.0, 0.3, 3000), rng.normal(3.0, 0.6, 2000)]).astype(dtype)
+
+    grid, density = pu._fast_kde_1d(x)
+
+    # Same Silverman bandwidth as `_fast_kde_1d`, expressed as scipy's factor of the sample std
+    bw = 1.06 * x.std() * x.size ** -0.2
+    expected = gaussian_kde(x.astype(np.float64), bw_method=bw / x.std(ddof=1))(grid)
+    assert density.dtype == dtype
+    np.testing.assert_allclose(density, expected, atol=0.01 * expected.max())
+    np.testing.assert_allclose(np.sum(density) * (grid[1] - grid[0]), 1.0, rtol=1e-3)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from data import structure_utils as su
+
+
+def _random_rotation(rng):
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q *= np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:, 0] *= -1
+    return q
+
+
+def test_batched_aligned_rmsd_matches_calc_aligned_rmsd():
+    rng = np.random.default_rng(0)
+    ref = rng.normal(scale=10.0, size=(64, 3))
+    preds = np.stack([
+        ref @ _random_rotation(rng).T + rng.normal(size=3) + rng.normal(scale=scale, size=ref.shape)
+        for scale in (0.0, 0.5, 2.0, 5.0)
+    ])
+
+    expected = np.array([su.calc_aligned_rmsd(ref, pred) for pred in preds])
+    np.testing.assert_allclose(su.batched_aligned_rmsd(ref, preds), expected, rtol=1e-6, atol=1e-8)
+
+
+def test_batched_aligned_rmsd_rigid_copy_is_zero():
+    rng = np.random.default_rng(1)
+    ref = rng.normal(size=(20, 3))
+    preds = np.stack([ref @ _random_rotation(rng).T + rng.normal(size=3) for _ in range(3)])
+    np.testing.assert_allclose(su.batched_aligned_rmsd(ref, preds), 0.0, atol=1e-6)
+
+
+def test_batched_aligned_rmsd_does_not_reflect():
+    # A mirror image cannot be superimposed by a proper rotation
+    rng = np.random.default_rng(2)
+    ref = rng.normal(size=(30, 3))
+    mirrored = ref * np.array([-1.0, 1.0, 1.0])
+    rmsd = su.batched_aligned_rmsd(ref, mirrored[None])
+    np.testing.assert_allclose(rmsd, [su.calc_aligned_rmsd(ref, mirrored)], rtol=1e-6)
+    assert rmsd[0] > 0.1
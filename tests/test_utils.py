@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+au = pytest.importorskip("analysis.utils")
+
+
+@pytest.fixture
+def backbone_dir(tmp_path):
+    for name in ('sample_0.pdb', 'sample_1.pdb'):
+        (tmp_path / name).write_text(f'ATOM {name}\n')
+    return tmp_path
+
+
+def test_pdb_dir_signature_is_stable(backbone_dir):
+    assert au.pdb_dir_signature(backbone_dir) == au.pdb_dir_signature(backbone_dir)
+
+
+def test_pdb_dir_signature_ignores_other_files(backbone_dir):
+    signature = au.pdb_dir_signature(backbone_dir)
+    (backbone_dir / 'diversity_cluster.tsv').write_text('sample_0.pdb\tsample_0.pdb\n')
+    (backbone_dir / 'assist_protein.pdb').write_text('ATOM\n')
+    (backbone_dir / 'tmp').mkdir()
+    assert au.pdb_dir_signature(backbone_dir) == signature
+
+
+@pytest.mark.parametrize('change', ['add', 'remove', 'rewrite', 'touch'])
+def test_pdb_dir_signature_invalidation(backbone_dir, change):
+    signature = au.pdb_dir_signature(backbone_dir)
+    pdb = backbone_dir / 'sample_0.pdb'
+    if change == 'add':
+        (backbone_dir / 'sample_2.pdb').write_text('ATOM\n')
+    elif change == 'remove':
+        pdb.unlink()
+    elif change == 'rewrite':
+        pdb.write_text('ATOM rewritten with a different size\n')
+    else:
+        stat = pdb.stat()
+        os.utime(pdb, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert au.pdb_dir_signature(backbone_dir) != signature
+
+
+def test_signature_roundtrip(tmp_path):
+    signature_path = tmp_path / '.esm_diversity.sig'
+    assert not au.signature_matches(signature_path, 'abc-tm0.5')
+    au.write_signature(signature_path, 'abc-tm0.5')
+    assert au.signature_matches(signature_path, 'abc-tm0.5')
+    assert not au.signature_matches(signature_path, 'abc-tm0.6')